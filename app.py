@@ -1,31 +1,47 @@
 import os
+import base64
+import json
 import random
 import logging
 import time
 import string
+import multiprocessing
 from io import BytesIO
-from datetime import datetime
-from flask import Flask, request, send_file, jsonify, render_template_string, redirect, session
+from datetime import datetime, timezone
+from flask import (Flask, request, send_file, send_from_directory, jsonify, render_template_string, redirect,
+                   session, Response, stream_with_context)
 from groq import Groq
-from PIL import Image, ImageDraw, ImageFont
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from core.db import DBPool
+from core.analytics import AnalyticsWriter
+from core.counters import RoastCounters
+from core.cache import TTLCache
+from core.llm import ModelRouter
+from core.roast_pool import RoastPool
+from core.templates import TemplateRegistry, MEME_RESCAN_SECS
+from core.render import RenderPool
+from core.uploads import UploadQueue
+from core.render_cache import RenderCache, card_key
+from core.roast_card import OUTPUT_W
+from core.formats import negotiate, quality_for, sniff, MIME, EXT
+from core.migrations import migrate, pending, MIGRATE_ON_BOOT, MIGRATE_BOOT_WAIT
+from core.battles import BattleCache
+from core import rollups
 
 try:
-    import requests as req_lib
+    from core.geo import make_geo_lookup
     GEO_ENABLED = True
 except:
     GEO_ENABLED = False
 
 try:
-    from search import get_smart_context
+    from search import get_smart_context, context_cache_stats, trending as trending_refresher
     SEARCH_ENABLED = True
 except:
     SEARCH_ENABLED = False
 
 try:
-    from core.battle_card import generate_battle_card
+    import core.battle_card                      # rendered by the worker pool in core/render.py
     BATTLE_CARD_ENABLED = True
 except:
     BATTLE_CARD_ENABLED = False
@@ -43,7 +59,7 @@ except:
     PUSH_ENABLED = False
 
 try:
-    from core.storage import upload_roast_card, upload_battle_card
+    from core.storage import upload_roast_card, upload_battle_card, storage
     STORAGE_ENABLED = True
 except:
     STORAGE_ENABLED = False
@@ -60,6 +76,7 @@ groq_client   = Groq(api_key=os.getenv("GROQ_API_KEY"))
 DATABASE_URL  = os.environ.get("DATABASE_URL", "")
 MEMES_FOLDER  = "memes"
 AI_MODELS     = ["llama-3.3-70b-versatile", "qwen/qwen-2.5-72b-instruct", "meta-llama/llama-3.1-70b-versatile"]
+model_router  = ModelRouter(AI_MODELS)    # AI_HEDGE (off), AI_HEDGE_RATE, AI_MODEL_TIMEOUT, AI_BREAKER_* — see core/llm.py
 ANALYTICS_KEY = os.getenv("ANALYTICS_KEY", "")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "RoasterFire@2025")
 
@@ -67,60 +84,33 @@ ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "RoasterFire@2025")
 # =====================================================================
 # DATABASE
 # =====================================================================
+db_pool = DBPool(DATABASE_URL)
+
+
 def get_db_connection():
-    try:    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    except: return None
+    """Borrow a pooled connection: `with get_db_connection() as conn:` (conn is None if DB is down)."""
+    return db_pool.connection()
 
 
 def init_database():
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        cur = conn.cursor()
-        cur.execute('''CREATE TABLE IF NOT EXISTS roasts (
-            id SERIAL PRIMARY KEY, topic VARCHAR(255), label VARCHAR(100),
-            roast TEXT, language VARCHAR(20), created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS stats (
-            id SERIAL PRIMARY KEY, total_roasts INTEGER DEFAULT 0)''')
-        cur.execute('SELECT COUNT(*) as c FROM stats')
-        if cur.fetchone()['c'] == 0:
-            cur.execute('INSERT INTO stats (total_roasts) VALUES (52341)')
-        cur.execute('''CREATE TABLE IF NOT EXISTS analytics (
-            id SERIAL PRIMARY KEY, topic VARCHAR(255), label VARCHAR(100),
-            roast_text TEXT, language VARCHAR(20), quality INTEGER, quality_name VARCHAR(20),
-            ip_address VARCHAR(45), country VARCHAR(100), country_code VARCHAR(10), city VARCHAR(100),
-            user_agent TEXT, device_type VARCHAR(20), response_ms INTEGER,
-            success BOOLEAN DEFAULT TRUE, error_msg TEXT, session_id VARCHAR(100),
-            hour_of_day INTEGER, day_of_week INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS battles (
-            id SERIAL PRIMARY KEY, battle_id VARCHAR(20) UNIQUE NOT NULL,
-            topic VARCHAR(255), mode VARCHAR(10) DEFAULT 'normal',
-            status VARCHAR(20) DEFAULT 'pending',
-            challenger_id VARCHAR(100), challenger_name VARCHAR(100),
-            opponent_id VARCHAR(100), opponent_name VARCHAR(100),
-            winner_id VARCHAR(100), loser_id VARCHAR(100),
-            total_rounds INTEGER DEFAULT 0, loss_reason VARCHAR(20),
-            card_url TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            accepted_at TIMESTAMP, ended_at TIMESTAMP, expires_at TIMESTAMP)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS battle_rounds (
-            id SERIAL PRIMARY KEY, battle_id VARCHAR(20) REFERENCES battles(battle_id),
-            round_num INTEGER, player_id VARCHAR(100), player_name VARCHAR(100),
-            roast_text TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS push_subscriptions (
-            id SERIAL PRIMARY KEY, session_id VARCHAR(100) UNIQUE,
-            endpoint TEXT, p256dh TEXT, auth TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS user_roast_count (
-            session_id VARCHAR(100) PRIMARY KEY,
-            roast_count INTEGER DEFAULT 0, gali_unlocked BOOLEAN DEFAULT FALSE,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        conn.commit()
-        logger.info("DB init OK")
-    except Exception as e:
-        logger.error(f"DB init error: {e}")
-    finally:
-        conn.close()
+    """
+    Apply pending transactional migrations (DB_MIGRATE_ON_BOOT, see core/migrations.py);
+    CONCURRENTLY index builds are the deploy step `python -m core.migrations up`.
+    """
+    with get_db_connection() as conn:
+        if not conn: return
+        try:
+            applied = []
+            if MIGRATE_ON_BOOT != "0":
+                applied = migrate(conn, transactional_only=MIGRATE_ON_BOOT != "all", wait=MIGRATE_BOOT_WAIT)
+            todo = pending(conn)
+            if todo:
+                logger.warning(f"DB schema is behind — {len(todo)} pending migration(s) "
+                               f"({', '.join(m.name for m in todo)}): run `python -m core.migrations up`")
+            else:
+                logger.info(f"DB init OK{' — applied ' + ', '.join(applied) if applied else ''}")
+        except Exception as e:
+            logger.error(f"DB init error: {e}")
 
 
 init_database()
@@ -129,29 +119,35 @@ init_database()
 # =====================================================================
 # DB HELPERS
 # =====================================================================
+counters = RoastCounters(get_db_connection)
+
+
+SESSION_ID_MAX = 100      # session_id columns are VARCHAR(100)
+
+
+def clean_sid(sid, default='unknown'):
+    """Client-supplied session id, clamped to what the session_id columns hold."""
+    return str(sid or default)[:SESSION_ID_MAX]
+
+
 def get_total_roasts():
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('SELECT total_roasts FROM stats WHERE id=1')
-            r = cur.fetchone()
-            return r['total_roasts'] if r else 52341
-        except: return 52341
-        finally: conn.close()
-    return 52341
+    return counters.total_roasts()
+
+
+geo_cache = TTLCache(maxsize=int(os.getenv("GEO_CACHE_SIZE", 10000)),
+                     ttl=int(os.getenv("GEO_CACHE_TTL", 86400)),
+                     neg_ttl=int(os.getenv("GEO_NEG_TTL", 300)))
+
+
+_fetch_geo = make_geo_lookup() if GEO_ENABLED else (lambda ip: None)   # GEO_BACKEND / GEO_DB_PATH
 
 
 def get_geo(ip):
     if not GEO_ENABLED or not ip or ip in ('127.0.0.1', 'localhost'):
         return {}, 'Unknown', '', 'Unknown'
-    try:
-        r = req_lib.get(f'http://ip-api.com/json/{ip}', timeout=2)
-        d = r.json()
-        if d.get('status') == 'success':
-            return d, d.get('country', 'Unknown'), d.get('countryCode', ''), d.get('city', 'Unknown')
-    except: pass
-    return {}, 'Unknown', '', 'Unknown'
+    try:    geo = geo_cache.get_or_load(ip, lambda: _fetch_geo(ip))
+    except: geo = None
+    return geo or ({}, 'Unknown', '', 'Unknown')
 
 
 def get_device_type(ua):
@@ -161,91 +157,54 @@ def get_device_type(ua):
     return 'desktop'
 
 
+analytics_writer = AnalyticsWriter(get_db_connection, get_geo)
+
+
 def save_roast_analytics(topic, label, roast_text, language, quality,
                           ip, sid, response_ms, success=True, error_msg=None):
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        cur = conn.cursor()
-        quality_names = {1:'SPARK', 2:'FLAME', 3:'INFERNO', 4:'HELLFIRE', 5:'APOCALYPSE'}
-        _, country, country_code, city = get_geo(ip)
-        ua  = request.headers.get('User-Agent', '')
-        now = datetime.now()
-        if success:
-            cur.execute('INSERT INTO roasts (topic,label,roast,language) VALUES (%s,%s,%s,%s)',
-                        (topic, label, roast_text, language))
-            cur.execute('UPDATE stats SET total_roasts = total_roasts + 1')
-        cur.execute('''INSERT INTO analytics
-            (topic,label,roast_text,language,quality,quality_name,
-             ip_address,country,country_code,city,user_agent,device_type,
-             response_ms,success,error_msg,session_id,hour_of_day,day_of_week)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)''',
-            (topic, label, roast_text, language, quality, quality_names.get(quality, '?'),
-             ip, country, country_code, city, ua, get_device_type(ua),
-             response_ms, success, error_msg, sid, now.hour, now.weekday()))
-        cur.execute('''INSERT INTO user_roast_count (session_id, roast_count) VALUES (%s,1)
-            ON CONFLICT (session_id) DO UPDATE
-            SET roast_count = user_roast_count.roast_count + 1, updated_at = NOW()''', (sid,))
-        cur.execute('''UPDATE user_roast_count SET gali_unlocked=TRUE
-            WHERE session_id=%s AND roast_count >= 10''', (sid,))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Analytics error: {e}")
-    finally:
-        conn.close()
+    """Queue the event for the background writer — geo lookup + DB writes happen off-request."""
+    ua = request.headers.get('User-Agent', '')
+    counters.roast(sid, success)
+    analytics_writer.submit({
+        "topic": topic, "label": label, "roast_text": roast_text, "language": language,
+        "quality": quality, "ip_address": ip, "user_agent": ua, "device_type": get_device_type(ua),
+        "response_ms": response_ms, "success": success, "error_msg": error_msg, "session_id": sid})
 
 
 def get_user_roast_count(sid):
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('SELECT roast_count,gali_unlocked FROM user_roast_count WHERE session_id=%s', (sid,))
-            r = cur.fetchone()
-            return (r['roast_count'], r['gali_unlocked']) if r else (0, False)
-        except: return (0, False)
-        finally: conn.close()
-    return (0, False)
+    return counters.user_roasts(sid)
+
+
+battles = BattleCache(get_db_connection)      # versioned write-through snapshots (BATTLE_CACHE_TTL)
 
 
 def get_battle(battle_id):
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM battles WHERE battle_id=%s', (battle_id,))
-            return cur.fetchone()
-        except: return None
-        finally: conn.close()
-    return None
+    return battles.get(battle_id)
 
 
 def get_battle_rounds(battle_id):
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('SELECT * FROM battle_rounds WHERE battle_id=%s ORDER BY round_num', (battle_id,))
-            return cur.fetchall()
-        except: return []
-        finally: conn.close()
-    return []
+    return battles.rounds(battle_id)
+
+
+def current_battle(battle_id, ok):
+    """The cached battle if ok(battle) holds, else the DB's current row — never reject on a stale snapshot."""
+    battle = get_battle(battle_id)
+    if battle and ok(battle): return battle
+    return battles.fresh(battle_id)
 
 
 def save_push_subscription(sid, endpoint, p256dh, auth):
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('''INSERT INTO push_subscriptions (session_id,endpoint,p256dh,auth)
-                VALUES (%s,%s,%s,%s) ON CONFLICT (session_id) DO UPDATE
-                SET endpoint=%s,p256dh=%s,auth=%s''',
-                (sid, endpoint, p256dh, auth, endpoint, p256dh, auth))
-            conn.commit()
-        except Exception as e:
-            logger.error(f"Push sub error: {e}")
-        finally:
-            conn.close()
+    with get_db_connection() as conn:
+        if conn:
+            try:
+                cur = conn.cursor()
+                cur.execute('''INSERT INTO push_subscriptions (session_id,endpoint,p256dh,auth)
+                    VALUES (%s,%s,%s,%s) ON CONFLICT (session_id) DO UPDATE
+                    SET endpoint=%s,p256dh=%s,auth=%s''',
+                    (sid, endpoint, p256dh, auth, endpoint, p256dh, auth))
+                conn.commit()
+            except Exception as e:
+                logger.error(f"Push sub error: {e}")
 
 
 def generate_battle_id():
@@ -253,18 +212,13 @@ def generate_battle_id():
 
 
 def _end_battle(battle_id, loser_id, reason):
-    battle = get_battle(battle_id)
+    battle = current_battle(battle_id, lambda b: b['status'] == 'active')
     if not battle: return jsonify({"error": "Not found"}), 404
     if battle['status'] != 'active': return jsonify({"error": "Battle not active"}), 400
-    winner_id = (battle['challenger_id'] if loser_id == battle['opponent_id'] else battle['opponent_id'])
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": "DB error"}), 500
     try:
-        cur = conn.cursor()
-        cur.execute('''UPDATE battles SET status='ended', winner_id=%s, loser_id=%s,
-            loss_reason=%s, ended_at=NOW() WHERE battle_id=%s''',
-            (winner_id, loser_id, reason, battle_id))
-        conn.commit()
+        battle = battles.end(battle_id, loser_id, reason)      # one UPDATE: re-checks status, picks the winner
+        if not battle: return jsonify({"error": "Battle not active"}), 400
+        winner_id   = battle['winner_id']
         winner_name = (battle['challenger_name'] if winner_id == battle['challenger_id'] else battle['opponent_name'])
         loser_name  = (battle['challenger_name'] if loser_id  == battle['challenger_id'] else battle['opponent_name'])
         if PUSH_ENABLED and GEMINI_ENABLED:
@@ -276,55 +230,17 @@ def _end_battle(battle_id, loser_id, reason):
                         "loss_reason": reason, "card_url": f"/battle/{battle_id}/card"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 
 # =====================================================================
 # IMAGE
 # =====================================================================
-def add_text_to_image(image_path, label, roast_text):
-    img  = Image.open(image_path).convert('RGB')
-    draw = ImageDraw.Draw(img)
-    W, H = img.size
-    try:
-        lf = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", max(16, W//20))
-        rf = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", max(14, W//26))
-    except:
-        lf = rf = ImageFont.load_default()
-    lh = int(H * 0.09)
-    draw.rectangle([0, 0, W, lh], fill="#8B0000")
-    lw = draw.textlength(label, font=lf)
-    lx = max(0, (W - lw) // 2)
-    for dx in range(-2, 3):
-        for dy in range(-2, 3):
-            draw.text((lx+dx, (lh-lf.size)//2+dy), label, font=lf, fill="#000000")
-    draw.text((lx, (lh-lf.size)//2), label, font=lf, fill="#FF4444")
-    words = roast_text.split()
-    lines, cur_line = [], ""
-    for w in words:
-        test = (cur_line + " " + w).strip()
-        if draw.textlength(test, font=rf) <= W - 24: cur_line = test
-        else:
-            if cur_line: lines.append(cur_line)
-            cur_line = w
-    if cur_line: lines.append(cur_line)
-    lh2   = rf.size + 4
-    total = lh2 * len(lines)
-    y     = H - total - 20
-    ov    = Image.new('RGBA', img.size, (0, 0, 0, 0))
-    od    = ImageDraw.Draw(ov)
-    od.rectangle([0, y-10, W, H], fill=(0, 0, 0, 160))
-    img   = Image.alpha_composite(img.convert('RGBA'), ov).convert('RGB')
-    draw  = ImageDraw.Draw(img)
-    for line in lines:
-        x = max(0, (W - draw.textlength(line, font=rf)) // 2)
-        for dx in range(-2, 3):
-            for dy in range(-2, 3):
-                draw.text((x+dx, y+dy), line, font=rf, fill="#000000")
-        draw.text((x, y), line, font=rf, fill="#FFFFFF")
-        y += lh2
-    return img
+templates   = TemplateRegistry(MEMES_FOLDER)   # decoded memes, MEME_CACHE_MB budget
+render_pool = RenderPool(templates)            # RENDER_WORKERS processes, each with its own decoded templates
+render_cache = RenderCache()                   # content-addressed cards: RENDER_CACHE_MB memory + shared RENDER_CACHE_DIR disk
+CARD_MAX_AGE = 365 * 24 * 3600                 # /roast/card/<key> never changes
+BATTLE_CARD_MAX_AGE = int(os.getenv("BATTLE_CARD_MAX_AGE", 86400))
+if not render_pool.enabled: templates.preload()
 
 
 # =====================================================================
@@ -383,11 +299,11 @@ LEVEL_CFG = {
 }
 
 
-def get_roast(topic, language='hindi', quality=3):
+def build_roast_prompt(topic, language='hindi', quality=3):
+    """(cfg, messages) for one roast — shared by the blocking and streaming paths."""
     import random as _r
     quality = max(1, min(5, int(quality)))
     cfg     = LEVEL_CFG[quality]
-    lbl     = cfg['label']
     wmin, wmax = cfg['wmin'], cfg['wmax']
 
     # ── Gather rich context via search ───────────────────────────────
@@ -434,31 +350,102 @@ def get_roast(topic, language='hindi', quality=3):
         f"INSTRUCTION: {lang_inst.get(language, lang_inst['hindi'])}\n"
         f"LABEL: creative title\nROAST: the roast"
     )
+    return cfg, [{"role": "system", "content": SYSTEM},
+                 {"role": "user",   "content": user_msg}]
 
-    for model in AI_MODELS:
-        try:
-            res  = groq_client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": SYSTEM},
-                    {"role": "user",   "content": user_msg}
-                ],
-                model=model, temperature=cfg['temp'], max_tokens=150)
-            text  = res.choices[0].message.content.strip()
-            label, roast = "", ""
-            for line in text.split('\n'):
-                l = line.strip()
-                if l.upper().startswith('LABEL:'):   label = l.split(':',1)[1].strip().strip('"*').upper()
-                elif l.upper().startswith('ROAST:'): roast = l.split(':',1)[1].strip().strip('"*')
-            if not roast:
-                lines = [l for l in text.split('\n') if l.strip()]
-                roast = lines[-1].strip().strip('"*') if lines else text[:120]
-            if not label:
-                label = f"{lbl} ROAST"
-            return label, roast
-        except: continue
+
+def parse_roast(text, lbl):
+    label, roast = "", ""
+    for line in text.split('\n'):
+        l = line.strip()
+        if l.upper().startswith('LABEL:'):   label = l.split(':',1)[1].strip().strip('"*').upper()
+        elif l.upper().startswith('ROAST:'): roast = l.split(':',1)[1].strip().strip('"*')
+    if not roast:
+        lines = [l for l in text.split('\n') if l.strip()]
+        roast = lines[-1].strip().strip('"*') if lines else text[:120]
+    if not label:
+        label = f"{lbl} ROAST"
+    return label, roast
+
+
+def fallback_roast(lbl):
     return (f"{lbl} ROAST", "AI ne bhi tujhe roast karna band kar diya — itna boring hai tu")
 
 
+def generate_roast(topic, language='hindi', quality=3):
+    """Live (label, roast) from the model router — raises if every model fails."""
+    cfg, messages = build_roast_prompt(topic, language, quality)
+
+    def call(model, timeout):
+        res  = groq_client.chat.completions.create(
+            messages=messages, model=model, temperature=cfg['temp'], max_tokens=150, timeout=timeout)
+        text = (res.choices[0].message.content or '').strip()
+        if not text: raise ValueError("empty completion")
+        return parse_roast(text, cfg['label'])
+
+    return model_router.run(call)
+
+
+def get_roast(topic, language='hindi', quality=3):
+    try:    return generate_roast(topic, language, quality)
+    except: return fallback_roast(LEVEL_CFG[max(1, min(5, int(quality)))]['label'])
+
+
+def get_roast_demand(limit, window):
+    """Busiest (topic, language, quality, requests) over the last `window` secs; None if the DB can't say."""
+    with get_db_connection() as conn:
+        if not conn: return None
+        try:
+            cur = conn.cursor()
+            cur.execute('''SELECT topic, language, quality, COUNT(*) AS cnt FROM analytics
+                WHERE success=TRUE AND topic!='' AND quality IS NOT NULL
+                  AND created_at > (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %s)   -- created_at is UTC
+                GROUP BY topic, language, quality ORDER BY cnt DESC LIMIT %s''', (window, limit))
+            return [(r['topic'], r['language'], r['quality'], r['cnt']) for r in cur.fetchall()]
+        except Exception as e:
+            logger.error(f"Roast demand error: {e}")
+            return None
+
+
+roast_pool = RoastPool(generate_roast, get_roast_demand, get_db_connection)
+
+
+def pooled_or_live_roast(topic, language, quality, session_id):
+    """Pre-generated roast when the pool has one this session hasn't seen, else live."""
+    pooled = roast_pool.pop(topic, language, quality, session_id)
+    if pooled: return pooled
+    label, roast_text = get_roast(topic, language, quality)
+    roast_pool.mark_seen(session_id, roast_text)
+    return label, roast_text
+
+
+def stream_roast(topic, language='hindi', quality=3):
+    """
+    Yields ('token', str) as the completion streams in, then ('roast', (label, roast)).
+    If a model dies mid-stream, ('reset', model) is yielded and the next model starts over.
+    """
+    cfg, messages = build_roast_prompt(topic, language, quality)
+    for model in model_router.order():
+        parts, t0 = [], time.time()
+        try:
+            for chunk in groq_client.chat.completions.create(
+                    messages=messages, model=model, temperature=cfg['temp'], max_tokens=150,
+                    stream=True, timeout=model_router.timeout):
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield 'token', delta
+            if not parts: raise ValueError("empty completion")
+            model_router.record(model, int((time.time() - t0) * 1000), True)
+            yield 'roast', parse_roast(''.join(parts).strip(), cfg['label'])
+            return
+        except Exception as e:
+            model_router.record(model, int((time.time() - t0) * 1000), False)
+            logger.error(f"Stream {model} failed: {e}")
+            if parts: yield 'reset', model
+    yield 'roast', fallback_roast(cfg['label'])
+
+
 
 # =====================================================================
 # ROUTES
@@ -478,7 +465,68 @@ def stats():
 @app.route('/api/health')
 def health():
     return jsonify({"status": "ok", "battle_card": BATTLE_CARD_ENABLED,
-                    "gemini": GEMINI_ENABLED, "push": PUSH_ENABLED})
+                    "gemini": GEMINI_ENABLED, "push": PUSH_ENABLED,
+                    "db_pool": db_pool.stats(), "analytics": analytics_writer.stats(),
+                    "counters": counters.stats(), "battles": battles.stats(),
+                    "geo_backend": getattr(_fetch_geo, 'backend', None), "geo_cache": geo_cache.stats(),
+                    "context_cache": context_cache_stats() if SEARCH_ENABLED else None,
+                    "trending": trending_refresher.stats() if SEARCH_ENABLED else None,
+                    "llm": model_router.metrics(), "roast_pool": roast_pool.stats(),
+                    "templates": templates.stats(), "render": render_pool.stats(),
+                    "render_cache": render_cache.stats(),
+                    "uploads": uploads.stats() if STORAGE_ENABLED else None,
+                    "storage": storage.name if STORAGE_ENABLED else None})
+
+
+def list_memes():
+    return templates.names()
+
+
+def client_ip():
+    return request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+
+
+def card_format(ratio='1:1'):
+    """(format, quality) for this client: ?fmt= or Accept, quality by ratio + device."""
+    fmt = negotiate(request.headers.get('Accept', ''), request.args.get('fmt'))
+    return fmt, quality_for(fmt, ratio, get_device_type(request.headers.get('User-Agent', '')))
+
+
+def render_roast_card(meme, label, roast_text, ratio='1:1', fmt='jpeg', quality=85):
+    """Crop + scale + render + encode one roast card → (key, bytes); identical inputs hit the cache."""
+    key = card_key('roast', templates.fingerprint(meme), label, roast_text, ratio, fmt, quality, OUTPUT_W)
+    return key, render_cache.get_or_render(
+        key, lambda: render_pool.roast_card(meme, label, roast_text, ratio, fmt, quality))
+
+
+def send_card(key, image_bytes, max_age=CARD_MAX_AGE):
+    """Card response with the content key as strong ETag; answers If-None-Match with 304."""
+    mimetype = MIME.get(sniff(image_bytes), 'application/octet-stream')
+    resp = send_file(BytesIO(image_bytes), mimetype=mimetype, etag=key, max_age=max_age)
+    if max_age >= CARD_MAX_AGE: resp.cache_control.immutable = True
+    return resp
+
+
+def _upload_roast(data, meta):
+    return upload_roast_card(BytesIO(data), meta.get('session_id', 'anon'))
+
+
+def _upload_battle(data, meta):
+    """Upload the battle card master, then point the battle at the CDN copy."""
+    card_url = upload_battle_card(data, meta['battle_id'])
+    battles.set_card_url(meta['battle_id'], card_url)
+    return card_url
+
+
+# Spooled, retried CDN uploads (UPLOAD_SPOOL_DIR, UPLOAD_WORKERS — see core/uploads.py)
+uploads = UploadQueue({'roast': _upload_roast, 'battle': _upload_battle})
+# adopt jobs a crashed worker left in the spool now, not on the next upload (not in render
+# workers, which re-import __main__ when the app is run as `python app.py`)
+if STORAGE_ENABLED and multiprocessing.parent_process() is None: uploads.start()
+
+
+def upload_roast_async(image_bytes, session_id):
+    if STORAGE_ENABLED: uploads.submit('roast', image_bytes, session_id=session_id)
 
 
 @app.route('/roast')
@@ -486,39 +534,26 @@ def roast():
     topic = request.args.get('topic', '').strip()
     lang  = request.args.get('lang', 'hindi')
     quality    = request.args.get('quality', 3)
-    session_id = request.args.get('session_id', 'unknown')
+    session_id = clean_sid(request.args.get('session_id'))
     ratio      = request.args.get('ratio', '1:1')
+    fmt, card_q = card_format(ratio)
     if not topic: return jsonify({"error": "No topic"}), 400
-    memes = [f for f in os.listdir(MEMES_FOLDER)
-             if f.endswith(('.jpg', '.jpeg', '.png'))] if os.path.exists(MEMES_FOLDER) else []
+    memes = list_memes()
     if not memes: return jsonify({"error": "No memes"}), 500
-    ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+    ip = client_ip()
     t0 = time.time()
     try:
-        label, roast_text = get_roast(topic, lang, quality)
-        img = add_text_to_image(os.path.join(MEMES_FOLDER, random.choice(memes)), label, roast_text)
-        W2, H2 = img.size
-        if ratio == '9:16':
-            th = int(W2 * 16 / 9)
-            if th > H2: nw = int(H2*9/16); img = img.crop(((W2-nw)//2, 0, (W2+nw)//2, H2))
-            else: img = img.crop((0, (H2-th)//2, W2, (H2+th)//2))
-        elif ratio == '16:9':
-            tw = int(H2 * 16 / 9)
-            if tw > W2: nh = int(W2*9/16); img = img.crop((0, (H2-nh)//2, W2, (H2+nh)//2))
-            else: img = img.crop(((W2-tw)//2, 0, (W2+tw)//2, H2))
-        buf = BytesIO()
-        img.save(buf, 'JPEG', quality=95)
-        buf.seek(0)
+        label, roast_text = pooled_or_live_roast(topic, lang, quality, session_id)
+        card_id, image_bytes = render_roast_card(random.choice(memes), label, roast_text, ratio, fmt, card_q)
         ms = int((time.time() - t0) * 1000)
         save_roast_analytics(topic, label, roast_text, lang, quality, ip, session_id, ms, True)
-        image_bytes = buf.getvalue()
-        if STORAGE_ENABLED:
-            import threading
-            def bg_upload():
-                try: upload_roast_card(BytesIO(image_bytes), session_id)
-                except Exception as ue: logger.error(f"BG upload failed: {ue}")
-            threading.Thread(target=bg_upload, daemon=True).start()
-        return send_file(BytesIO(image_bytes), mimetype='image/jpeg')
+        upload_roast_async(image_bytes, session_id)
+        resp = send_file(BytesIO(image_bytes), mimetype=MIME[fmt], etag=card_id)
+        resp.headers['Cache-Control'] = 'no-store'              # same query, new roast every time
+        resp.headers['Vary']          = 'Accept'
+        if render_cache.shared:                                 # any worker can serve it
+            resp.headers['X-Card-Url'] = f"/roast/card/{card_id}"  # stable, cacheable copy for shares
+        return resp
     except Exception as e:
         ms = int((time.time() - t0) * 1000)
         save_roast_analytics(topic, '', '', lang, quality, ip, session_id, ms, False, str(e))
@@ -526,9 +561,80 @@ def roast():
         return jsonify({"error": str(e)}), 500
 
 
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/roast/stream')
+def roast_stream():
+    """Server-Sent Events: token* → roast (LABEL/ROAST) → card (image URL; data: URI if the card cache isn't shared) → done."""
+    topic = request.args.get('topic', '').strip()
+    lang  = request.args.get('lang', 'hindi')
+    quality    = request.args.get('quality', 3)
+    session_id = clean_sid(request.args.get('session_id'))
+    ratio      = request.args.get('ratio', '1:1')
+    fmt, card_q = card_format(ratio)
+    if not topic: return jsonify({"error": "No topic"}), 400
+    memes = list_memes()
+    if not memes: return jsonify({"error": "No memes"}), 500
+    ip = client_ip()
+    t0 = time.time()
+
+    def events():
+        label, roast_text = '', ''
+        pooled = roast_pool.pop(topic, lang, quality, session_id)
+        try:
+            for kind, val in ([('roast', pooled)] if pooled else stream_roast(topic, lang, quality)):
+                if kind == 'token':   yield sse('token', {"t": val})
+                elif kind == 'reset': yield sse('reset', {"model": val})
+                else:
+                    label, roast_text = val
+                    if not pooled: roast_pool.mark_seen(session_id, roast_text)
+                    yield sse('roast', {"label": label, "roast": roast_text})
+            card_id, image_bytes = render_roast_card(random.choice(memes), label, roast_text, ratio, fmt, card_q)
+            if render_cache.shared: yield sse('card', {"url": f"/roast/card/{card_id}"})
+            else:                   yield sse('card', {"data": f"data:{MIME[fmt]};base64,"
+                                                               + base64.b64encode(image_bytes).decode()})
+            ms = int((time.time() - t0) * 1000)
+            save_roast_analytics(topic, label, roast_text, lang, quality, ip, session_id, ms, True)
+            upload_roast_async(image_bytes, session_id)
+        except Exception as e:
+            ms = int((time.time() - t0) * 1000)
+            save_roast_analytics(topic, label, roast_text, lang, quality, ip, session_id, ms, False, str(e))
+            logger.error(f"Roast stream error: {e}")
+            yield sse('error', {"error": str(e)})
+        yield sse('done', {})
+
+    resp = Response(stream_with_context(events()), mimetype='text/event-stream')
+    resp.headers['Cache-Control']     = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'     # don't let nginx buffer the stream
+    return resp
+
+
+@app.route('/roast/card/<card_id>')
+def roast_card(card_id):
+    if request.if_none_match.contains(card_id):           # content-addressed: same key, same bytes
+        return Response(status=304, headers={'ETag': f'"{card_id}"'})
+    image_bytes = render_cache.get(card_id)
+    if image_bytes is None: return jsonify({"error": "Card expired"}), 404
+    return send_card(card_id, image_bytes)
+
+
+@app.route('/media/<path:path>')
+def media(path):
+    """Files of the local storage backend — content-addressed, so cached forever."""
+    if not STORAGE_ENABLED or storage.name != 'local': return jsonify({"error": "Not found"}), 404
+    ext  = path.rsplit('.', 1)[-1]
+    mime = next((MIME[f] for f, e in EXT.items() if e == ext), None)
+    resp = send_from_directory(storage.root, path, mimetype=mime, max_age=CARD_MAX_AGE,
+                               etag=os.path.basename(path).split('.')[0])    # sendfile + Range + 304
+    resp.cache_control.immutable = True
+    return resp
+
+
 @app.route('/api/gali-status')
 def gali_status():
-    sid = request.args.get('session_id', '')
+    sid = clean_sid(request.args.get('session_id'), '')
     count, unlocked = get_user_roast_count(sid)
     return jsonify({"roast_count": count, "gali_unlocked": unlocked, "roasts_to_gali": max(0, 10-count)})
 
@@ -539,29 +645,20 @@ def battle_create():
     data            = request.json or {}
     topic           = data.get('topic', '').strip()
     mode            = data.get('mode', 'normal')
-    challenger_id   = data.get('session_id', 'unknown')
+    challenger_id   = clean_sid(data.get('session_id'))
     challenger_name = data.get('name', 'Anonymous')
     if not topic: return jsonify({"error": "Topic required"}), 400
     if mode == 'gali':
         _, unlocked = get_user_roast_count(challenger_id)
         if not unlocked: return jsonify({"error": "Gali mode locked. Need 10 roasts first."}), 403
     battle_id = generate_battle_id()
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": "DB error"}), 500
     try:
-        cur = conn.cursor()
-        cur.execute('''INSERT INTO battles
-            (battle_id,topic,mode,status,challenger_id,challenger_name,expires_at)
-            VALUES (%s,%s,%s,'pending',%s,%s, NOW() + INTERVAL '24 hours')''',
-            (battle_id, topic, mode, challenger_id, challenger_name))
-        conn.commit()
+        battles.create(battle_id, topic, mode, challenger_id, challenger_name)
         return jsonify({"battle_id": battle_id,
                         "battle_url": f"{request.host_url}battle/{battle_id}",
                         "topic": topic, "mode": mode})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 
 @app.route('/battle/<battle_id>')
@@ -575,19 +672,14 @@ def battle_view(battle_id):
 @app.route('/battle/<battle_id>/accept', methods=['POST'])
 def battle_accept(battle_id):
     data          = request.json or {}
-    opponent_id   = data.get('session_id', 'unknown')
+    opponent_id   = clean_sid(data.get('session_id'))
     opponent_name = data.get('name', 'Anonymous')
-    battle = get_battle(battle_id)
+    battle = current_battle(battle_id, lambda b: b['status'] == 'pending')
     if not battle: return jsonify({"error": "Not found"}), 404
     if battle['status'] != 'pending': return jsonify({"error": "Already started"}), 400
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": "DB error"}), 500
     try:
-        cur = conn.cursor()
-        cur.execute('''UPDATE battles SET status='active', opponent_id=%s, opponent_name=%s,
-            accepted_at=NOW(), expires_at=NOW()+INTERVAL '24 hours' WHERE battle_id=%s''',
-            (opponent_id, opponent_name, battle_id))
-        conn.commit()
+        battle = battles.accept(battle_id, opponent_id, opponent_name)   # only wins if still pending
+        if not battle: return jsonify({"error": "Already started"}), 400
         if PUSH_ENABLED and GEMINI_ENABLED:
             try:
                 send_push(battle['challenger_id'],
@@ -596,35 +688,27 @@ def battle_accept(battle_id):
         return jsonify({"status": "active", "battle_id": battle_id})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 
 @app.route('/battle/<battle_id>/roast', methods=['POST'])
 def battle_roast(battle_id):
     data      = request.json or {}
-    player_id = data.get('session_id', 'unknown')
+    player_id = clean_sid(data.get('session_id'))
     language  = data.get('lang', 'hindi')
     quality   = data.get('quality', 3)
-    battle    = get_battle(battle_id)
+    battle    = current_battle(battle_id, lambda b: b['status'] == 'active'
+                                                 and player_id in (b['challenger_id'], b['opponent_id']))
     if not battle: return jsonify({"error": "Not found"}), 404
     if battle['status'] != 'active': return jsonify({"error": "Battle not active"}), 400
     if player_id not in (battle['challenger_id'], battle['opponent_id']):
         return jsonify({"error": "You are not in this battle"}), 403
     try:
-        label, roast_text = get_roast(battle['topic'], language, quality)
-        player_name = (battle['challenger_name'] if player_id == battle['challenger_id']
-                       else battle['opponent_name'])
-        conn = get_db_connection()
-        if not conn: return jsonify({"error": "DB error"}), 500
-        cur = conn.cursor()
-        cur.execute('SELECT COUNT(*) as c FROM battle_rounds WHERE battle_id=%s', (battle_id,))
-        round_num = cur.fetchone()['c'] + 1
-        cur.execute('''INSERT INTO battle_rounds (battle_id,round_num,player_id,player_name,roast_text)
-            VALUES (%s,%s,%s,%s,%s)''', (battle_id, round_num, player_id, player_name, roast_text))
-        cur.execute('UPDATE battles SET total_rounds=%s WHERE battle_id=%s', (round_num, battle_id))
-        conn.commit()
-        conn.close()
+        label, roast_text = pooled_or_live_roast(battle['topic'], language, quality, player_id)
+        with get_db_connection() as conn:
+            if not conn: return jsonify({"error": "DB error"}), 500
+            added = battles.add_round(conn, battle_id, player_id, roast_text)
+        if not added: return jsonify({"error": "Battle not active"}), 409    # ended while the roast was generated
+        round_num, player_name = added
         return jsonify({"round": round_num, "roast": roast_text, "label": label, "player": player_name})
     except Exception as e:
         logger.error(f"Battle roast error: {e}")
@@ -634,7 +718,7 @@ def battle_roast(battle_id):
 @app.route('/battle/<battle_id>/surrender', methods=['POST'])
 def battle_surrender(battle_id):
     data = request.json or {}
-    return _end_battle(battle_id, data.get('session_id', 'unknown'), 'surrendered')
+    return _end_battle(battle_id, clean_sid(data.get('session_id')), 'surrendered')
 
 
 @app.route('/battle/<battle_id>/status')
@@ -649,7 +733,7 @@ def battle_status(battle_id):
 
 @app.route('/battle/<battle_id>/card')
 def battle_card_route(battle_id):
-    battle = get_battle(battle_id)
+    battle = current_battle(battle_id, lambda b: b['card_url'])   # another worker may have uploaded it already
     if not battle: return jsonify({"error": "Not found"}), 404
     if battle['status'] != 'ended': return jsonify({"error": "Battle not ended yet"}), 400
     if battle['card_url']: return redirect(battle['card_url'])
@@ -663,28 +747,28 @@ def battle_card_route(battle_id):
     dh, dm   = divmod(int(duration.total_seconds() // 60), 60)
     wname = (battle['challenger_name'] if battle['winner_id'] == battle['challenger_id'] else battle['opponent_name'])
     lname = (battle['challenger_name'] if battle['loser_id']  == battle['challenger_id'] else battle['opponent_name'])
-    card_path = generate_battle_card({
+    card_data = {
         "battle_id": battle_id, "winner_name": wname, "loser_name": lname,
         "winner_roasts": w_roasts, "loser_roasts": l_roasts,
         "duration_hrs": dh, "duration_mins": dm,
         "loss_reason": battle['loss_reason'] or 'timeout',
         "total_rounds": battle['total_rounds'],
         "topic": battle['topic'], "mode": battle['mode']
-    })
-    card_url = None
-    if STORAGE_ENABLED:
-        try:
-            card_url = upload_battle_card(card_path, battle_id)
-            conn = get_db_connection()
-            if conn:
-                cur = conn.cursor()
-                cur.execute('UPDATE battles SET card_url=%s WHERE battle_id=%s', (card_url, battle_id))
-                conn.commit()
-                conn.close()
-        except Exception as e:
-            logger.error(f"Card upload: {e}")
-    if card_url: return redirect(card_url)
-    return send_file(card_path, mimetype='image/jpeg')
+    }
+    fmt, q = card_format()
+    key = card_key('battle', card_data, fmt, q)
+    if STORAGE_ENABLED and not uploads.pending('battle', battle_id):
+        # the CDN copy is the master it re-encodes per client — keep it high-quality JPEG;
+        # once uploaded, battles.card_url is set and later requests redirect to it
+        master_key = card_key('battle', card_data, 'jpeg', 96)
+        master = render_cache.get_or_render(master_key, lambda: render_pool.battle_card(card_data, 'jpeg', 96))
+        uploads.submit('battle', master, key=battle_id, battle_id=battle_id)
+    if request.if_none_match.contains(key):
+        return Response(status=304, headers={'ETag': f'"{key}"', 'Vary': 'Accept, User-Agent'})
+    card_bytes = render_cache.get_or_render(key, lambda: render_pool.battle_card(card_data, fmt, q))
+    resp = send_card(key, card_bytes, BATTLE_CARD_MAX_AGE)
+    resp.headers['Vary'] = 'Accept, User-Agent'          # format + quality are negotiated per client
+    return resp
 
 
 # ── Push subscription ─────────────────────────────────────────────────
@@ -705,28 +789,23 @@ def vapid_key():
 def analytics():
     key = request.headers.get('X-Analytics-Key', '')
     if ANALYTICS_KEY and key != ANALYTICS_KEY: return jsonify({"error": "Unauthorized"}), 401
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": "DB error"}), 500
-    try:
-        cur = conn.cursor()
-        result = {}
-        cur.execute('SELECT COUNT(*) as total, COUNT(CASE WHEN success THEN 1 END) as ok FROM analytics')
-        result['overview'] = dict(cur.fetchone())
-        cur.execute('SELECT language,COUNT(*) as cnt FROM analytics WHERE success=TRUE GROUP BY language ORDER BY cnt DESC')
-        result['by_language'] = [dict(r) for r in cur.fetchall()]
-        cur.execute('SELECT quality_name,COUNT(*) as cnt FROM analytics WHERE success=TRUE GROUP BY quality_name ORDER BY cnt DESC')
-        result['by_quality'] = [dict(r) for r in cur.fetchall()]
-        cur.execute('SELECT topic,COUNT(*) as cnt FROM analytics WHERE success=TRUE GROUP BY topic ORDER BY cnt DESC LIMIT 10')
-        result['top_topics'] = [dict(r) for r in cur.fetchall()]
-        cur.execute('SELECT country,COUNT(*) as cnt FROM analytics WHERE success=TRUE GROUP BY country ORDER BY cnt DESC LIMIT 10')
-        result['top_countries'] = [dict(r) for r in cur.fetchall()]
-        cur.execute("SELECT COUNT(*) as battles,COUNT(CASE WHEN status='ended' THEN 1 END) as completed FROM battles")
-        result['battles'] = dict(cur.fetchone())
-        return jsonify(result)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        if not conn: return jsonify({"error": "DB error"}), 500
+        try:
+            cur = conn.cursor()
+            result = {}
+            t   = rollups.totals(cur)
+            result['overview']      = {"total": t['events'], "ok": t['ok']}
+            result['as_of']         = t['as_of'].isoformat() if t['as_of'] else None
+            result['by_language']   = rollups.top(cur, 'language')
+            result['by_quality']    = rollups.top(cur, 'quality')
+            result['top_topics']    = rollups.top(cur, 'topic', 10)
+            result['top_countries'] = rollups.top(cur, 'country', 10)
+            cur.execute("SELECT COUNT(*) as battles,COUNT(CASE WHEN status='ended' THEN 1 END) as completed FROM battles")
+            result['battles'] = dict(cur.fetchone())
+            return jsonify(result)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
 
 
 # =====================================================================
@@ -784,7 +863,7 @@ ADMIN_HTML = """<!DOCTYPE html>
 {% else %}
 <div class="topbar">
   <h1>🔥 Roaster AI — Admin</h1>
-  <a href="/admin?logout=1" class="logout">Logout</a>
+  <span>{% if s.as_of %}<span style="color:#555;font-size:0.8rem;margin-right:16px;">stats as of {{ s.as_of.strftime('%d %b %H:%M:%S') }}</span>{% endif %}<a href="/admin?logout=1" class="logout">Logout</a></span>
 </div>
 <div class="grid">
   <div class="stat-card"><div class="num">{{ s.total_roasts }}</div><div class="lbl">Total Roasts</div></div>
@@ -887,44 +966,44 @@ def admin():
                                   s=_get_admin_stats(), enumerate=enumerate)
 
 
+@app.route('/admin/reload-memes', methods=['POST'])
+def admin_reload_memes():
+    if not session.get('admin_ok'): return jsonify({"error": "Unauthorized"}), 401
+    # every gunicorn worker and render worker re-decodes within MEME_RESCAN_SECS (folder mtime check)
+    templates.mark_changed()
+    if not render_pool.enabled: templates.preload()   # this process right away
+    return jsonify(dict(templates.stats(), broadcast=True, within_secs=MEME_RESCAN_SECS))
+
+
 def _get_admin_stats():
-    conn = get_db_connection()
-    if not conn: return {}
-    try:
-        cur = conn.cursor()
-        s   = {}
-        cur.execute("SELECT COUNT(*) as c FROM analytics WHERE success=TRUE")
-        s['total_roasts'] = cur.fetchone()['c']
-        cur.execute("SELECT COUNT(*) as c FROM analytics WHERE success=TRUE AND created_at::date=CURRENT_DATE")
-        s['today_roasts'] = cur.fetchone()['c']
-        cur.execute("SELECT COUNT(DISTINCT session_id) as c FROM analytics")
-        s['unique_users'] = cur.fetchone()['c']
-        cur.execute("SELECT AVG(response_ms)::int as a FROM analytics WHERE success=TRUE")
-        s['avg_response'] = cur.fetchone()['a'] or 0
-        cur.execute("SELECT COUNT(*) as c FROM battles")
-        s['total_battles'] = cur.fetchone()['c']
-        cur.execute("SELECT COUNT(*) as c FROM battles WHERE status='ended'")
-        s['battles_completed'] = cur.fetchone()['c']
-        cur.execute("SELECT topic,COUNT(*) as cnt FROM analytics WHERE success=TRUE AND topic!='' GROUP BY topic ORDER BY cnt DESC LIMIT 10")
-        s['top_topics'] = cur.fetchall()
-        cur.execute("SELECT country,COUNT(*) as cnt FROM analytics WHERE success=TRUE GROUP BY country ORDER BY cnt DESC LIMIT 8")
-        s['top_countries'] = cur.fetchall()
-        cur.execute("SELECT language,COUNT(*) as cnt FROM analytics WHERE success=TRUE GROUP BY language ORDER BY cnt DESC")
-        s['by_language'] = cur.fetchall()
-        cur.execute("SELECT quality_name,COUNT(*) as cnt FROM analytics WHERE success=TRUE GROUP BY quality_name ORDER BY cnt DESC")
-        s['by_quality'] = cur.fetchall()
-        cur.execute("SELECT device_type,COUNT(*) as cnt FROM analytics GROUP BY device_type ORDER BY cnt DESC")
-        s['by_device'] = cur.fetchall()
-        cur.execute("SELECT battle_id,topic,status,total_rounds FROM battles ORDER BY created_at DESC LIMIT 10")
-        s['recent_battles'] = cur.fetchall()
-        cur.execute("SELECT topic,language,quality_name,country,device_type,created_at FROM analytics WHERE success=TRUE ORDER BY created_at DESC LIMIT 15")
-        s['recent_roasts'] = cur.fetchall()
-        return s
-    except Exception as e:
-        logger.error(f"Admin stats error: {e}")
-        return {}
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        if not conn: return {}
+        try:
+            cur = conn.cursor()
+            s   = {}
+            t   = rollups.totals(cur)
+            s['total_roasts'] = t['ok']
+            s['today_roasts'] = rollups.today(cur, datetime.now(timezone.utc).date())['ok']
+            s['unique_users'] = rollups.unique_sessions(cur)
+            s['avg_response'] = t['avg_ms']
+            s['as_of']        = t['as_of']
+            cur.execute("SELECT COUNT(*) as c FROM battles")
+            s['total_battles'] = cur.fetchone()['c']
+            cur.execute("SELECT COUNT(*) as c FROM battles WHERE status='ended'")
+            s['battles_completed'] = cur.fetchone()['c']
+            s['top_topics']    = rollups.top(cur, 'topic', 10, skip_empty=True)
+            s['top_countries'] = rollups.top(cur, 'country', 8)
+            s['by_language']   = rollups.top(cur, 'language')
+            s['by_quality']    = rollups.top(cur, 'quality')
+            s['by_device']     = rollups.top(cur, 'device', metric='events')
+            cur.execute("SELECT battle_id,topic,status,total_rounds FROM battles ORDER BY created_at DESC LIMIT 10")
+            s['recent_battles'] = cur.fetchall()
+            cur.execute("SELECT topic,language,quality_name,country,device_type,created_at FROM analytics WHERE success=TRUE ORDER BY created_at DESC LIMIT 15")
+            s['recent_roasts'] = cur.fetchall()
+            return s
+        except Exception as e:
+            logger.error(f"Admin stats error: {e}")
+            return {}
 
 
 # =====================================================================
@@ -0,0 +1,61 @@
+"""
+benchmarks/bench_battle_card.py
+===============================
+Micro-benchmarks for core/battle_card.py pieces.
+Run from the repo root:  python -m benchmarks.bench_battle_card [iterations]
+  bar    — one progress bar: per-column line loop (old) vs cached ramp paste
+  glow   — one glowing value label
+  base   — copying the precomposed base canvas
+  card   — compose_battle_card end to end (no encode), and with JPEG encode
+"""
+
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+from benchmarks.bench_render import timeit, BATTLE
+from core import battle_card as bc
+
+BAR_W = bc.LBW
+
+
+def _bar_lines(d, x, y, w, h, pct, col):
+    """The previous _bar: one d.line per column of the fill."""
+    d.rectangle([x, y, x+w, y+h], fill=(10, 8, 20), outline=(50, 48, 65), width=1)
+    fw = max(4, int(w * min(pct, 100) / 100))
+    r, g, b = col
+    for i in range(fw):
+        br = 0.45 + 0.55 * (i / max(fw, 1))
+        d.line([(x+i, y+1),(x+i, y+h-1)], fill=(int(r*br), int(g*br), int(b*br)))
+    if fw > 3:
+        d.line([(x+fw-1, y),(x+fw-1, y+h)], fill=col, width=2)
+
+
+def bench_bars(n):
+    img  = Image.new("RGBA", (BAR_W + 20, bc.BAR_H + 10))
+    d    = ImageDraw.Draw(img, 'RGBA')
+    col  = (55, 135, 255)
+    old  = timeit(lambda: _bar_lines(d, 2, 2, BAR_W, bc.BAR_H, 99, col), n)
+    new  = timeit(lambda: bc._bar(img, d, 2, 2, BAR_W, bc.BAR_H, 99, col), n)
+    bc._ramp.cache_clear()
+    cold = timeit(lambda: (bc._ramp.cache_clear(), bc._bar(img, d, 2, 2, BAR_W, bc.BAR_H, 99, col)), n)
+    return old, new, cold
+
+
+def bench_glow(n):
+    img = bc._base().copy()
+    d   = ImageDraw.Draw(img, 'RGBA')
+    return timeit(lambda: bc._glow(img, d, "7/9", bc._f(28), bc.LXR, bc.ROW1, bc.W_WHITE, bc.W_BLUE,
+                                   p=2, sp=5, a='rt'), n)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    old, new, cold = bench_bars(n)
+    print(f"bar (lines) : {old * 1000:8.1f} µs/bar")
+    print(f"bar (ramp)  : {new * 1000:8.1f} µs/bar  ({cold * 1000:.1f} µs uncached)")
+    print(f"glow        : {bench_glow(n) * 1000:8.1f} µs/label")
+    print(f"base copy   : {timeit(lambda: bc._base().copy(), n) * 1000:8.1f} µs")
+    m = max(1, n // 10)
+    print(f"card        : {timeit(lambda: bc.compose_battle_card(BATTLE), m):8.2f} ms/card")
+    print(f"card + jpeg : {timeit(lambda: bc.render_battle_card(BATTLE), m):8.2f} ms/card")
@@ -0,0 +1,71 @@
+"""
+benchmarks/bench_render.py
+==========================
+Per-card render time for roast cards and battle cards.
+Run from the repo root:  python -m benchmarks.bench_render [iterations]
+The last line is throughput of the render pool (core/render.py) under
+concurrent requests, with RENDER_WORKERS processes vs inline rendering.
+"""
+
+import os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.templates import TemplateRegistry
+from core.roast_card import add_text_to_image
+from core.battle_card import generate_battle_card
+from core.render import RenderPool, RENDER_WORKERS
+
+ROOT   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LABEL  = "CERTIFIED DELULU"
+ROAST  = ("Tera LinkedIn profile dekh ke lagta hai startup ka CEO hai, "
+          "par UPI balance dekh ke lagta hai intern bhi nahi")
+BATTLE = {
+    "battle_id": "RB-00421", "winner_name": "Arjun", "loser_name": "Rahul",
+    "winner_roasts": 7, "loser_roasts": 2, "duration_hrs": 18, "duration_mins": 42,
+    "loss_reason": "timeout", "total_rounds": 9, "topic": "My Ex",
+}
+
+
+def timeit(fn, n):
+    fn()                                   # warm caches
+    t0 = time.perf_counter()
+    for _ in range(n): fn()
+    return (time.perf_counter() - t0) / n * 1000
+
+
+def bench_roast_card(n):
+    reg   = TemplateRegistry(os.path.join(ROOT, "memes"))
+    names = reg.names()
+    reg.preload()
+    it = iter(range(10**9))
+    return timeit(lambda: add_text_to_image(reg.get(names[next(it) % len(names)]), LABEL, ROAST), n)
+
+
+def bench_battle_card(n):
+    def one():
+        os.remove(generate_battle_card(BATTLE))
+    return timeit(one, n)
+
+
+
+def bench_render_pool(n, workers, threads=8):
+    """Cards/sec for n roast cards requested from `threads` request threads."""
+    reg   = TemplateRegistry(os.path.join(ROOT, "memes"))
+    names = reg.names()
+    pool  = RenderPool(reg, workers=workers)
+    if not workers: reg.preload()
+    pool.roast_card(names[0], LABEL, ROAST)             # start + warm the workers
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(threads) as ex:
+        list(ex.map(lambda i: pool.roast_card(names[i % len(names)], LABEL, ROAST), range(n)))
+    pool.restart()
+    return n / (time.perf_counter() - t0)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f"roast card  : {bench_roast_card(n):7.1f} ms/card  (add_text_to_image, {n} runs)")
+    print(f"battle card : {bench_battle_card(n):7.1f} ms/card  (generate_battle_card, {n} runs)")
+    print(f"render pool : {bench_render_pool(n * 5, RENDER_WORKERS):7.1f} cards/s  "
+          f"({RENDER_WORKERS} workers; inline {bench_render_pool(n * 5, 0):.1f} cards/s)")
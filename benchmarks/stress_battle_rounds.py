@@ -0,0 +1,113 @@
+"""
+benchmarks/stress_battle_rounds.py
+==================================
+Concurrency stress test for core/battles.add_round against a real database.
+Run from the repo root:  DATABASE_URL=... python -m benchmarks.stress_battle_rounds [threads] [moves]
+Creates a throwaway active battle, has `threads` connections each add `moves`
+rounds as fast as they can, then checks round_num is exactly 1..N with no
+duplicates or gaps and battles.total_rounds == N. Also times the old
+COUNT + INSERT + UPDATE sequence for comparison (it is expected to produce
+duplicates). Exits 1 if the atomic path fails; the test battle is deleted.
+"""
+
+import os, sys, time, secrets, threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from core.battles import add_round
+
+DSN = os.environ.get("DATABASE_URL")
+
+
+def _connect():
+    return psycopg2.connect(DSN, cursor_factory=RealDictCursor)
+
+
+def _old_round(conn, battle_id, player_id, text):
+    """The previous battle_roast sequence: three statements, number from COUNT(*)."""
+    cur = conn.cursor()
+    cur.execute('SELECT COUNT(*) as c FROM battle_rounds WHERE battle_id=%s', (battle_id,))
+    round_num = cur.fetchone()['c'] + 1
+    cur.execute('''INSERT INTO battle_rounds (battle_id,round_num,player_id,player_name,roast_text)
+        VALUES (%s,%s,%s,%s,%s)''', (battle_id, round_num, player_id, 'P', text))
+    cur.execute('UPDATE battles SET total_rounds=%s WHERE battle_id=%s', (round_num, battle_id))
+    conn.commit()
+    return round_num
+
+
+def _new_battle(cur):
+    battle_id = "ST-" + secrets.token_hex(4).upper()
+    cur.execute('''INSERT INTO battles (battle_id, topic, status, challenger_id, challenger_name,
+                   opponent_id, opponent_name) VALUES (%s,'stress','active','a','A','b','B')''', (battle_id,))
+    return battle_id
+
+
+def run(fn, threads, moves):
+    """→ (battle_id, secs, errors) after `threads` x `moves` calls of fn(conn, battle_id, player, text)."""
+    setup = _connect()
+    battle_id = _new_battle(setup.cursor())
+    setup.commit()
+    errors, start = [], threading.Barrier(threads)
+
+    def player(i):
+        conn = _connect()
+        start.wait()
+        for m in range(moves):
+            try:
+                fn(conn, battle_id, "ab"[i % 2], f"roast {i}.{m}")
+            except Exception as e:
+                conn.rollback()
+                errors.append(e)
+        conn.close()
+
+    ts = [threading.Thread(target=player, args=(i,)) for i in range(threads)]
+    t0 = time.perf_counter()
+    for t in ts: t.start()
+    for t in ts: t.join()
+    secs = time.perf_counter() - t0
+    setup.close()
+    return battle_id, secs, errors
+
+
+def check(battle_id):
+    conn = _connect()
+    cur  = conn.cursor()
+    cur.execute('SELECT round_num FROM battle_rounds WHERE battle_id=%s ORDER BY round_num', (battle_id,))
+    nums = [r['round_num'] for r in cur.fetchall()]
+    cur.execute('SELECT total_rounds FROM battles WHERE battle_id=%s', (battle_id,))
+    total = cur.fetchone()['total_rounds']
+    conn.close()
+    return nums, total
+
+
+def cleanup(battle_id):
+    conn = _connect()
+    cur  = conn.cursor()
+    cur.execute('DELETE FROM battle_rounds WHERE battle_id=%s', (battle_id,))
+    cur.execute('DELETE FROM battles WHERE battle_id=%s', (battle_id,))
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    if not DSN: sys.exit("set DATABASE_URL")
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    moves   = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    n       = threads * moves
+
+    bid, secs, errors = run(add_round, threads, moves)
+    nums, total = check(bid)
+    cleanup(bid)
+    ok = not errors and nums == list(range(1, n + 1)) and total == n
+    print(f"atomic  : {n / secs:7.0f} rounds/s  {secs / moves * 1000:6.2f} ms/move  "
+          f"rounds={len(nums)} distinct={len(set(nums))} total_rounds={total} errors={len(errors)}  "
+          f"{'OK' if ok else 'FAIL'}")
+
+    bid, secs, errors = run(_old_round, threads, moves)
+    nums, total = check(bid)
+    cleanup(bid)
+    print(f"old 3-q : {n / secs:7.0f} rounds/s  {secs / moves * 1000:6.2f} ms/move  "
+          f"rounds={len(nums)} distinct={len(set(nums))} total_rounds={total} errors={len(errors)}"
+          f"  (errors = unique-index rejections of duplicate numbers)")
+    sys.exit(0 if ok else 1)
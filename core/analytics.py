@@ -0,0 +1,209 @@
+"""
+core/analytics.py
+=================
+Background analytics pipeline.
+/roast drops an event on a bounded queue; a writer thread does the geo lookup
+and flushes batches with multi-row INSERTs, folding the same batch into the
+dashboard rollups (core/rollups.py). A batch whose flush fails (DB blip, pool
+exhausted) goes back to the front and is retried with backoff, up to
+ANALYTICS_RETRIES times, before it's dropped and counted as failed. A batch the
+DB rejects outright (DataError / IntegrityError) is written row by row instead,
+dropping only the bad rows. Request-supplied strings are clamped to their column
+widths on submit(). created_at / hour_of_day / day_of_week are UTC, so rollup
+days are UTC days.
+Roast counters live in core/counters.py.
+"""
+
+import os, time, queue, atexit, logging, threading
+from datetime import datetime, timezone
+import psycopg2
+from psycopg2.extras import execute_values
+from core.rollups import apply_rollups
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_QUEUE_MAX  = int(os.getenv("ANALYTICS_QUEUE_MAX", 5000))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", 200))
+ANALYTICS_FLUSH_SECS = float(os.getenv("ANALYTICS_FLUSH_SECS", 2))
+ANALYTICS_OVERFLOW   = os.getenv("ANALYTICS_OVERFLOW", "drop_oldest")   # drop_oldest | drop_newest | block
+ANALYTICS_BLOCK_SECS = float(os.getenv("ANALYTICS_BLOCK_SECS", 0.05))   # max wait for 'block' policy
+ANALYTICS_RETRIES    = int(os.getenv("ANALYTICS_RETRIES", 5))            # retries of a failed batch
+ANALYTICS_RETRY_SECS = float(os.getenv("ANALYTICS_RETRY_SECS", 1))      # backoff; doubles per retry, max 30s
+DETERMINISTIC        = (psycopg2.DataError, psycopg2.IntegrityError)    # retrying the same rows won't help
+
+QUALITY_NAMES = {1:'SPARK', 2:'FLAME', 3:'INFERNO', 4:'HELLFIRE', 5:'APOCALYPSE'}
+
+ANALYTICS_COLS = ('topic,label,roast_text,language,quality,quality_name,'
+                  'ip_address,country,country_code,city,user_agent,device_type,'
+                  'response_ms,success,error_msg,session_id,hour_of_day,day_of_week,created_at')
+COL_NAMES = ANALYTICS_COLS.split(',')
+
+# request-supplied columns → their VARCHAR width; clamped when the event is queued
+FIELD_LIMITS = {"topic": 255, "label": 100, "language": 20, "ip_address": 45,
+                "device_type": 20, "session_id": 100}
+
+
+def _clip(value, n):
+    return value[:n] if isinstance(value, str) else value
+
+
+class AnalyticsWriter:
+    """
+    submit() never touches the network or DB — it only enqueues.
+    `get_conn` is a context-manager factory (DBPool.connection), `geo(ip)` returns
+    (raw, country, country_code, city).
+    """
+
+    def __init__(self, get_conn, geo, maxsize=ANALYTICS_QUEUE_MAX, batch_size=ANALYTICS_BATCH_SIZE,
+                 flush_secs=ANALYTICS_FLUSH_SECS, overflow=ANALYTICS_OVERFLOW):
+        self.get_conn   = get_conn
+        self.geo        = geo
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.overflow   = overflow
+        self.q          = queue.Queue(maxsize=maxsize)
+        self._stop      = threading.Event()
+        self._lock      = threading.Lock()
+        self._thread    = None
+        self._pid       = None
+        self.m = {"submitted": 0, "written": 0, "dropped": 0, "failed": 0, "retries": 0, "batches": 0,
+                  "max_depth": 0, "last_flush_ms": 0, "avg_flush_ms": 0.0}
+        atexit.register(self.stop)
+
+    # ── producer side ────────────────────────────────────────
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive(): return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid    = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="analytics-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, event):
+        """Enqueue one event dict (analytics columns). Returns False if it was dropped."""
+        if self._stop.is_set(): return False
+        self._ensure_started()
+        event.setdefault("created_at", time.time())
+        for k, n in FIELD_LIMITS.items():
+            if k in event: event[k] = _clip(event[k], n)
+        self.m["submitted"] += 1
+        try:
+            if self.overflow == "block": self.q.put(event, timeout=ANALYTICS_BLOCK_SECS)
+            else:                        self.q.put_nowait(event)
+        except queue.Full:
+            if self.overflow != "drop_oldest":
+                self.m["dropped"] += 1
+                return False
+            try:    self.q.get_nowait()          # make room — newest events are worth more
+            except queue.Empty: pass
+            self.m["dropped"] += 1
+            try:    self.q.put_nowait(event)
+            except queue.Full: return False
+        self.m["max_depth"] = max(self.m["max_depth"], self.q.qsize())
+        return True
+
+    # ── writer side ──────────────────────────────────────────
+    def _run(self):
+        retry, attempts = None, 0                  # a failed batch goes ahead of the queue
+        while True:
+            batch, deadline = retry or [], time.time() + self.flush_secs
+            while not retry and len(batch) < self.batch_size:
+                try:    batch.append(self.q.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty: break
+            if batch:
+                error, batch = self._flush(batch)
+                if error is None:
+                    retry, attempts = None, 0
+                elif attempts < ANALYTICS_RETRIES:
+                    retry, attempts = batch, attempts + 1
+                    self.m["retries"] += 1
+                    delay = min(30.0, ANALYTICS_RETRY_SECS * 2 ** (attempts - 1))
+                    logger.warning(f"Analytics flush failed ({len(batch)} events), "
+                                   f"retry {attempts} in {delay:.1f}s: {error}")
+                    self._stop.wait(delay)             # no backoff while shutting down
+                else:
+                    self.m["failed"] += len(batch)
+                    logger.error(f"Analytics flush error ({len(batch)} events dropped "
+                                 f"after {attempts} retries): {error}")
+                    retry, attempts = None, 0
+            if self._stop.is_set() and self.q.empty() and not retry: return
+
+    def _rows(self, batch):
+        geo_by_ip = {}
+        for e in batch:
+            ip = e.get("ip_address")
+            if ip not in geo_by_ip:
+                try:    geo_by_ip[ip] = self.geo(ip)[1:]
+                except Exception: geo_by_ip[ip] = ('Unknown', '', 'Unknown')
+        rows = []
+        for e in batch:
+            ts = datetime.fromtimestamp(e["created_at"], timezone.utc).replace(tzinfo=None)   # naive UTC
+            country, country_code, city = geo_by_ip[e.get("ip_address")]
+            try:    q = int(e.get("quality"))
+            except (TypeError, ValueError): q = None
+            rows.append((e.get("topic"), e.get("label"), e.get("roast_text"), e.get("language"),
+                         q, QUALITY_NAMES.get(q, '?'),
+                         e.get("ip_address"), _clip(country, 100), _clip(country_code, 10), _clip(city, 100),
+                         e.get("user_agent"), e.get("device_type"), e.get("response_ms"),
+                         e.get("success", True), e.get("error_msg"), e.get("session_id"),
+                         ts.hour, ts.weekday(), ts))
+        return rows
+
+    def _write(self, rows):
+        """INSERT rows + fold them into the rollups, in one transaction."""
+        ok = [r for r in rows if r[13]]
+        with self.get_conn() as conn:
+            if not conn: raise RuntimeError("no DB connection")
+            try:
+                cur = conn.cursor()
+                if ok:
+                    execute_values(cur, 'INSERT INTO roasts (topic,label,roast,language,created_at) VALUES %s',
+                                   [(r[0], r[1], r[2], r[3], r[18]) for r in ok], page_size=self.batch_size)
+                execute_values(cur, f'INSERT INTO analytics ({ANALYTICS_COLS}) VALUES %s', rows,
+                               page_size=self.batch_size)
+                apply_rollups(cur, [dict(zip(COL_NAMES, r)) for r in rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def _flush(self, batch):
+        """
+        Write one batch → (None, []) or (error, events still unwritten). A batch the
+        DB rejects (DataError / IntegrityError) is written row by row instead of
+        retried: the bad rows are dropped, the rest land.
+        """
+        t0, error, rest = time.time(), None, []
+        rows = self._rows(batch)
+        try:
+            self._write(rows)
+            self.m["written"] += len(batch)
+            self.m["batches"] += 1
+        except DETERMINISTIC as e:
+            logger.warning(f"Analytics batch rejected ({e.__class__.__name__}) — writing row by row")
+            for i, row in enumerate(rows):
+                try:
+                    self._write([row])
+                    self.m["written"] += 1
+                except DETERMINISTIC as e:
+                    self.m["failed"] += 1
+                    logger.error(f"Analytics row dropped (topic={str(row[0])[:40]!r}): {e}")
+                except Exception as e:
+                    error, rest = e, batch[i:]
+                    break
+            self.m["batches"] += 1
+        except Exception as e:
+            error, rest = e, batch
+        ms = int((time.time() - t0) * 1000)
+        self.m["last_flush_ms"] = ms
+        self.m["avg_flush_ms"]  = round(0.8 * self.m["avg_flush_ms"] + 0.2 * ms, 1)
+        return error, rest
+
+    def stop(self, timeout=10):
+        """Flush whatever is queued and stop the writer (registered with atexit)."""
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def stats(self):
+        return dict(self.m, queue_depth=self.q.qsize(), queue_max=self.q.maxsize, overflow=self.overflow)
@@ -3,10 +3,15 @@ core/battle_card.py
 ===================
 Overlays dynamic text on battle_template.png.
 Fixes: no bar/text overlap, single match time, Roasts Landed (same total both sides).
+The template, logo bar, panel wipes and static labels are composed once per
+process (_base); a card is a copy of that plus the battle-specific text.
 """
 
 import os, random, tempfile
-from PIL import Image, ImageDraw, ImageFont
+from io import BytesIO
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFilter
+from core.templates import get_font
 
 TEMPLATE  = os.path.join(os.path.dirname(os.path.abspath(__file__)), "battle_template.png")
 LOGO      = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo.png")
@@ -32,23 +37,39 @@ RP = (542, 646, 990, 990)     # right panel interior
 # Wipe the baked-in match time from template + our row
 MT_WIPE = (150, 540, 875, 598)   # wide enough to kill template text
 
+# Panel layout (canvas coordinates, i.e. below the logo bar)
+BAR_H = 15
+LX, LXR, LBW = LP[0] + 18, LP[2] - 18, LP[2] - LP[0] - 36
+RX, RXR, RBW = RP[0] + 18, RP[2] - 18, RP[2] - RP[0] - 36
+ROW1 = LP[1] + 16 + LOGO_BAR          # Roasts Landed
+ROW2 = ROW1 + 32 + BAR_H + 20         # Dominance Score
+DIV1 = ROW2 + 32 + BAR_H + 20
+ROW3 = DIV1 + 14                      # Best Roast / Reason for Loss
+ROW4 = ROW3 + 40                      # Time of Defeat
+DIV2 = ROW4 + 40                      # above the shame line
+
 
 def _f(s, reg=False):
-    try:    return ImageFont.truetype(FONT_REG if reg else FONT_BOLD, s)
-    except: return ImageFont.load_default()
+    return get_font(s, FONT_REG if reg else FONT_BOLD)     # lru-cached per process
 
 def _tw(d, t, f): return d.textlength(t, font=f)
 
-def _glow(d, text, font, x, y, fill, gc, p=3, sp=7, a='lt'):
+def _glow(img, d, text, font, x, y, fill, gc, p=3, sp=7, a='lt'):
+    """Text with a soft halo: one mask, dilated + blurred once, composited once."""
     if a == 'ct': x = int(x - _tw(d, text, font) / 2)
     if a == 'rt': x = int(x - _tw(d, text, font))
-    r, g, b = gc
-    for i in range(p, 0, -1):
-        s = sp * i // p
-        al = min(255, int(145 / i))
-        for dx in range(-s, s+1, max(1, s//2)):
-            for dy in range(-s, s+1, max(1, s//2)):
-                d.text((x+dx, y+dy), text, font=font, fill=(r, g, b, al))
+    l, t, r, b = d.textbbox((x, y), text, font=font)
+    pad  = sp + 4
+    ox, oy = max(0, l - pad), max(0, t - pad)
+    mask = Image.new("L", (r + pad - ox, b + pad - oy), 0)
+    ImageDraw.Draw(mask).text((x - ox, y - oy), text, font=font, fill=255)
+    peak = min(255, 145 + 40 * (p - 1))           # more passes used to stack brighter
+    halo = (mask.filter(ImageFilter.MaxFilter(2 * (sp // 2) + 1))
+                .filter(ImageFilter.GaussianBlur(sp / 2))
+                .point(lambda v: v * peak // 255))
+    layer = Image.new("RGBA", mask.size, tuple(gc) + (0,))
+    layer.putalpha(halo)
+    img.alpha_composite(layer, dest=(ox, oy))
     d.text((x, y), text, font=font, fill=fill)
 
 def _shadow(d, text, font, x, y, fill, a='lt', off=2):
@@ -57,14 +78,21 @@ def _shadow(d, text, font, x, y, fill, a='lt', off=2):
     d.text((x+off, y+off), text, font=font, fill=(0, 0, 0, 180))
     d.text((x, y),          text, font=font, fill=fill)
 
-def _bar(d, x, y, w, h, pct, col):
-    """Progress bar with guaranteed spacing — caller must give correct y."""
-    d.rectangle([x, y, x+w, y+h], fill=(10, 8, 20), outline=(50, 48, 65), width=1)
-    fw = max(4, int(w * min(pct, 100) / 100))
+@lru_cache(maxsize=256)
+def _ramp(fw, h, col):
+    """Gradient fill for a bar: one row of per-column colours, stretched to height h-1."""
     r, g, b = col
+    row = bytearray()
     for i in range(fw):
         br = 0.45 + 0.55 * (i / max(fw, 1))
-        d.line([(x+i, y+1),(x+i, y+h-1)], fill=(int(r*br), int(g*br), int(b*br)))
+        row += bytes((int(r*br), int(g*br), int(b*br), 255))
+    return Image.frombytes("RGBA", (fw, 1), bytes(row)).resize((fw, h - 1), Image.NEAREST)
+
+def _bar(img, d, x, y, w, h, pct, col):
+    """Progress bar with guaranteed spacing — caller must give correct y."""
+    d.rectangle([x, y, x+w, y+h], fill=(10, 8, 20), outline=(50, 48, 65), width=1)
+    fw = max(4, int(w * min(pct, 100) / 100))
+    img.paste(_ramp(fw, h, tuple(col)), (x, y+1))
     if fw > 3:
         d.line([(x+fw-1, y),(x+fw-1, y+h)], fill=col, width=2)
 
@@ -82,7 +110,7 @@ def _wrap(d, text, font, mw):
     if cur: lines.append(cur)
     return lines
 
-def _shame(reason, dh, lr, wr):
+def _shame(reason, dh, lr, wr, rng=random):
     ratio = wr / max(lr, 1)
     pool = (["Tapped out. Couldn't take it.",
              "Waved the white flag. Pathetic.",
@@ -94,10 +122,10 @@ def _shame(reason, dh, lr, wr):
              "Timed out. Ran out of words.",
              "Ghosted the battle. Very brave."])
     if ratio >= 3: pool.append(f"Outroasted {ratio:.0f}x. Not even close.")
-    return random.choice(pool)
+    return rng.choice(pool)
 
-def _quote(topic):
-    return random.choice([
+def _quote(topic, rng=random):
+    return rng.choice([
         f"Destroyed {topic} without breaking a sweat.",
         "Left them with absolutely no comeback.",
         "The roast heard around the world.",
@@ -106,28 +134,13 @@ def _quote(topic):
     ])
 
 
-def generate_battle_card(battle_data: dict) -> str:
-    bid    = battle_data.get("battle_id",    "RB-00000")
-    winner = battle_data.get("winner_name",  "WINNER").upper()
-    loser  = battle_data.get("loser_name",   "LOSER").upper()
-    wr     = int(battle_data.get("winner_roasts", 0))
-    lr     = int(battle_data.get("loser_roasts",  0))
-    dh     = int(battle_data.get("duration_hrs",  0))
-    dm     = int(battle_data.get("duration_mins", 0))
-    reason = battle_data.get("loss_reason", "timeout").lower()
-    total  = int(battle_data.get("total_rounds", max(wr+lr, 1)))
-    topic  = battle_data.get("topic", "Unknown")
-
-    # Both fought same total rounds — difference is roasts LANDED
-    w_dom   = min(99, wr * 100 // max(total, 1))
-    l_dom   = max(4,  min(25, lr * 100 // max(total, 1)))
-    dur     = f"{dh}:{dm:02d}"
-    shame   = _shame(reason, dh, lr, wr)
-    quote   = _quote(topic)
-    r_lbl   = "Knockout" if reason == "timeout" else "Surrender"
-    d_time  = f"Round {total}  ·  {dh:02d}:{dm:02d}"
-
-    # ── Load template — paste below logo bar ─────────────────
+@lru_cache(maxsize=1)
+def _base():
+    """
+    Everything that doesn't depend on the battle: template + logo bar, wiped
+    panels, static labels, bar frames and dividers. Built once per process;
+    each card starts from a copy.
+    """
     template_img = Image.open(TEMPLATE).convert("RGBA")
     template_img = template_img.resize((W, H), Image.LANCZOS)
 
@@ -149,14 +162,62 @@ def generate_battle_card(battle_data: dict) -> str:
     # Thin fire-red separator line under logo bar
     draw.rectangle([0, LOGO_BAR - 2, W, LOGO_BAR], fill=(200, 40, 10))
 
-    # All subsequent y positions are offset by LOGO_BAR
-    Y = LOGO_BAR   # use this offset for everything below
+    Y = LOGO_BAR
 
     # ── WIPE panels + match time completely ───────────────────
     draw.rectangle([LP[0], LP[1]+Y, LP[2], LP[3]+Y], fill=(14, 11, 24, 252))
     draw.rectangle([RP[0], RP[1]+Y, RP[2], RP[3]+Y], fill=(22,  8,  5, 252))
     draw.rectangle([MT_WIPE[0], MT_WIPE[1]+Y, MT_WIPE[2], MT_WIPE[3]+Y], fill=(6, 4, 14, 245))
 
+    lf2 = _f(21, reg=True)
+
+    # Left panel
+    draw.text((LX, ROW1), "Roasts Landed:",   font=lf2, fill=GREY)
+    draw.text((LX, ROW2), "Dominance Score:", font=lf2, fill=GREY)
+    _divider(draw, LX, LXR, DIV1)
+    _glow(img, draw, "Best Roast:", _f(21), LX, ROW3, W_GOLD, W_GOLD2, p=1, sp=3)
+    _divider(draw, LX, LXR, LP[3]+Y-46, col=(60, 58, 80))
+
+    # Right panel
+    draw.text((RX, ROW1), "Roasts Landed:",   font=lf2, fill=GREY)
+    draw.text((RX, ROW2), "Dominance Score:", font=lf2, fill=GREY)
+    _divider(draw, RX, RXR, DIV1, col=(70, 35, 25))
+    draw.text((RX, ROW3), "Reason for Loss:", font=lf2, fill=GREY)
+    draw.text((RX, ROW4), "Time of Defeat:",  font=lf2, fill=GREY)
+    _divider(draw, RX, RXR, DIV2, col=(70, 35, 25))
+    _divider(draw, RX, RXR, RP[3]+Y-46, col=(70, 30, 20))
+    return img
+
+
+def compose_battle_card(battle_data: dict) -> Image.Image:
+    """Draw the battle-specific text and bars on a copy of the base → RGB image."""
+    bid    = battle_data.get("battle_id",    "RB-00000")
+    winner = battle_data.get("winner_name",  "WINNER").upper()
+    loser  = battle_data.get("loser_name",   "LOSER").upper()
+    wr     = int(battle_data.get("winner_roasts", 0))
+    lr     = int(battle_data.get("loser_roasts",  0))
+    dh     = int(battle_data.get("duration_hrs",  0))
+    dm     = int(battle_data.get("duration_mins", 0))
+    reason = battle_data.get("loss_reason", "timeout").lower()
+    total  = int(battle_data.get("total_rounds", max(wr+lr, 1)))
+    topic  = battle_data.get("topic", "Unknown")
+
+    # Both fought same total rounds — difference is roasts LANDED
+    w_dom   = min(99, wr * 100 // max(total, 1))
+    l_dom   = max(4,  min(25, lr * 100 // max(total, 1)))
+    dur     = f"{dh}:{dm:02d}"
+    rng     = random.Random(bid)          # same battle → same lines → same bytes (render cache)
+    shame   = _shame(reason, dh, lr, wr, rng)
+    quote   = _quote(topic, rng)
+    r_lbl   = "Knockout" if reason == "timeout" else "Surrender"
+    d_time  = f"Round {total}  ·  {dh:02d}:{dm:02d}"
+
+    img  = _base().copy()
+    draw = ImageDraw.Draw(img, 'RGBA')
+    Y    = LOGO_BAR
+    vf   = _f(28)
+    smf  = _f(18, reg=True)
+
     # ─────────────────────────────────────────────────────────
     # MATCH TIME — single, centered, clean
     # ─────────────────────────────────────────────────────────
@@ -165,92 +226,37 @@ def generate_battle_card(battle_data: dict) -> str:
     # ─────────────────────────────────────────────────────────
     # LEFT PANEL — Winner stats
     # ─────────────────────────────────────────────────────────
-    LX  = LP[0] + 18
-    LXR = LP[2] - 18
-    LBW = LP[2] - LP[0] - 36
-    lf2 = _f(21, reg=True)
-    vf  = _f(28)
-    smf = _f(18, reg=True)
-    BAR_H = 15
-
-    y = LP[1] + 16 + Y
-
-    # Roasts Landed
-    draw.text((LX, y), "Roasts Landed:", font=lf2, fill=GREY)
-    _glow(draw, f"{wr}/{total}", vf, LXR, y-2, W_WHITE, W_BLUE, p=2, sp=5, a='rt')
-    y += 32
-    _bar(draw, LX, y, LBW, BAR_H, w_dom, (55, 135, 255))
-    y += BAR_H + 20
-
-    # Dominance Score
-    draw.text((LX, y), "Dominance Score:", font=lf2, fill=GREY)
-    _glow(draw, f"{w_dom}%", vf, LXR, y-2, W_GOLD, W_GOLD2, p=2, sp=5, a='rt')
-    y += 32
-    _bar(draw, LX, y, LBW, BAR_H, w_dom, (195, 95, 8))
-    y += BAR_H + 20
-
-    # Divider
-    _divider(draw, LX, LXR, y)
-    y += 14
-
-    # Best Roast
-    _glow(draw, "Best Roast:", _f(21), LX, y, W_GOLD, W_GOLD2, p=1, sp=3)
-    y += 30
+    _glow(img, draw, f"{wr}/{total}", vf, LXR, ROW1-2, W_WHITE, W_BLUE, p=2, sp=5, a='rt')
+    _bar(img, draw, LX, ROW1 + 32, LBW, BAR_H, w_dom, (55, 135, 255))
+    _glow(img, draw, f"{w_dom}%", vf, LXR, ROW2-2, W_GOLD, W_GOLD2, p=2, sp=5, a='rt')
+    _bar(img, draw, LX, ROW2 + 32, LBW, BAR_H, w_dom, (195, 95, 8))
+
+    y = ROW3 + 30
     for ql in _wrap(draw, f'"{quote}"', smf, LBW)[:3]:
         _shadow(draw, ql, smf, LX, y, WHITE)
         y += 25
 
     # Winner name pinned to panel bottom
-    _divider(draw, LX, LXR, LP[3]+Y-46, col=(60, 58, 80))
-    _glow(draw, winner, _f(30), LX, LP[3]+Y-40, W_GOLD, W_GOLD2, p=3, sp=7)
+    _glow(img, draw, winner, _f(30), LX, LP[3]+Y-40, W_GOLD, W_GOLD2, p=3, sp=7)
 
     # ─────────────────────────────────────────────────────────
     # RIGHT PANEL — Loser stats
     # ─────────────────────────────────────────────────────────
-    RX  = RP[0] + 18
-    RXR = RP[2] - 18
-    RBW = RP[2] - RP[0] - 36
-
-    y = RP[1] + 16 + Y
-
-    # Roasts Landed
-    draw.text((RX, y), "Roasts Landed:", font=lf2, fill=GREY)
-    _glow(draw, f"{lr}/{total}", vf, RXR, y-2, L_WHITE, L_RED, p=2, sp=5, a='rt')
-    y += 32
-    _bar(draw, RX, y, RBW, BAR_H, l_dom, (195, 35, 8))
-    y += BAR_H + 20
-
-    # Dominance Score
-    draw.text((RX, y), "Dominance Score:", font=lf2, fill=GREY)
-    _glow(draw, f"{l_dom}%", vf, RXR, y-2, L_FIRE, L_RED, p=2, sp=5, a='rt')
-    y += 32
-    _bar(draw, RX, y, RBW, BAR_H, l_dom, (170, 55, 4))
-    y += BAR_H + 20
-
-    # Divider
-    _divider(draw, RX, RXR, y, col=(70, 35, 25))
-    y += 14
-
-    # Reason for Loss
-    draw.text((RX, y), "Reason for Loss:", font=lf2, fill=GREY)
-    _glow(draw, r_lbl, vf, RXR, y-2, WHITE, L_RED, p=2, sp=5, a='rt')
-    y += 40
-
-    # Time of Defeat
-    draw.text((RX, y), "Time of Defeat:", font=lf2, fill=GREY)
-    _shadow(draw, d_time, _f(21), RXR, y+3, WHITE, a='rt')
-    y += 40
+    _glow(img, draw, f"{lr}/{total}", vf, RXR, ROW1-2, L_WHITE, L_RED, p=2, sp=5, a='rt')
+    _bar(img, draw, RX, ROW1 + 32, RBW, BAR_H, l_dom, (195, 35, 8))
+    _glow(img, draw, f"{l_dom}%", vf, RXR, ROW2-2, L_FIRE, L_RED, p=2, sp=5, a='rt')
+    _bar(img, draw, RX, ROW2 + 32, RBW, BAR_H, l_dom, (170, 55, 4))
+    _glow(img, draw, r_lbl, vf, RXR, ROW3-2, WHITE, L_RED, p=2, sp=5, a='rt')
+    _shadow(draw, d_time, _f(21), RXR, ROW4+3, WHITE, a='rt')
 
     # Shame line
-    _divider(draw, RX, RXR, y, col=(70, 35, 25))
-    y += 12
+    y = DIV2 + 12
     for sl in _wrap(draw, shame, _f(17, reg=True), RBW)[:2]:
         draw.text((RX, y), sl, font=_f(17, reg=True), fill=(210, 100, 80))
         y += 23
 
     # Loser name pinned to panel bottom
-    _divider(draw, RX, RXR, RP[3]+Y-46, col=(70, 30, 20))
-    _glow(draw, loser, _f(30), RXR, RP[3]+Y-40, L_RED, L_FIRE, p=3, sp=7, a='rt')
+    _glow(img, draw, loser, _f(30), RXR, RP[3]+Y-40, L_RED, L_FIRE, p=3, sp=7, a='rt')
 
     # ─────────────────────────────────────────────────────────
     # WATERMARK — bottom center
@@ -260,10 +266,21 @@ def generate_battle_card(battle_data: dict) -> str:
     draw.text(((W - int(_tw(draw, wm, wmf))) // 2, H + Y - 16),
               wm, font=wmf, fill=(85, 82, 95, 185))
 
-    # ── Save ─────────────────────────────────────────────────
-    out = img.convert("RGB")
+    return img.convert("RGB")
+
+
+def render_battle_card(battle_data: dict, quality=96) -> bytes:
+    """Battle card as JPEG bytes."""
+    buf = BytesIO()
+    compose_battle_card(battle_data).save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def generate_battle_card(battle_data: dict) -> str:
+    """Battle card written to a temp JPEG; returns its path (caller deletes it)."""
+    bid = battle_data.get("battle_id", "RB-00000")
     tmp = tempfile.NamedTemporaryFile(suffix=".jpg", prefix=f"battle_{bid}_", delete=False)
-    out.save(tmp.name, "JPEG", quality=96)
+    tmp.write(render_battle_card(battle_data))
     tmp.close()
     return tmp.name
 
@@ -0,0 +1,193 @@
+"""
+core/battles.py
+===============
+Battle state: atomic writes + a versioned, write-through snapshot cache.
+  - every UPDATE of a battles row bumps battles.version (trigger, migration 6)
+  - writes are single conditional statements with RETURNING *; the returned row
+    replaces the cached snapshot, so this process never serves its own stale state
+  - a snapshot is (row, rounds) for one version; put() never replaces a newer
+    version with an older one, and rounds are only attached to the version they
+    were read for
+  - other processes' writes show up within BATTLE_CACHE_TTL; an ended battle
+    with its card_url set no longer changes, so it's kept for BATTLE_CACHE_ENDED_TTL
+  - a snapshot can be that old, so callers whose guard fails on it re-check with
+    fresh() before rejecting
+  - a failed read raises; only a battle that really isn't there is cached as missing
+add_round() numbers and stores a round in one statement: the UPDATE on the
+battle row bumps total_rounds (and row-locks the battle, so concurrent moves
+queue), re-checks status + membership, and feeds the INSERT through RETURNING.
+Round numbers per battle are unique and gap-free; a UNIQUE (battle_id, round_num)
+index backs that up.
+"""
+
+import os, threading
+from core.cache import TTLCache
+
+BATTLE_CACHE_SIZE      = int(os.getenv("BATTLE_CACHE_SIZE", 5000))
+BATTLE_CACHE_TTL       = float(os.getenv("BATTLE_CACHE_TTL", 2))          # pending / active snapshots
+BATTLE_CACHE_ENDED_TTL = float(os.getenv("BATTLE_CACHE_ENDED_TTL", 300))  # ended, card_url set: final
+BATTLE_CACHE_NEG_TTL   = float(os.getenv("BATTLE_CACHE_NEG_TTL", 1))      # unknown ids
+
+ADD_ROUND_SQL = '''
+    WITH b AS (
+        UPDATE battles SET total_rounds = total_rounds + 1
+        WHERE battle_id = %(battle_id)s AND status = 'active'
+          AND %(player_id)s IN (challenger_id, opponent_id)
+        RETURNING *
+    ), r AS (
+        INSERT INTO battle_rounds (battle_id, round_num, player_id, player_name, roast_text)
+        SELECT battle_id, total_rounds, %(player_id)s,
+               CASE WHEN challenger_id = %(player_id)s THEN challenger_name ELSE opponent_name END,
+               %(roast_text)s
+        FROM b
+        RETURNING round_num, player_name AS round_player
+    )
+    SELECT r.round_num, r.round_player, b.* FROM b CROSS JOIN r'''
+
+
+def add_round(conn, battle_id, player_id, roast_text):
+    """
+    Store the next round → (round_num, player_name, battle_row), or None if the
+    battle is no longer active or the player isn't in it. Commits.
+    """
+    cur = conn.cursor()
+    cur.execute(ADD_ROUND_SQL, {"battle_id": battle_id, "player_id": player_id, "roast_text": roast_text})
+    r = cur.fetchone()
+    conn.commit()
+    if not r: return None
+    row = dict(r)
+    return row.pop('round_num'), row.pop('round_player'), row
+
+
+class _Snapshot:
+    __slots__ = ("row", "rounds")
+
+    def __init__(self, row, rounds=None):
+        self.row, self.rounds = row, rounds
+
+
+class BattleCache:
+    """
+    `get_conn` is a context-manager factory (DBPool.connection).
+    Returned rows and round lists are shared snapshots — treat them as read-only.
+    """
+
+    def __init__(self, get_conn, maxsize=BATTLE_CACHE_SIZE, ttl=BATTLE_CACHE_TTL,
+                 ended_ttl=BATTLE_CACHE_ENDED_TTL, neg_ttl=BATTLE_CACHE_NEG_TTL):
+        self.get_conn  = get_conn
+        self.ended_ttl = ended_ttl
+        self.neg_ttl   = neg_ttl
+        self._cache    = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock     = threading.Lock()
+        self.m = {"loads": 0, "round_loads": 0, "writes": 0, "stale_puts": 0}
+
+    def _query(self, sql, args, many=False):
+        with self.get_conn() as conn:
+            if not conn: raise RuntimeError("no DB connection")
+            cur = conn.cursor()
+            cur.execute(sql, args)
+            return cur.fetchall() if many else cur.fetchone()
+
+    def put(self, row, rounds=None):
+        """Cache a battles row read from / returned by the DB, unless a newer version is cached."""
+        with self._lock:
+            cur = self._cache.get(row['battle_id'])
+            if cur and cur.row:
+                have, new = cur.row.get('version', 0), row.get('version', 0)
+                if have > new:
+                    self.m["stale_puts"] += 1
+                    return cur
+                if have == new and rounds is None and cur.row == row: return cur    # keep its rounds
+            snap = _Snapshot(row, rounds)
+            final = row['status'] == 'ended' and row['card_url']     # until card_url is set, other workers' uploads must show
+            self._cache.set(row['battle_id'], snap, self.ended_ttl if final else None)
+            return snap
+
+    def _snapshot(self, battle_id):
+        snap = self._cache.get(battle_id)
+        if snap is not None: return snap
+        self.m["loads"] += 1
+        row = self._query('SELECT * FROM battles WHERE battle_id=%s', (battle_id,))
+        if row is None:
+            snap = _Snapshot(None, ())
+            self._cache.set(battle_id, snap, self.neg_ttl)
+            return snap
+        return self.put(row)
+
+    def get(self, battle_id):
+        return self._snapshot(battle_id).row
+
+    def fresh(self, battle_id):
+        """The row as the DB has it now (re-read, then cached) — for a guard that failed on a snapshot."""
+        self.invalidate(battle_id)
+        return self.get(battle_id)
+
+    def rounds(self, battle_id):
+        """Rounds matching the cached row — up to its total_rounds (one SELECT per version, not per poll)."""
+        snap = self._snapshot(battle_id)
+        if snap.rounds is not None or snap.row is None: return snap.rounds or []
+        self.m["round_loads"] += 1
+        rounds = self._query('''SELECT * FROM battle_rounds WHERE battle_id=%s AND round_num <= %s
+                                ORDER BY round_num''', (battle_id, snap.row['total_rounds'] or 0), many=True)
+        rounds = tuple(rounds)
+        with self._lock:
+            if self._cache.get(battle_id) is snap: snap.rounds = rounds
+        return rounds
+
+    def invalidate(self, battle_id):
+        self._cache.pop(battle_id)
+
+    # ── state transitions (write-through) ────────────────────
+    def _write(self, sql, args):
+        with self.get_conn() as conn:
+            if not conn: raise RuntimeError("no DB connection")
+            cur = conn.cursor()
+            cur.execute(sql, args)
+            row = cur.fetchone()
+            conn.commit()
+        self.m["writes"] += 1
+        if row is None: return None
+        self.put(row)
+        return row
+
+    def create(self, battle_id, topic, mode, challenger_id, challenger_name):
+        return self._write('''INSERT INTO battles
+            (battle_id,topic,mode,status,challenger_id,challenger_name,expires_at)
+            VALUES (%s,%s,%s,'pending',%s,%s, NOW() + INTERVAL '24 hours') RETURNING *''',
+            (battle_id, topic, mode, challenger_id, challenger_name))
+
+    def accept(self, battle_id, opponent_id, opponent_name):
+        """pending → active; None if someone else got there first."""
+        row = self._write('''UPDATE battles SET status='active', opponent_id=%s, opponent_name=%s,
+            accepted_at=NOW(), expires_at=NOW()+INTERVAL '24 hours'
+            WHERE battle_id=%s AND status='pending' RETURNING *''',
+            (opponent_id, opponent_name, battle_id))
+        if row is None: self.invalidate(battle_id)
+        return row
+
+    def end(self, battle_id, loser_id, reason):
+        """active → ended, winner = the other player; None if the battle wasn't active."""
+        row = self._write('''UPDATE battles SET status='ended', loser_id=%(loser)s,
+            winner_id = CASE WHEN %(loser)s = opponent_id THEN challenger_id ELSE opponent_id END,
+            loss_reason=%(reason)s, ended_at=NOW()
+            WHERE battle_id=%(battle_id)s AND status='active' RETURNING *''',
+            {"loser": loser_id, "reason": reason, "battle_id": battle_id})
+        if row is None: self.invalidate(battle_id)
+        return row
+
+    def set_card_url(self, battle_id, card_url):
+        return self._write('UPDATE battles SET card_url=%s WHERE battle_id=%s RETURNING *', (card_url, battle_id))
+
+    def add_round(self, conn, battle_id, player_id, roast_text):
+        """add_round() on `conn`, writing the bumped battle row through → (round_num, player_name) or None."""
+        added = add_round(conn, battle_id, player_id, roast_text)
+        self.m["writes"] += 1
+        if added is None:
+            self.invalidate(battle_id)
+            return None
+        round_num, player_name, row = added
+        self.put(row)
+        return round_num, player_name
+
+    def stats(self):
+        return dict(self.m, cache=self._cache.stats())
@@ -0,0 +1,105 @@
+"""
+core/cache.py
+=============
+Small thread-safe LRU + TTL cache.
+Failed lookups can be cached for a shorter time (negative caching), and
+get_or_load() makes concurrent misses on one key share a single load.
+"""
+
+import time, threading
+from collections import OrderedDict
+
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=300, neg_ttl=None):
+        self.maxsize   = maxsize
+        self.ttl       = ttl
+        self.neg_ttl   = ttl if neg_ttl is None else neg_ttl
+        self._data     = OrderedDict()     # key -> (expires_at, value)
+        self._inflight = {}
+        self._lock     = threading.Lock()
+        self.hits = self.misses = self.neg_hits = self.coalesced = self.evictions = 0
+
+    def _get_locked(self, key, now):
+        item = self._data.get(key)
+        if item is None: return False, None
+        if item[0] <= now:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, item[1]
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._get_locked(key, time.time())
+            if found: self.hits += 1
+            else:     self.misses += 1
+            return value if found else default
+
+    def _set_locked(self, key, value, ttl):
+        self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key, value, ttl=None):
+        with self._lock: self._set_locked(key, value, ttl)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item else None
+
+    def get_or_load(self, key, loader, negative=lambda v: v is None, wait=10, keep=None):
+        """
+        Cached value for `key`, else loader(). Only one thread runs the loader per key;
+        the rest wait up to `wait` secs for its result. Values for which negative(v)
+        is true are kept for neg_ttl instead of ttl. Loader exceptions are not cached.
+        keep() is checked under the cache lock just before storing; if it returns
+        False the value is returned but not cached (the load raced an invalidation).
+        """
+        with self._lock:
+            found, value = self._get_locked(key, time.time())
+            if found:
+                self.hits += 1
+                if negative(value): self.neg_hits += 1
+                return value
+            self.misses += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if not flight.event.wait(wait): return loader()
+            if flight.error is not None: raise flight.error
+            return flight.value
+        try:
+            flight.value = loader()
+            with self._lock:
+                if keep is None or keep():
+                    self._set_locked(key, flight.value, self.neg_ttl if negative(flight.value) else self.ttl)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock: self._inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._data), "max": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "negative_hits": self.neg_hits, "coalesced": self.coalesced, "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
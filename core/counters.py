@@ -0,0 +1,251 @@
+"""
+core/counters.py
+================
+Write-behind counters for stats.total_roasts and user_roast_count.
+Request threads bump per-process striped counters (one lock per stripe, each
+thread sticking to its own stripe); a flusher thread folds them into the DB every COUNTER_FLUSH_SECS
+as one delta per row, in its own short transaction. Reads go through a
+short-TTL cache and add this process's not-yet-flushed delta, so a user sees
+their own roasts counted immediately.
+A flush moves deltas to "in flight", where pending() still counts them until
+the commit has landed and the cached bases are dropped, so reads never dip.
+Each flush bumps a generation; a cache load that started before it isn't
+stored, so a pre-commit base can't outlive its delta.
+If the DB rejects the batch (DataError / IntegrityError), rows are retried one
+by one and the rejected ones dropped; only transient failures are restored.
+"""
+
+import os, time, atexit, logging, itertools, threading
+from collections import Counter
+import psycopg2
+from psycopg2.extras import execute_values
+from core.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+COUNTER_STRIPES    = int(os.getenv("COUNTER_STRIPES", 8))
+COUNTER_FLUSH_SECS = float(os.getenv("COUNTER_FLUSH_SECS", 5))
+COUNTER_READ_TTL   = float(os.getenv("COUNTER_READ_TTL", 5))     # secs a DB read of a counter is reused
+GALI_UNLOCK_AT     = 10
+TOTAL_ROASTS_SEED  = 52341
+DETERMINISTIC      = (psycopg2.DataError, psycopg2.IntegrityError)   # retrying the same row won't help
+
+UPSERT_SQL = f'''INSERT INTO user_roast_count (session_id, roast_count, gali_unlocked)
+    VALUES %s ON CONFLICT (session_id) DO UPDATE
+    SET roast_count   = user_roast_count.roast_count + EXCLUDED.roast_count,
+        gali_unlocked = user_roast_count.gali_unlocked
+                        OR user_roast_count.roast_count + EXCLUDED.roast_count >= {GALI_UNLOCK_AT},
+        updated_at    = NOW()'''
+
+
+class StripedCounter:
+    """Keyed int deltas spread over stripes so concurrent add()s rarely share a lock."""
+
+    def __init__(self, stripes=COUNTER_STRIPES):
+        self._stripes = [(threading.Lock(), Counter()) for _ in range(max(1, stripes))]
+        self._local   = threading.local()
+        self._next    = itertools.count()
+        self._flight  = Counter()            # drained, not yet committed
+        self._flock   = threading.Lock()     # drain / settle / pending see stripes + in-flight as one
+
+    def _stripe(self):
+        """Threads get stripes round-robin on first use (thread idents are page-aligned, so no modulo)."""
+        try:    return self._stripes[self._local.i]
+        except AttributeError:
+            self._local.i = next(self._next) % len(self._stripes)
+            return self._stripes[self._local.i]
+
+    def add(self, key, n=1):
+        lock, c = self._stripe()
+        with lock: c[key] += n
+
+    def pending(self, key):
+        """Not yet committed: the stripes plus anything drained by a flush still in progress."""
+        with self._flock:
+            return sum(c.get(key, 0) for _, c in self._stripes) + self._flight.get(key, 0)
+
+    def drain(self):
+        """Move every stripe's deltas in flight → one Counter; the stripes start again from zero."""
+        out = Counter()
+        with self._flock:
+            for lock, c in self._stripes:
+                with lock:
+                    out.update(c)
+                    c.clear()
+            self._flight.update(out)
+        return out
+
+    def settle(self, deltas):
+        """Drained deltas are committed (and cached bases dropped) — stop counting them."""
+        with self._flock:
+            self._flight.subtract(deltas)
+            self._flight = +self._flight        # drop keys that reached zero
+
+    def restore(self, deltas):
+        """Put drained deltas back after a failed flush."""
+        lock, c = self._stripes[0]
+        with self._flock:
+            self._flight.subtract(deltas)
+            self._flight = +self._flight
+            with lock: c.update(deltas)
+
+
+class RoastCounters:
+    """
+    `get_conn` is a context-manager factory (DBPool.connection).
+    roast(sid, ok) is all a request does; nothing touches the DB until the flush.
+    """
+
+    def __init__(self, get_conn, stripes=COUNTER_STRIPES, flush_secs=COUNTER_FLUSH_SECS, read_ttl=COUNTER_READ_TTL):
+        self.get_conn   = get_conn
+        self.flush_secs = flush_secs
+        self.total      = StripedCounter(stripes)       # single key: "total"
+        self.sessions   = StripedCounter(stripes)       # session_id -> roasts
+        self.reads      = TTLCache(maxsize=4096, ttl=read_ttl)
+        self._stop      = threading.Event()
+        self._lock      = threading.Lock()
+        self._thread    = None
+        self._pid       = None
+        self._gen       = 0                             # bumped after every committed flush
+        self.m = {"flushes": 0, "failed": 0, "dropped": 0, "rows": 0, "last_flush_ms": 0, "avg_flush_ms": 0.0}
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.stop)
+
+    def _after_fork(self):
+        """A forked child starts with no pending deltas — the parent flushes its own."""
+        self.total    = StripedCounter(len(self.total._stripes))
+        self.sessions = StripedCounter(len(self.sessions._stripes))
+        self.reads    = TTLCache(maxsize=self.reads.maxsize, ttl=self.reads.ttl)
+        self._lock    = threading.Lock()
+        self._thread  = None
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive(): return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid    = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="counter-flush", daemon=True)
+                self._thread.start()
+
+    # ── write side ───────────────────────────────────────────
+    def roast(self, sid, ok=True):
+        """Count one roast attempt for `sid`; only successful ones count towards the global total."""
+        self._ensure_started()
+        if ok: self.total.add("total")
+        if sid is not None: self.sessions.add(sid)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_secs):
+            self.flush()
+
+    def _write(self, cur, total, sessions):
+        if total:
+            cur.execute('UPDATE stats SET total_roasts = total_roasts + %s', (total,))
+        if sessions:
+            execute_values(cur, UPSERT_SQL, [(sid, n, n >= GALI_UNLOCK_AT) for sid, n in sessions],
+                           page_size=500)
+
+    def _landed(self, total, sessions):
+        """Committed (or dropped for good) — stop counting these deltas as pending."""
+        self._gen += 1                             # loads that started before the commit aren't cached
+        if total["total"]: self.reads.pop("total") # the cached base is stale once its delta lands
+        for sid in sessions: self.reads.pop(("user", sid))
+        self.total.settle(total)
+        self.sessions.settle(sessions)
+
+    def flush(self):
+        t0       = time.time()
+        total    = self.total.drain()
+        sessions = self.sessions.drain()
+        if not total and not sessions: return
+        try:
+            with self.get_conn() as conn:
+                if not conn: raise RuntimeError("no DB connection")
+                self._write(conn.cursor(), total["total"], sorted(sessions.items()))   # sorted → stable lock order
+                conn.commit()
+            self.m["flushes"] += 1
+            self.m["rows"]    += len(sessions) + bool(total["total"])
+            self._landed(total, sessions)
+        except DETERMINISTIC as e:
+            logger.warning(f"Counter flush rejected ({e.__class__.__name__}) — retrying row by row")
+            self._flush_rows(total, sessions)
+        except Exception as e:
+            self.total.restore(total)
+            self.sessions.restore(sessions)
+            self.m["failed"] += 1
+            logger.error(f"Counter flush error: {e}")
+        ms = int((time.time() - t0) * 1000)
+        self.m["last_flush_ms"] = ms
+        self.m["avg_flush_ms"]  = round(0.8 * self.m["avg_flush_ms"] + 0.2 * ms, 1)
+
+    def _flush_rows(self, total, sessions):
+        """
+        One transaction per row after the batch was rejected: a row the DB refuses
+        (DataError / IntegrityError) is dropped and logged, never restored — it
+        would fail every flush after. A transient error puts the rest back.
+        """
+        rows = ([("total", total["total"])] if total["total"] else []) + sorted(sessions.items())
+        done = 0
+        with self.get_conn() as conn:
+            for i, (key, n) in enumerate(rows):
+                try:
+                    if not conn: raise RuntimeError("no DB connection")
+                    if key == "total": self._write(conn.cursor(), n, ())
+                    else:              self._write(conn.cursor(), 0, [(key, n)])
+                    conn.commit()
+                    self.m["rows"] += 1
+                except DETERMINISTIC as e:
+                    conn.rollback()
+                    self.m["dropped"] += 1
+                    logger.error(f"Counter row dropped ({key!r}: +{n}): {e}")
+                except Exception as e:
+                    if conn: conn.rollback()
+                    self.m["failed"] += 1
+                    logger.error(f"Counter flush error: {e}")
+                    break
+                done = i + 1
+        landed = dict(rows[:done])
+        t_done = Counter({"total": landed.pop("total")}) if "total" in landed else Counter()
+        s_done = Counter(landed)
+        self._landed(t_done, s_done)
+        self.total.restore(total - t_done)
+        self.sessions.restore(sessions - s_done)
+        self.m["flushes"] += 1
+
+    def stop(self):
+        """Flush what's pending (registered with atexit)."""
+        self._stop.set()
+        if self._pid == os.getpid(): self.flush()
+
+    # ── read side ────────────────────────────────────────────
+    def _query(self, sql, args=()):
+        with self.get_conn() as conn:
+            if not conn: return None
+            try:
+                cur = conn.cursor()
+                cur.execute(sql, args)
+                return cur.fetchone() or {}
+            except Exception:
+                return None
+
+    def _cached(self, key, sql, args=()):
+        gen = self._gen
+        return self.reads.get_or_load(key, lambda: self._query(sql, args), keep=lambda: self._gen == gen)
+
+    def total_roasts(self):
+        r = self._cached("total", 'SELECT total_roasts FROM stats WHERE id=1')
+        base = r.get('total_roasts', TOTAL_ROASTS_SEED) if r else TOTAL_ROASTS_SEED
+        return base + self.total.pending("total")
+
+    def user_roasts(self, sid):
+        """(roast_count, gali_unlocked) for a session, including this process's unflushed roasts."""
+        r = self._cached(("user", sid), 'SELECT roast_count,gali_unlocked FROM user_roast_count WHERE session_id=%s',
+                         (sid,))
+        count    = (r.get('roast_count', 0) if r else 0) + self.sessions.pending(sid)
+        unlocked = bool(r and r.get('gali_unlocked')) or count >= GALI_UNLOCK_AT
+        return count, unlocked
+
+    def stats(self):
+        return dict(self.m, pending_total=self.total.pending("total"),
+                    pending_sessions=sum(len(c) for _, c in self.sessions._stripes),
+                    reads=self.reads.stats())
@@ -0,0 +1,121 @@
+"""
+core/db.py
+==========
+Thread-safe PostgreSQL connection pool shared by all request threads.
+Connections are health-checked on checkout and handed out via a context manager.
+"""
+
+import os, time, logging, threading
+from contextlib import contextmanager
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_MIN        = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX        = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT    = float(os.getenv("DB_POOL_TIMEOUT", 5))     # secs to wait for a free slot
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5))    # secs for a fresh TCP+auth handshake
+DB_PING_AFTER      = float(os.getenv("DB_PING_AFTER", 30))      # ping connections idle longer than this
+
+
+class DBPool:
+    """
+    Lazily-created ThreadedConnectionPool.
+    A semaphore caps checkouts so callers wait up to `timeout` instead of failing
+    instantly when the pool is exhausted. Recreated after fork (gunicorn workers).
+    """
+
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT):
+        self.dsn       = dsn
+        self.minconn   = minconn
+        self.maxconn   = maxconn
+        self.timeout   = timeout
+        self._pool     = None
+        self._pid      = None
+        self._lock     = threading.Lock()
+        self._slots    = threading.BoundedSemaphore(maxconn)
+        self._last_use = {}
+        self._in_use   = 0
+        self.waits     = 0    # checkouts that timed out waiting for a slot
+        self.discarded = 0    # connections dropped by the health check
+
+    def _get_pool(self):
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = pg_pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, self.dsn,
+                        cursor_factory=RealDictCursor, connect_timeout=DB_CONNECT_TIMEOUT)
+                    self._pid      = os.getpid()
+                    self._last_use = {}
+        return self._pool
+
+    def _healthy(self, conn):
+        if conn.closed: return False
+        if time.time() - self._last_use.get(id(conn), 0) < DB_PING_AFTER: return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            self.waits += 1
+            logger.warning(f"DB pool exhausted ({self.maxconn}) — gave up after {self.timeout}s")
+            return None
+        try:
+            pool = self._get_pool()
+            for _ in range(2):
+                conn = pool.getconn()
+                if self._healthy(conn):
+                    with self._lock: self._in_use += 1
+                    return conn
+                self.discarded += 1
+                self._last_use.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+        except Exception as e:
+            logger.error(f"DB connect error: {e}")
+        self._slots.release()
+        return None
+
+    def _release(self, conn):
+        close = conn.closed != 0
+        if not close:
+            try:    conn.rollback()           # end any transaction the caller left open
+            except Exception: close = True
+        try:
+            if self._pid == os.getpid():
+                if close: self._last_use.pop(id(conn), None)
+                else:     self._last_use[id(conn)] = time.time()
+                self._pool.putconn(conn, close=close)
+            else:
+                conn.close()
+        except Exception:
+            pass
+        finally:
+            with self._lock: self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Yields a live connection, or None if the DB is unreachable / pool exhausted."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn is not None: self._release(conn)
+
+    def stats(self):
+        return {"max": self.maxconn, "in_use": self._in_use,
+                "timeouts": self.waits, "discarded": self.discarded}
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.closeall()
+            self._pool = None
@@ -0,0 +1,125 @@
+"""
+core/formats.py
+===============
+Output formats for rendered cards.
+  - negotiate() picks AVIF / WebP when the client accepts them, else JPEG
+  - JPEG is progressive + optimized (first paint before the last byte arrives)
+  - quality per format, nudged per ratio and device type (CARD_QUALITY)
+  - encode() can also encode a baseline JPEG q95 for a sample of cards, so
+    stats() can report the bytes saved against the old fixed output
+"""
+
+import os, random, threading
+from io import BytesIO
+from PIL import features
+
+CARD_FORMATS    = [f for f in os.getenv("CARD_FORMATS", "webp,avif,jpeg").split(",") if f]   # server preference;
+                  # webp first: ~5x cheaper to encode than AVIF for ~15% more bytes
+CARD_QUALITY    = os.getenv("CARD_QUALITY", "")           # e.g. "avif=50,webp=78,jpeg=82,mobile=-5,9:16=-3"
+BASELINE_SAMPLE = float(os.getenv("CARD_BASELINE_SAMPLE", 0.05))   # fraction of cards also encoded as JPEG q95
+BASELINE_Q      = 95
+
+MIME = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg"}
+EXT  = {"avif": "avif", "webp": "webp", "jpeg": "jpg"}
+
+# base quality per format; + per-device and per-ratio offsets
+QUALITY = {"avif": 55, "webp": 80, "jpeg": 85}
+ADJUST  = {"mobile": -5, "tablet": -3, "9:16": -3}
+
+for part in CARD_QUALITY.split(","):
+    k, _, v = part.partition("=")
+    try:    (QUALITY if k.strip() in QUALITY else ADJUST)[k.strip()] = int(v)
+    except ValueError: pass
+
+AVAILABLE = ["jpeg"] + [f for f in ("webp", "avif") if features.check(f)]
+
+
+def quality_for(fmt, ratio='1:1', device='desktop'):
+    q = QUALITY.get(fmt, 85) + ADJUST.get(device, 0) + ADJUST.get(ratio, 0)
+    return max(20, min(95, q))
+
+
+def _accepted(accept):
+    """{'image/webp': 1.0, ...} from an Accept header."""
+    out = {}
+    for item in (accept or "").split(","):
+        mime, *params = [p.strip() for p in item.split(";")]
+        q = 1.0
+        for p in params:
+            if p.startswith("q="):
+                try:    q = float(p[2:])
+                except ValueError: q = 0.0
+        if mime: out[mime.lower()] = q
+    return out
+
+
+def negotiate(accept, requested=None):
+    """
+    Output format for a client: the first of CARD_FORMATS that we can encode and
+    the client can decode. `requested` ("avif,webp" from a ?fmt= param, for clients
+    that can't set Accept, like EventSource) replaces the Accept header. AVIF/WebP
+    need an explicit image/avif / image/webp — */* alone gets JPEG.
+    """
+    if requested:
+        client = {f.strip() for f in requested.split(",")}
+    else:
+        acc    = _accepted(accept)
+        client = {f for f, mime in MIME.items() if acc.get(mime, 0) > 0}
+    for fmt in CARD_FORMATS:
+        if fmt in AVAILABLE and (fmt == "jpeg" or fmt in client): return fmt
+    return "jpeg"
+
+
+def sniff(data):
+    """Format of encoded card bytes, from the file signature."""
+    if data[:3] == b"\xff\xd8\xff":                      return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":      return "webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis"): return "avif"
+    return None
+
+
+def encode(img, fmt="jpeg", quality=None, baseline=None):
+    """
+    Encode an RGB image → (bytes, baseline_len). baseline_len is the size of the
+    same card as JPEG q95 for a sampled fraction of calls, else None.
+    """
+    quality = quality_for(fmt) if quality is None else quality
+    buf = BytesIO()
+    if fmt == "avif":   img.save(buf, "AVIF", quality=quality, speed=8)
+    elif fmt == "webp": img.save(buf, "WEBP", quality=quality, method=4)
+    else:               img.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+    base_len = None
+    if random.random() < BASELINE_SAMPLE if baseline is None else baseline:
+        ref = BytesIO()
+        img.save(ref, "JPEG", quality=BASELINE_Q)
+        base_len = ref.tell()
+    return buf.getvalue(), base_len
+
+
+class FormatStats:
+    """Per-format output counters; bytes saved is extrapolated from the sampled baselines."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.m = {}
+
+    def record(self, fmt, size, base_len=None):
+        with self._lock:
+            st = self.m.setdefault(fmt, {"cards": 0, "bytes": 0, "sampled": 0, "sampled_bytes": 0, "baseline_bytes": 0})
+            st["cards"] += 1
+            st["bytes"] += size
+            if base_len:
+                st["sampled"]        += 1
+                st["sampled_bytes"]  += size
+                st["baseline_bytes"] += base_len
+
+    def stats(self):
+        out = {}
+        with self._lock:
+            for fmt, st in self.m.items():
+                ratio = 1 - st["sampled_bytes"] / st["baseline_bytes"] if st["baseline_bytes"] else None
+                out[fmt] = {"cards": st["cards"], "avg_kb": round(st["bytes"] / st["cards"] / 1024, 1),
+                            "saved_pct": round(ratio * 100, 1) if ratio is not None else None,
+                            "saved_mb_est": round(st["bytes"] * ratio / (1 - ratio) / 1024 / 1024, 2)
+                                            if ratio is not None and ratio < 1 else None}
+        return out
@@ -0,0 +1,176 @@
+"""
+core/geo.py
+===========
+IP geolocation backends for analytics.
+  local — memory-mapped IPv4 range file, binary search, no network
+  http  — ip-api.com (free, rate-limited), used as fallback
+Build the range file from a CSV:  python -m core.geo build ranges.csv geo.bin
+Benchmark local vs HTTP:          python -m core.geo bench geo.bin
+"""
+
+import os, sys, csv, mmap, time, random, struct, logging, ipaddress
+from bisect import bisect_right
+
+try:
+    import requests as req_lib
+    HTTP_ENABLED = True
+except ImportError:
+    HTTP_ENABLED = False
+
+logger = logging.getLogger(__name__)
+
+GEO_BACKEND = os.getenv("GEO_BACKEND", "auto")        # auto | local | http | local+http
+GEO_DB_PATH = os.getenv("GEO_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "geo.bin"))
+
+# File layout (little-endian):
+#   header  : MAGIC, n_ranges u32, n_records u32
+#   starts  : n_ranges  x u32   (sorted)
+#   ends    : n_ranges  x u32
+#   rec_idx : n_ranges  x u32   → index into records
+#   offsets : n_records+1 x u32 → byte offsets into blob
+#   blob    : "country\tcountry_code\tcity" UTF-8 records, concatenated
+MAGIC  = b"RGEODB1\0"
+HEADER = struct.Struct("<8sII")
+
+
+def _ip_int(v):
+    v = str(v).strip()
+    return int(v) if v.isdigit() else int(ipaddress.IPv4Address(v))
+
+
+def build_geo_db(csv_path, out_path, cols=("start", "end", "country_code", "country", "city")):
+    """
+    Convert a CSV of IPv4 ranges into the binary range file.
+    Columns are positional, in `cols` order; start/end may be dotted IPs or integers.
+    Rows that are IPv6 or malformed are skipped. Returns number of ranges written.
+    """
+    ix = {c: i for i, c in enumerate(cols)}
+    ranges, records, rec_ids = [], [], {}
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            try:
+                start, end = _ip_int(row[ix["start"]]), _ip_int(row[ix["end"]])
+            except (ValueError, IndexError):
+                continue                          # header / IPv6 / junk
+            rec = "\t".join(row[ix[c]].strip().replace("\t", " ") if c in ix and ix[c] < len(row) else ""
+                            for c in ("country", "country_code", "city"))
+            if rec not in rec_ids:
+                rec_ids[rec] = len(records)
+                records.append(rec.encode("utf-8"))
+            ranges.append((start, end, rec_ids[rec]))
+    ranges.sort()
+
+    offsets, pos = [], 0
+    for r in records:
+        offsets.append(pos)
+        pos += len(r)
+    offsets.append(pos)
+
+    n = len(ranges)
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, n, len(records)))
+        for col in range(3):
+            f.write(struct.pack(f"<{n}I", *(r[col] for r in ranges)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(b"".join(records))
+    os.replace(tmp, out_path)
+    return n
+
+
+class LocalGeoDB:
+    """Read-only view over a range file. Lookups are a bisect over mmapped u32 arrays."""
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise RuntimeError("geo range file is little-endian; native u32 view needs a little-endian host")
+        self._f  = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, nrec = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC: raise ValueError(f"{path}: not a geo range file")
+        mv  = memoryview(self._mm)
+        off = HEADER.size
+        self.starts  = mv[off:off + 4*n].cast("I");               off += 4*n
+        self.ends    = mv[off:off + 4*n].cast("I");               off += 4*n
+        self.rec_idx = mv[off:off + 4*n].cast("I");               off += 4*n
+        self.offsets = mv[off:off + 4*(nrec+1)].cast("I");        off += 4*(nrec+1)
+        self.blob    = off
+        self.size    = n
+
+    def lookup(self, ip):
+        """(raw, country, country_code, city) or None if not covered / not IPv4."""
+        try:    n = int(ipaddress.IPv4Address(ip))
+        except ValueError: return None
+        i = bisect_right(self.starts, n) - 1
+        if i < 0 or n > self.ends[i]: return None
+        r = self.rec_idx[i]
+        a, b = self.offsets[r], self.offsets[r+1]
+        country, cc, city = self._mm[self.blob + a:self.blob + b].decode("utf-8").split("\t")
+        raw = {"status": "success", "country": country, "countryCode": cc, "city": city, "source": "local"}
+        return raw, country or 'Unknown', cc, city or 'Unknown'
+
+
+def http_lookup(ip):
+    """ip-api.com lookup — (raw, country, country_code, city) or None on failure."""
+    if not HTTP_ENABLED: return None
+    try:
+        r = req_lib.get(f'http://ip-api.com/json/{ip}', timeout=2)
+        d = r.json()
+        if d.get('status') == 'success':
+            return d, d.get('country', 'Unknown'), d.get('countryCode', ''), d.get('city', 'Unknown')
+    except Exception: pass
+    return None
+
+
+def make_geo_lookup(backend=GEO_BACKEND, db_path=GEO_DB_PATH):
+    """
+    Build the lookup chain for `backend`:
+      local       → range file only
+      http        → ip-api.com only
+      local+http  → range file, ip-api.com on miss
+      auto        → local+http if the range file exists, else http
+    """
+    if backend == "auto":
+        backend = "local+http" if os.path.exists(db_path) else "http"
+    chain = []
+    if "local" in backend:
+        try:
+            db = LocalGeoDB(db_path)
+            chain.append(db.lookup)
+            logger.info(f"Geo: local range file {db_path} ({db.size} ranges)")
+        except Exception as e:
+            logger.error(f"Geo: local range file unavailable ({e}) — falling back to HTTP")
+            if "http" not in backend: backend += "+http"
+    if "http" in backend:
+        chain.append(http_lookup)
+
+    def lookup(ip):
+        for fn in chain:
+            geo = fn(ip)
+            if geo: return geo
+        return None
+    lookup.backend = backend
+    return lookup
+
+
+def _bench(db_path, n=100000, http_n=5):
+    db  = LocalGeoDB(db_path)
+    ips = [str(ipaddress.IPv4Address(random.getrandbits(32))) for _ in range(n)]
+    t0  = time.perf_counter()
+    hits = sum(1 for ip in ips if db.lookup(ip))
+    local_us = (time.perf_counter() - t0) / n * 1e6
+    print(f"local : {n} lookups, {hits} hits, {local_us:.2f} µs/lookup")
+    t0 = time.perf_counter()
+    ok = sum(1 for ip in ips[:http_n] if http_lookup(ip))
+    http_ms = (time.perf_counter() - t0) / http_n * 1000
+    print(f"http  : {http_n} lookups, {ok} ok, {http_ms:.1f} ms/lookup")
+    if local_us: print(f"speedup ≈ {http_ms * 1000 / local_us:,.0f}x")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "build":
+        print(f"Wrote {build_geo_db(sys.argv[2], sys.argv[3])} ranges → {sys.argv[3]}")
+    elif len(sys.argv) >= 3 and sys.argv[1] == "bench":
+        _bench(sys.argv[2], *(int(a) for a in sys.argv[3:5]))
+    else:
+        print(__doc__)
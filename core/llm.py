@@ -0,0 +1,195 @@
+"""
+core/llm.py
+===========
+Model router for roast completions.
+  - per-model timeout, latency window (p50/p95) and error counts
+  - circuit breaker: a model that keeps failing is skipped for a cooldown
+  - hedging (AI_HEDGE=1, off by default): if the primary hasn't answered by
+    its p95, the next model is launched in a small separate pool and the first
+    valid result wins. Hedges are bounded by AI_HEDGE_WORKERS slots and an
+    AI_HEDGE_RATE budget (never queued); a losing call that hasn't started is
+    cancelled. Without hedging every call runs on the request thread
+"""
+
+import os, time, logging, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+AI_HEDGE          = os.getenv("AI_HEDGE", "0") == "1"
+AI_MODEL_TIMEOUT  = float(os.getenv("AI_MODEL_TIMEOUT", 12))      # secs per model call
+AI_HEDGE_MIN_MS   = int(os.getenv("AI_HEDGE_MIN_MS", 400))
+AI_HEDGE_MAX_MS   = int(os.getenv("AI_HEDGE_MAX_MS", 4000))
+AI_HEDGE_DEFAULT  = int(os.getenv("AI_HEDGE_DEFAULT_MS", 2500))    # until a model has enough samples
+AI_BREAKER_FAILS  = int(os.getenv("AI_BREAKER_FAILS", 3))          # consecutive failures to open
+AI_BREAKER_COOL   = int(os.getenv("AI_BREAKER_COOLDOWN", 60))      # secs a model stays skipped
+AI_WORKERS        = int(os.getenv("AI_WORKERS", 16))              # primaries in flight when hedging
+AI_HEDGE_WORKERS  = int(os.getenv("AI_HEDGE_WORKERS", 4))        # concurrent hedges; beyond that none are sent
+AI_HEDGE_RATE     = float(os.getenv("AI_HEDGE_RATE", 0.1))        # max hedges per primary call, on average
+
+
+class ModelStats:
+    def __init__(self, window=200):
+        self.lat         = deque(maxlen=window)
+        self.calls       = 0
+        self.errors      = 0
+        self.timeouts    = 0
+        self.wins        = 0
+        self.fails_row   = 0
+        self.open_until  = 0.0
+        self.lock        = threading.Lock()
+
+    def pct(self, p):
+        with self.lock: s = sorted(self.lat)
+        return s[min(len(s) - 1, int(len(s) * p))] if s else None
+
+    def snapshot(self):
+        return {"calls": self.calls, "errors": self.errors, "timeouts": self.timeouts, "wins": self.wins,
+                "p50_ms": self.pct(0.5), "p95_ms": self.pct(0.95),
+                "breaker": "open" if self.open_until > time.time() else "closed"}
+
+
+class ModelRouter:
+    def __init__(self, models, hedge=AI_HEDGE, timeout=AI_MODEL_TIMEOUT):
+        self.models  = list(models)
+        self.hedge   = hedge
+        self.timeout = timeout
+        self.stats   = {m: ModelStats() for m in self.models}
+        self.hedges  = 0
+        self.hedge_wins     = 0
+        self.hedges_skipped = 0                  # over budget or no free slot
+        self._tokens        = float(AI_HEDGE_WORKERS)
+        self._hedge_lock    = threading.Lock()
+        self._hedge_slots   = threading.BoundedSemaphore(AI_HEDGE_WORKERS)
+        self._hedge_pool    = ThreadPoolExecutor(max_workers=AI_HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+        self._pool          = None
+
+    # ── bookkeeping ──────────────────────────────────────────
+    def record(self, model, ms, ok, timed_out=False):
+        st = self.stats[model]
+        with st.lock:
+            st.calls += 1
+            if ok:
+                st.lat.append(ms)
+                st.fails_row = 0
+                return
+            st.errors   += 1
+            st.timeouts += int(timed_out)
+            st.fails_row += 1
+            if st.fails_row >= AI_BREAKER_FAILS:
+                st.open_until = time.time() + AI_BREAKER_COOL
+                logger.warning(f"LLM breaker open for {model} ({st.fails_row} failures in a row)")
+
+    def order(self):
+        """Models with a closed breaker, in priority order (all of them if every breaker is open)."""
+        now  = time.time()
+        live = [m for m in self.models if self.stats[m].open_until <= now]
+        return live or list(self.models)
+
+    def hedge_delay(self, model):
+        st = self.stats[model]
+        p95 = st.pct(0.95) if len(st.lat) >= 20 else AI_HEDGE_DEFAULT
+        return max(AI_HEDGE_MIN_MS, min(AI_HEDGE_MAX_MS, p95)) / 1000
+
+    def _attempt(self, call, model):
+        t0 = time.time()
+        try:
+            result = call(model, self.timeout)
+        except Exception:
+            ms = int((time.time() - t0) * 1000)
+            self.record(model, ms, False, timed_out=ms >= self.timeout * 1000 * 0.95)
+            raise
+        self.record(model, int((time.time() - t0) * 1000), True)
+        return result
+
+    # ── hedging ──────────────────────────────────────────────
+    def _take_hedge(self):
+        """One hedge from the budget (AI_HEDGE_RATE tokens accrue per call) and a free hedge slot."""
+        with self._hedge_lock:
+            if self._tokens < 1 or not self._hedge_slots.acquire(blocking=False):
+                self.hedges_skipped += 1
+                return False
+            self._tokens -= 1
+            return True
+
+    def _primary_pool(self):
+        """Primaries only need a pool when hedging is on; sized like the request concurrency."""
+        if self._pool is None:
+            with self._hedge_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix="llm")
+        return self._pool
+
+    def _hedged(self, call, model):
+        try:
+            return self._attempt(call, model)
+        finally:
+            self._hedge_slots.release()
+
+    # ── entry point ──────────────────────────────────────────
+    def run(self, call):
+        """
+        call(model, timeout) → result, raising on failure / invalid output.
+        Returns the first valid result; raises RuntimeError if every model fails.
+        """
+        order = self.order()
+        if self.hedge and len(order) > 1:
+            return self._run_hedged(call, order)
+        for model in order:
+            try:
+                result = self._attempt(call, model)
+                self.stats[model].wins += 1
+                return result
+            except Exception as e:
+                logger.warning(f"LLM {model} failed: {e}")
+        raise RuntimeError("all models failed")
+
+    def _run_hedged(self, call, order):
+        """
+        The primary runs as a future; if it hasn't answered by its hedge delay the
+        next model is started in the hedge pool (budget allowing) and the first
+        valid result wins. The rest of the order is tried only if both fail.
+        """
+        primary, spare = order[0], order[1]
+        with self._hedge_lock: self._tokens = min(AI_HEDGE_WORKERS, self._tokens + AI_HEDGE_RATE)
+        pending  = {self._primary_pool().submit(self._attempt, call, primary): primary}
+        deadline = time.time() + self.timeout
+        hedged   = tried_spare = False
+        while pending:
+            left = deadline - time.time()
+            if left <= 0: break
+            done, _ = wait(pending, timeout=left if hedged else min(left, self.hedge_delay(primary)),
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                if hedged: break
+                hedged = True
+                if self._take_hedge():
+                    self.hedges += 1
+                    tried_spare = True
+                    logger.info(f"LLM hedge: {primary} slow, launching {spare}")
+                    pending[self._hedge_pool.submit(self._hedged, call, spare)] = spare
+                    deadline = time.time() + self.timeout
+                continue
+            for f in done:
+                model = pending.pop(f)
+                if f.exception() is None:
+                    self.stats[model].wins += 1
+                    if model == spare: self.hedge_wins += 1
+                    for other, m in pending.items():            # the loser: drop it if it hasn't started
+                        if other.cancel() and m == spare: self._hedge_slots.release()
+                    return f.result()
+                logger.warning(f"LLM {model} failed: {f.exception()}")
+        for model in order[2:] if tried_spare else order[1:]:
+            try:
+                result = self._attempt(call, model)
+                self.stats[model].wins += 1
+                return result
+            except Exception as e:
+                logger.warning(f"LLM {model} failed: {e}")
+        raise RuntimeError("all models failed")
+
+    def metrics(self):
+        return {"hedge": self.hedge, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                "hedges_skipped": self.hedges_skipped,
+                "models": {m: st.snapshot() for m, st in self.stats.items()}}
@@ -0,0 +1,259 @@
+"""
+core/migrations.py
+==================
+Versioned schema migrations.
+Each migration runs once, in version order; applied versions are recorded in
+schema_migrations. Worker boot applies the pending transactional migrations
+(tables, columns, small indexes) under the lock, so a plain deploy comes up with
+the schema the code needs; CONCURRENTLY index builds are left to the deploy step
+`python -m core.migrations up` (boot warns while any are pending). Set
+DB_MIGRATE_ON_BOOT=0 to only check at boot, =all to build indexes too. Concurrent runners take turns on an
+advisory lock, polled with pg_try_advisory_lock so a waiter holds no snapshot
+that a CREATE INDEX CONCURRENTLY would have to wait for. Index migrations build
+CONCURRENTLY (outside a transaction) so writes to the live tables aren't blocked.
+Apply pending:         python -m core.migrations up
+Show versions:         python -m core.migrations status
+Backfills that scan whole tables are offline commands, not migration steps
+(e.g. python -m core.rollups rebuild after migration 3).
+"""
+
+import os, sys, time, logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY          = 0x526F6173     # pg_advisory_lock key shared by every app process
+MIGRATE_ON_BOOT   = os.getenv("DB_MIGRATE_ON_BOOT", "1")            # 1: transactional only | all | 0: check only
+MIGRATE_LOCK_WAIT = float(os.getenv("DB_MIGRATE_LOCK_WAIT", 600))   # secs to wait for another runner
+MIGRATE_BOOT_WAIT = float(os.getenv("DB_MIGRATE_BOOT_WAIT", 60))    # same, at worker boot (an index build may hold it)
+
+Migration = namedtuple("Migration", "version name statements transactional")
+
+MIGRATIONS = [
+    Migration(1, "base tables", [
+        '''CREATE TABLE IF NOT EXISTS roasts (
+            id SERIAL PRIMARY KEY, topic VARCHAR(255), label VARCHAR(100),
+            roast TEXT, language VARCHAR(20), created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS stats (
+            id SERIAL PRIMARY KEY, total_roasts INTEGER DEFAULT 0)''',
+        '''INSERT INTO stats (total_roasts) SELECT 52341 WHERE NOT EXISTS (SELECT 1 FROM stats)''',
+        '''CREATE TABLE IF NOT EXISTS analytics (
+            id SERIAL PRIMARY KEY, topic VARCHAR(255), label VARCHAR(100),
+            roast_text TEXT, language VARCHAR(20), quality INTEGER, quality_name VARCHAR(20),
+            ip_address VARCHAR(45), country VARCHAR(100), country_code VARCHAR(10), city VARCHAR(100),
+            user_agent TEXT, device_type VARCHAR(20), response_ms INTEGER,
+            success BOOLEAN DEFAULT TRUE, error_msg TEXT, session_id VARCHAR(100),
+            hour_of_day INTEGER, day_of_week INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS battles (
+            id SERIAL PRIMARY KEY, battle_id VARCHAR(20) UNIQUE NOT NULL,
+            topic VARCHAR(255), mode VARCHAR(10) DEFAULT 'normal',
+            status VARCHAR(20) DEFAULT 'pending',
+            challenger_id VARCHAR(100), challenger_name VARCHAR(100),
+            opponent_id VARCHAR(100), opponent_name VARCHAR(100),
+            winner_id VARCHAR(100), loser_id VARCHAR(100),
+            total_rounds INTEGER DEFAULT 0, loss_reason VARCHAR(20),
+            card_url TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            accepted_at TIMESTAMP, ended_at TIMESTAMP, expires_at TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS battle_rounds (
+            id SERIAL PRIMARY KEY, battle_id VARCHAR(20) REFERENCES battles(battle_id),
+            round_num INTEGER, player_id VARCHAR(100), player_name VARCHAR(100),
+            roast_text TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS push_subscriptions (
+            id SERIAL PRIMARY KEY, session_id VARCHAR(100) UNIQUE,
+            endpoint TEXT, p256dh TEXT, auth TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS user_roast_count (
+            session_id VARCHAR(100) PRIMARY KEY,
+            roast_count INTEGER DEFAULT 0, gali_unlocked BOOLEAN DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ], True),
+
+    # user_roast_count.session_id (PK) and push_subscriptions.session_id (UNIQUE)
+    # are already indexed by their constraints.
+    Migration(2, "indexes for battles, rounds and analytics", [
+        # rounds of one battle: ORDER BY round_num and COUNT(*) are both index-only
+        '''CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_battle_rounds_battle_round
+            ON battle_rounds (battle_id, round_num)''',
+        # recent roasts, roast pool demand, success filters
+        '''CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analytics_success_created
+            ON analytics (success, created_at)''',
+        # created_at::date = CURRENT_DATE (today's roasts; dropped again in 8)
+        '''CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analytics_day_ok
+            ON analytics ((created_at::date)) WHERE success''',
+        # recent battles list + status counts on the dashboards
+        '''CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_battles_created
+            ON battles (created_at)''',
+        '''CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_battles_status
+            ON battles (status)''',
+    ], False),
+
+    # dashboard rollups (core/rollups.py) — new events land via AnalyticsWriter; backfill the
+    # existing ones offline afterwards:  python -m core.rollups rebuild
+    Migration(3, "analytics rollups", [
+        '''CREATE TABLE IF NOT EXISTS analytics_rollup (
+            period VARCHAR(10), dim VARCHAR(10), value VARCHAR(255),
+            events BIGINT DEFAULT 0, ok BIGINT DEFAULT 0, ms_sum BIGINT DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (period, dim, value))''',
+        # top-N per dimension without sorting every topic ever seen
+        '''CREATE INDEX IF NOT EXISTS idx_rollup_top ON analytics_rollup (period, dim, ok DESC)''',
+        '''CREATE TABLE IF NOT EXISTS analytics_hll (
+            period VARCHAR(10) PRIMARY KEY, registers BYTEA,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ], True),
+
+    # rounds used to be numbered COUNT(*)+1, so concurrent moves could share a number
+    Migration(4, "renumber battle rounds", [
+        '''UPDATE battle_rounds r SET round_num = n.rn
+            FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY battle_id ORDER BY round_num, created_at, id) AS rn
+                  FROM battle_rounds) n
+            WHERE r.id = n.id AND r.round_num IS DISTINCT FROM n.rn''',
+        '''UPDATE battles b SET total_rounds = c.n
+            FROM (SELECT battle_id, COUNT(*) AS n FROM battle_rounds GROUP BY battle_id) c
+            WHERE b.battle_id = c.battle_id AND b.total_rounds IS DISTINCT FROM c.n''',
+    ], True),
+
+    Migration(5, "unique round numbers per battle", [
+        '''CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_battle_rounds_battle_round
+            ON battle_rounds (battle_id, round_num)''',
+        '''DROP INDEX CONCURRENTLY IF EXISTS idx_battle_rounds_battle_round''',
+    ], False),
+
+    # battle snapshots (core/battles.py) are versioned; the trigger covers every writer
+    Migration(6, "battles.version", [
+        '''ALTER TABLE battles ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0''',
+        '''CREATE OR REPLACE FUNCTION battles_bump_version() RETURNS trigger AS $$
+            BEGIN
+                NEW.version := OLD.version + 1;
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql''',
+        '''DROP TRIGGER IF EXISTS battles_version ON battles''',
+        '''CREATE TRIGGER battles_version BEFORE UPDATE ON battles
+            FOR EACH ROW EXECUTE FUNCTION battles_bump_version()''',
+    ], True),
+
+    # pre-generated roasts shared by every worker (core/roast_pool.py) + the refiller lease
+    Migration(7, "shared roast pool", [
+        '''CREATE TABLE IF NOT EXISTS roast_pool (
+            id BIGSERIAL PRIMARY KEY, topic_key VARCHAR(255), language VARCHAR(20), quality INTEGER,
+            label VARCHAR(100), roast TEXT, digest BYTEA,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE INDEX IF NOT EXISTS idx_roast_pool_bucket ON roast_pool (topic_key, language, quality, id)''',
+        '''CREATE TABLE IF NOT EXISTS roast_pool_lease (
+            id INTEGER PRIMARY KEY, holder TEXT, until TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''INSERT INTO roast_pool_lease (id, holder) VALUES (1, '') ON CONFLICT (id) DO NOTHING''',
+    ], True),
+
+    # today's roasts come from analytics_rollup now; nothing filters on created_at::date
+    Migration(8, "drop idx_analytics_day_ok", [
+        '''DROP INDEX CONCURRENTLY IF EXISTS idx_analytics_day_ok''',
+    ], False),
+]
+
+
+def _drop_invalid(cur, sql):
+    """A failed CONCURRENTLY build leaves an INVALID index that IF NOT EXISTS would keep."""
+    if "CONCURRENTLY" not in sql or "IF NOT EXISTS" not in sql: return
+    name = sql.split("IF NOT EXISTS", 1)[1].split()[0]
+    cur.execute('''SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                   WHERE c.relname = %s AND NOT i.indisvalid''', (name,))
+    if cur.fetchone():
+        logger.warning(f"Migrations: dropping invalid index {name} before rebuilding it")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def _lock(conn, wait=MIGRATE_LOCK_WAIT):
+    """Poll for the advisory lock between sleeps — a blocked pg_advisory_lock() call keeps a snapshot open."""
+    cur, deadline = conn.cursor(), time.time() + wait
+    while True:
+        cur.execute('SELECT pg_try_advisory_lock(%s) AS ok', (LOCK_KEY,))
+        r = cur.fetchone()
+        if (r['ok'] if isinstance(r, dict) else r[0]): return
+        if time.time() > deadline: raise RuntimeError(f"migration lock still held after {wait:.0f}s")
+        time.sleep(0.5)
+
+
+def applied_versions(cur):
+    cur.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY, name TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    cur.execute('SELECT version FROM schema_migrations')
+    return {r['version'] if isinstance(r, dict) else r[0] for r in cur.fetchall()}
+
+
+def migrate(conn, migrations=MIGRATIONS, transactional_only=False, wait=MIGRATE_LOCK_WAIT):
+    """
+    Apply pending migrations on `conn`; returns the names applied. A statement is
+    SQL, or a callable(conn) for data steps that need Python (e.g. backfills).
+    transactional_only skips the CONCURRENTLY ones (worker boot) — they only add
+    or drop indexes, so the rest can go ahead of them.
+    """
+    done, autocommit = [], conn.autocommit
+    conn.rollback()
+    conn.autocommit = True                      # the advisory lock is per session, not per transaction
+    _lock(conn, wait)
+    try:
+        have = applied_versions(conn.cursor())
+        for m in sorted(migrations, key=lambda m: m.version):
+            if m.version in have or (transactional_only and not m.transactional): continue
+            logger.info(f"Migrations: applying {m.version} — {m.name}")
+            conn.autocommit = not m.transactional   # CONCURRENTLY can't run inside a transaction
+            cur = conn.cursor()
+            try:
+                for step in m.statements:
+                    if callable(step):
+                        step(conn)
+                        continue
+                    if not m.transactional: _drop_invalid(cur, step)
+                    cur.execute(step)
+                cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (m.version, m.name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                if not m.transactional:             # don't leave a half-built INVALID index behind
+                    for step in m.statements:
+                        if isinstance(step, str):
+                            try:    _drop_invalid(cur, step)
+                            except Exception: pass
+                raise
+            finally:
+                conn.autocommit = True
+            done.append(f"{m.version}:{m.name}")
+    finally:
+        conn.cursor().execute('SELECT pg_advisory_unlock(%s)', (LOCK_KEY,))
+        conn.autocommit = autocommit
+    return done
+
+
+def pending(conn, migrations=MIGRATIONS):
+    """Migrations not applied yet (read-only — doesn't create schema_migrations)."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass('schema_migrations') AS t")
+        r = cur.fetchone()
+        have = set()
+        if (r['t'] if isinstance(r, dict) else r[0]):
+            cur.execute('SELECT version FROM schema_migrations')
+            have = {r['version'] if isinstance(r, dict) else r[0] for r in cur.fetchall()}
+    finally:
+        conn.rollback()
+    return [m for m in sorted(migrations, key=lambda m: m.version) if m.version not in have]
+
+
+if __name__ == "__main__":
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd not in ("up", "migrate", "status"):
+        print(__doc__)
+        sys.exit(0)
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+    if cmd in ("up", "migrate"):
+        print("\n".join(migrate(conn)) or "up to date")
+    else:
+        have = applied_versions(conn.cursor())
+        conn.commit()
+        for m in MIGRATIONS:
+            print(f"{'x' if m.version in have else ' '} {m.version:3d}  {m.name}")
@@ -0,0 +1,194 @@
+"""
+core/render.py
+==============
+Render service — roast cards and battle cards are drawn in a pool of worker
+processes, so CPU-bound Pillow work scales across cores instead of queueing
+behind the GIL in the Flask request threads.
+  - workers are warm: each decodes the meme templates and loads its fonts once
+  - jobs are submitted with a timeout and come back as encoded bytes in the
+    negotiated format (core/formats.py)
+  - queue depth, queue wait, per-job render time and bytes per format are
+    reported in stats()
+RENDER_WORKERS is per web worker — every gunicorn worker starts its own pool — so
+the default splits the cores (less one) between WEB_CONCURRENCY web workers, max
+4 each. RENDER_WORKERS=0 renders inline in the calling thread (same job functions).
+Workers are started from a forkserver (spawn where there is none), never forked
+from the app: by the time the first card is rendered the app process runs
+writer / flusher / upload threads, and a fork would copy their held locks.
+Template changes reach every worker through the folder mtime check (see
+TemplateRegistry.mark_changed), in every app process.
+"""
+
+import os, time, logging, threading, multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from core.templates import TemplateRegistry
+from core.roast_card import compose_roast_card
+from core.formats import encode, FormatStats
+
+logger = logging.getLogger(__name__)
+
+WEB_CONCURRENCY  = int(os.getenv("WEB_CONCURRENCY", 1))        # gunicorn web workers on this host
+RENDER_WORKERS   = int(os.getenv("RENDER_WORKERS",             # per web worker
+                                 max(1, min(4, ((os.cpu_count() or 2) - 1) // max(1, WEB_CONCURRENCY)))))
+RENDER_TIMEOUT   = float(os.getenv("RENDER_TIMEOUT", 10))      # secs a request waits for its card
+RENDER_QUEUE_MAX = int(os.getenv("RENDER_QUEUE_MAX", 64))      # jobs in flight before new ones are refused
+RENDER_START     = os.getenv("RENDER_START_METHOD",             # workers re-import __main__ (guarded in app.py)
+                             "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+# ── worker side ──────────────────────────────────────────────
+_registry = None       # TemplateRegistry of this process
+
+
+def _init_worker(folder, budget_mb):
+    global _registry
+    _registry = TemplateRegistry(folder, budget_mb)
+    _registry.preload()
+    names = _registry.names()
+    try:                                          # first render loads fonts + lazy Pillow plugins
+        if names: _roast_job(names[0], "WARM UP", "warm up the fonts", '1:1', 'jpeg', 85)
+    except Exception as e:
+        logger.warning(f"Render worker warm-up failed: {e}")
+
+
+def _roast_job(meme, label, roast_text, ratio, fmt, quality):
+    _registry.check()                             # picks up a reload broadcast via the folder mtime
+    t0  = time.perf_counter()
+    img = compose_roast_card(_registry.view(meme), label, roast_text, ratio)
+    data, base_len = encode(img, fmt, quality)
+    return data, (time.perf_counter() - t0) * 1000, base_len
+
+
+def _battle_job(battle_data, fmt, quality):
+    from core.battle_card import compose_battle_card    # optional module, like in app.py
+    t0 = time.perf_counter()
+    data, base_len = encode(compose_battle_card(battle_data), fmt, quality)
+    return data, (time.perf_counter() - t0) * 1000, base_len
+
+
+# ── request side ─────────────────────────────────────────────
+def _pct(window, p):
+    s = sorted(window)
+    return round(s[min(len(s) - 1, int(len(s) * p))], 1) if s else None
+
+
+class RenderPool:
+    """
+    registry — the app's TemplateRegistry; workers open their own copy of its folder.
+    roast_card(...) / battle_card(...) → encoded bytes, raising RuntimeError on
+    timeout, a full queue or a dead worker.
+    """
+
+    def __init__(self, registry, workers=RENDER_WORKERS, timeout=RENDER_TIMEOUT, queue_max=RENDER_QUEUE_MAX):
+        self.registry  = registry
+        self.workers   = workers
+        self.timeout   = timeout
+        self.queue_max = queue_max
+        self.enabled   = workers > 0
+        self._exec     = None
+        self._pid      = None
+        self._inflight = 0
+        self._lock     = threading.Lock()
+        self.job_ms    = deque(maxlen=500)
+        self.wait_ms   = deque(maxlen=500)
+        self.formats   = FormatStats()
+        self.m = {"submitted": 0, "completed": 0, "failed": 0, "timeouts": 0, "rejected": 0, "restarts": 0}
+        if not self.enabled:
+            global _registry
+            _registry = registry
+
+    def _executor(self):
+        if self._exec is not None and self._pid == os.getpid(): return self._exec
+        with self._lock:
+            if self._exec is None or self._pid != os.getpid():
+                self._pid  = os.getpid()
+                ctx = multiprocessing.get_context(RENDER_START)
+                if RENDER_START == "forkserver": ctx.set_forkserver_preload(["core.render"])
+                self._exec = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=ctx,
+                    initializer=_init_worker, initargs=(self.registry.folder, self.registry.budget // 1024 // 1024))
+                logger.info(f"Render pool: {self.workers} workers ({RENDER_START})")
+        return self._exec
+
+    def restart(self):
+        """Replace this process's workers (e.g. after one died). Jobs already queued still finish."""
+        with self._lock:
+            old, self._exec = self._exec, None
+            self.m["restarts"] += 1
+        if old is not None and self._pid == os.getpid():
+            old.shutdown(wait=False)
+
+    def _release(self, _fut=None):
+        with self._lock: self._inflight -= 1
+
+    def _submit(self, fn, *args):
+        try:
+            return self._executor().submit(fn, *args)
+        except BrokenProcessPool:
+            logger.error("Render pool broken — restarting workers")
+            self.restart()
+            return self._executor().submit(fn, *args)
+
+    def _run(self, fn, *args, timeout=None):
+        """fn(*args) → (bytes, render_ms, baseline_len); args end with (fmt, quality)."""
+        timeout = self.timeout if timeout is None else timeout
+        t0 = time.perf_counter()
+        if not self.enabled:
+            self.m["submitted"] += 1
+            try:    data, ms, base_len = fn(*args)
+            except Exception:
+                self.m["failed"] += 1
+                raise
+            self._record(args[-2], data, ms, 0, base_len)
+            return data
+        with self._lock:
+            if self._inflight >= self.queue_max:
+                self.m["rejected"] += 1
+                raise RuntimeError(f"render queue full ({self._inflight} jobs)")
+            self._inflight += 1
+            self.m["submitted"] += 1
+        try:
+            fut = self._submit(fn, *args)
+        except Exception:
+            self._release()
+            self.m["failed"] += 1
+            raise
+        fut.add_done_callback(self._release)       # a timed-out job still holds its slot until it ends
+        try:
+            data, ms, base_len = fut.result(timeout=timeout)
+        except FutureTimeout:
+            fut.cancel()
+            self.m["timeouts"] += 1
+            raise RuntimeError(f"render timed out after {timeout}s")
+        except BrokenProcessPool:
+            self.m["failed"] += 1
+            self.restart()
+            raise RuntimeError("render worker died")
+        except Exception:
+            self.m["failed"] += 1
+            raise
+        self._record(args[-2], data, ms, (time.perf_counter() - t0) * 1000 - ms, base_len)
+        return data
+
+    def _record(self, fmt, data, job_ms, wait_ms, base_len):
+        self.m["completed"] += 1
+        self.formats.record(fmt, len(data), base_len)
+        self.job_ms.append(job_ms)
+        self.wait_ms.append(max(0.0, wait_ms))
+
+    # ── jobs ─────────────────────────────────────────────────
+    def roast_card(self, meme, label, roast_text, ratio='1:1', fmt='jpeg', quality=85, timeout=None):
+        """Crop + scale + render + encode one roast card → bytes."""
+        return self._run(_roast_job, meme, label, roast_text, ratio, fmt, quality, timeout=timeout)
+
+    def battle_card(self, battle_data, fmt='jpeg', quality=85, timeout=None):
+        """Battle result card → encoded bytes."""
+        return self._run(_battle_job, battle_data, fmt, quality, timeout=timeout)
+
+    def stats(self):
+        return dict(self.m, enabled=self.enabled, workers=self.workers, queued=self._inflight,
+                    job_p50_ms=_pct(self.job_ms, 0.5), job_p95_ms=_pct(self.job_ms, 0.95),
+                    wait_p95_ms=_pct(self.wait_ms, 0.95), formats=self.formats.stats())
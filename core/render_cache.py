@@ -0,0 +1,186 @@
+"""
+core/render_cache.py
+====================
+Content-addressed cache for rendered cards.
+The key is a hash of everything that decides the output bytes (template file
+identity, text, ratio, format, renderer version), so an entry never goes stale
+and the key doubles as a strong ETag.
+  memory — LRU bounded by total bytes (RENDER_CACHE_MB), per process
+  disk   — RENDER_CACHE_DIR (default <repo>/cache/cards), survives restarts and is
+           shared by gunicorn workers; put it on shared storage when running more
+           than one host. RENDER_CACHE_DIR=off leaves only the per-process memory
+           tier, and `shared` is then False — callers must not hand out card URLs
+           that only this process can serve.
+Concurrent misses for one key render once (the rest wait for it); disk files
+are written under a unique temp name and renamed; the disk tier is pruned on a
+background thread every PRUNE_EVERY writes.
+"""
+
+import os, re, json, hashlib, logging, tempfile, threading
+from collections import OrderedDict
+from core.cache import _Flight
+
+logger = logging.getLogger(__name__)
+
+RENDER_CACHE_MB      = int(os.getenv("RENDER_CACHE_MB", 64))
+RENDER_CACHE_DIR     = os.getenv("RENDER_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "cards"))
+RENDER_CACHE_DISK_MB = int(os.getenv("RENDER_CACHE_DISK_MB", 1024))
+RENDER_VERSION       = 1        # bump when drawing code changes the bytes for the same inputs
+PRUNE_EVERY          = 100      # disk writes between size checks
+RENDER_WAIT          = float(os.getenv("RENDER_WAIT", 30))   # secs to wait for another thread's render
+
+KEY_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def card_key(*parts):
+    """Hex digest of the render inputs (plus RENDER_VERSION); dicts hash key-order independent."""
+    raw = json.dumps([RENDER_VERSION, *parts], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, max_mb=RENDER_CACHE_MB, disk_dir=RENDER_CACHE_DIR, disk_mb=RENDER_CACHE_DISK_MB):
+        self.budget      = max_mb * 1024 * 1024
+        self.disk_dir    = disk_dir if disk_dir and disk_dir.lower() not in ("off", "none") else None
+        self.disk_budget = disk_mb * 1024 * 1024
+        self._mem        = OrderedDict()      # key -> bytes
+        self._bytes      = 0
+        self._writes     = 0
+        self._inflight   = {}                 # key -> _Flight of the render in progress
+        self._pruning    = False
+        self._lock       = threading.Lock()
+        self.m = {"hits": 0, "disk_hits": 0, "misses": 0, "renders": 0, "coalesced": 0, "evictions": 0,
+                  "disk_writes": 0, "disk_pruned": 0, "disk_errors": 0}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    # ── memory tier ──────────────────────────────────────────
+    def _remember(self, key, data):
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None: self._bytes -= len(old)
+            if len(data) > self.budget: return
+            self._mem[key] = data
+            self._bytes   += len(data)
+            while self._bytes > self.budget:
+                _, gone = self._mem.popitem(last=False)
+                self._bytes -= len(gone)
+                self.m["evictions"] += 1
+
+    # ── disk tier ────────────────────────────────────────────
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _disk_read(self, key):
+        try:
+            with open(self._path(key), "rb") as f: return f.read()
+        except FileNotFoundError: return None
+        except OSError as e:
+            self.m["disk_errors"] += 1
+            logger.warning(f"Render cache read {key}: {e}")
+            return None
+
+    def _disk_write(self, key, data):
+        path, tmp = self._path(key), None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{key}.", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f: f.write(data)
+            os.replace(tmp, path)                  # readers never see a half-written card
+            self.m["disk_writes"] += 1
+        except OSError as e:
+            self.m["disk_errors"] += 1
+            logger.warning(f"Render cache write {key}: {e}")
+            if tmp:
+                try:    os.remove(tmp)
+                except OSError: pass
+            return
+        with self._lock:
+            self._writes += 1
+            if self._writes % PRUNE_EVERY != 1 or self._pruning: return
+            self._pruning = True
+        threading.Thread(target=self._prune, name="render-cache-prune", daemon=True).start()
+
+    def _prune(self):
+        """Delete the least recently written files until the disk tier is under budget."""
+        try:     self._prune_disk()
+        except Exception as e: logger.warning(f"Render cache prune: {e}")
+        finally: self._pruning = False
+
+    def _prune_disk(self):
+        files, total = [], 0
+        for root, _, names in os.walk(self.disk_dir):
+            for n in names:
+                p = os.path.join(root, n)
+                try:    st = os.stat(p)
+                except OSError: continue
+                files.append((st.st_mtime, st.st_size, p))
+                total += st.st_size
+        files.sort()
+        for _, size, p in files:
+            if total <= self.disk_budget * 0.9: break
+            try:    os.remove(p)
+            except OSError: continue
+            total -= size
+            self.m["disk_pruned"] += 1
+
+    # ── entry points ─────────────────────────────────────────
+    def get(self, key):
+        """Cached bytes for `key` (memory, then disk), or None. Unknown-shaped keys are a miss."""
+        if not KEY_RE.match(key or ""): return None
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.m["hits"] += 1
+                return data
+        data = self._disk_read(key) if self.disk_dir else None
+        if data is None:
+            self.m["misses"] += 1
+            return None
+        self.m["disk_hits"] += 1
+        self._remember(key, data)
+        return data
+
+    @property
+    def shared(self):
+        """True when every worker can serve a key any worker rendered (disk tier on)."""
+        return self.disk_dir is not None
+
+    def set(self, key, data):
+        self._remember(key, data)
+        if self.disk_dir: self._disk_write(key, data)
+
+    def get_or_render(self, key, render):
+        """
+        Cached bytes for `key`, else render() → bytes, stored in both tiers. One
+        thread renders per key; the others wait up to RENDER_WAIT secs for it.
+        """
+        data = self.get(key)
+        if data is not None: return data
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader: flight = self._inflight[key] = _Flight()
+            else:      self.m["coalesced"] += 1
+        if not leader:
+            if not flight.event.wait(RENDER_WAIT): return render()
+            if flight.error is not None: raise flight.error
+            return flight.value
+        try:
+            flight.value = render()
+            self.m["renders"] += 1
+            self.set(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock: self._inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        lookups = self.m["hits"] + self.m["disk_hits"] + self.m["misses"]
+        return dict(self.m, items=len(self._mem), mb=round(self._bytes / 1024 / 1024, 1),
+                    budget_mb=self.budget // 1024 // 1024, disk=bool(self.disk_dir),
+                    hit_rate=round((lookups - self.m["misses"]) / lookups, 3) if lookups else 0.0)
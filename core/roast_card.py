@@ -0,0 +1,85 @@
+"""
+core/roast_card.py
+==================
+Label bar + caption overlay for /roast meme cards.
+The template is cropped to the requested ratio and scaled to the output width
+first, so text is laid out for the final canvas and no drawn pixels are thrown away.
+Outlines use Pillow's native stroke (one draw call per string).
+"""
+
+import os
+from PIL import Image, ImageDraw
+from core.templates import get_font
+
+LABEL_BG  = "#8B0000"
+LABEL_FG  = "#FF4444"
+OUTLINE   = "#000000"
+STROKE    = 2          # same reach as the old 5x5 offset loop
+CAPTION_A = 160        # caption band darkness (0-255)
+OUTPUT_W  = int(os.getenv("CARD_OUTPUT_WIDTH", 1080))   # larger memes are scaled down to this
+
+
+def crop_box(W, H, ratio):
+    """Centered crop box for '9:16' / '16:9', or None to keep the template's own shape."""
+    if ratio == '9:16':
+        th = int(W * 16 / 9)
+        if th > H: nw = int(H*9/16); return ((W-nw)//2, 0, (W+nw)//2, H)
+        return (0, (H-th)//2, W, (H+th)//2)
+    if ratio == '16:9':
+        tw = int(H * 16 / 9)
+        if tw > W: nh = int(W*9/16); return (0, (H-nh)//2, W, (H+nh)//2)
+        return ((W-tw)//2, 0, (W+tw)//2, H)
+    return None
+
+
+def _wrap(draw, text, font, max_w):
+    lines, cur_line = [], ""
+    for w in text.split():
+        test = (cur_line + " " + w).strip()
+        if draw.textlength(test, font=font) <= max_w: cur_line = test
+        else:
+            if cur_line: lines.append(cur_line)
+            cur_line = w
+    if cur_line: lines.append(cur_line)
+    return lines
+
+
+def add_text_to_image(img, label, roast_text):
+    """Draw label bar + caption on `img` (an RGB template copy) in place; returns it."""
+    draw = ImageDraw.Draw(img)
+    W, H = img.size
+    lf   = get_font(max(16, W//20))
+    rf   = get_font(max(14, W//26))
+    lh   = int(H * 0.09)
+    draw.rectangle([0, 0, W, lh], fill=LABEL_BG)
+    lx = max(0, (W - draw.textlength(label, font=lf)) // 2)
+    draw.text((lx, (lh-lf.size)//2), label, font=lf, fill=LABEL_FG,
+              stroke_width=STROKE, stroke_fill=OUTLINE)
+
+    lines = _wrap(draw, roast_text, rf, W - 24)
+    lh2   = rf.size + 4
+    y     = H - lh2 * len(lines) - 20
+    # Darken only the caption band instead of compositing a full-size RGBA overlay
+    band_top = max(0, y - 10)
+    band = img.crop((0, band_top, W, H))
+    img.paste(Image.blend(band, Image.new('RGB', band.size, (0, 0, 0)), CAPTION_A / 255), (0, band_top))
+    for line in lines:
+        x = max(0, (W - draw.textlength(line, font=rf)) // 2)
+        draw.text((x, y), line, font=rf, fill="#FFFFFF", stroke_width=STROKE, stroke_fill=OUTLINE)
+        y += lh2
+    return img
+
+
+def compose_roast_card(template, label, roast_text, ratio='1:1', out_w=OUTPUT_W):
+    """
+    Crop → downscale → draw. `template` is never modified (it may be the shared
+    decoded copy from the registry); returns a new RGB image.
+    """
+    img = template
+    box = crop_box(*img.size, ratio)
+    if box: img = img.crop(box)
+    if img.width > out_w:
+        img = img.resize((out_w, max(1, round(img.height * out_w / img.width))),
+                         Image.LANCZOS, reducing_gap=2.0)
+    if img is template: img = img.copy()
+    return add_text_to_image(img, label, roast_text)
@@ -0,0 +1,219 @@
+"""
+core/roast_pool.py
+==================
+Pre-generated roasts for the (topic, language, quality) buckets people are
+actually asking for right now. Requests pop a fresh roast the session hasn't
+seen and fall back to live generation when the bucket is empty.
+  - the pool lives in the roast_pool table (migration 7), so every worker and
+    host pops from the same roasts; pops are DELETE ... SKIP LOCKED, each
+    pooled roast is served once
+  - one process refills at a time: the roast_pool_lease row is claimed for
+    ROAST_POOL_INTERVAL at the start of each pass (and renewed by its holder)
+  - a bucket is refilled only if it saw traffic in the last ROAST_POOL_WINDOW
+    secs, and only up to min(ROAST_POOL_SIZE, requests in that window) — an
+    idle site generates nothing
+  - if the demand query fails, the pass is skipped and the pool left as it is
+No-repeat tracking (sessions → roasts seen) is per process.
+"""
+
+import os, time, string, socket, hashlib, logging, threading
+from collections import OrderedDict, deque
+from core.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+ROAST_POOL_ENABLED   = os.getenv("ROAST_POOL_ENABLED", "1") == "1"
+ROAST_POOL_SIZE      = int(os.getenv("ROAST_POOL_SIZE", 4))          # max roasts kept per bucket
+ROAST_POOL_TTL       = int(os.getenv("ROAST_POOL_TTL", 3600))        # secs before a pooled roast is stale
+ROAST_POOL_BUCKETS   = int(os.getenv("ROAST_POOL_BUCKETS", 20))      # busiest buckets considered per pass
+ROAST_POOL_INTERVAL  = int(os.getenv("ROAST_POOL_INTERVAL", 60))     # secs between refill passes
+ROAST_POOL_WINDOW    = int(os.getenv("ROAST_POOL_WINDOW", 600))      # secs of traffic that count as demand
+ROAST_POOL_PER_PASS  = int(os.getenv("ROAST_POOL_PER_PASS", 30))     # max generations per pass
+ROAST_POOL_SESSIONS  = int(os.getenv("ROAST_POOL_SESSIONS", 20000))  # sessions tracked for no-repeat
+ROAST_POOL_EMPTY_TTL = float(os.getenv("ROAST_POOL_EMPTY_TTL", 10))  # secs an empty bucket isn't re-queried
+ROAST_POOL_SEEN      = 50                                            # roasts remembered per session
+
+POP_SQL = '''
+    DELETE FROM roast_pool WHERE id = (
+        SELECT id FROM roast_pool
+        WHERE topic_key=%s AND language=%s AND quality=%s
+          AND created_at > NOW() - make_interval(secs => %s)
+          AND NOT (digest = ANY(%s::bytea[]))
+        ORDER BY id LIMIT 1
+        FOR UPDATE SKIP LOCKED)
+    RETURNING label, roast'''
+
+LEASE_SQL = '''
+    UPDATE roast_pool_lease SET holder=%(me)s, until=NOW() + make_interval(secs => %(secs)s)
+    WHERE id=1 AND (until < NOW() OR holder=%(me)s)
+    RETURNING holder'''
+
+
+def _norm(topic):
+    return " ".join((topic or "").lower().split()).strip(string.punctuation + " ")
+
+
+def _digest(roast):
+    return hashlib.blake2b(roast.encode("utf-8"), digest_size=8).digest()
+
+
+class RoastPool:
+    """
+    generate(topic, language, quality) → (label, roast), raising on failure.
+    demand(limit, window_secs) → [(topic, language, quality, requests), ...] busiest
+    first, or None if it couldn't be read.
+    `get_conn` is a context-manager factory (DBPool.connection).
+    """
+
+    def __init__(self, generate, demand, get_conn, size=ROAST_POOL_SIZE, ttl=ROAST_POOL_TTL,
+                 buckets=ROAST_POOL_BUCKETS, interval=ROAST_POOL_INTERVAL, window=ROAST_POOL_WINDOW,
+                 enabled=ROAST_POOL_ENABLED):
+        self.generate    = generate
+        self.demand      = demand
+        self.get_conn    = get_conn
+        self.size        = size
+        self.ttl         = ttl
+        self.max_buckets = buckets
+        self.interval    = interval
+        self.window      = window
+        self.enabled     = enabled
+        self.holder      = f"{socket.gethostname()}:{os.getpid()}"
+        self._empty      = TTLCache(maxsize=4096, ttl=ROAST_POOL_EMPTY_TTL)   # buckets known to be empty
+        self._seen       = OrderedDict()    # session -> deque[digest]
+        self._lock       = threading.Lock()
+        self._thread     = None
+        self._pid        = None
+        self.m = {"hits": 0, "misses": 0, "generated": 0, "expired": 0, "gen_errors": 0, "passes": 0,
+                  "passes_skipped": 0, "last_pass_ms": 0, "last_buckets": 0}
+
+    @staticmethod
+    def key(topic, language, quality):
+        try:    quality = max(1, min(5, int(quality)))
+        except (TypeError, ValueError): quality = 3
+        return _norm(topic), language, quality
+
+    # ── request side ─────────────────────────────────────────
+    def _seen_locked(self, session_id):
+        seen = self._seen.get(session_id)
+        if seen is None:
+            seen = self._seen[session_id] = deque(maxlen=ROAST_POOL_SEEN)
+            while len(self._seen) > ROAST_POOL_SESSIONS:
+                self._seen.popitem(last=False)
+        self._seen.move_to_end(session_id)
+        return seen
+
+    def mark_seen(self, session_id, roast):
+        with self._lock:
+            self._seen_locked(session_id).append(_digest(roast))
+
+    def pop(self, topic, language, quality, session_id):
+        """A pooled (label, roast) this session hasn't seen, or None."""
+        if not self.enabled: return None
+        self.start()
+        k = self.key(topic, language, quality)
+        if self._empty.get(k):
+            self.m["misses"] += 1
+            return None
+        with self._lock: seen = list(self._seen_locked(session_id))
+        row = None
+        with self.get_conn() as conn:
+            if conn:
+                try:
+                    cur = conn.cursor()
+                    cur.execute(POP_SQL, (*k, self.ttl, seen))
+                    row = cur.fetchone()
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logger.warning(f"Roast pool pop failed: {e}")
+        if not row:
+            self._empty.set(k, True)
+            self.m["misses"] += 1
+            return None
+        self.mark_seen(session_id, row['roast'])
+        self.m["hits"] += 1
+        return row['label'], row['roast']
+
+    # ── background side ──────────────────────────────────────
+    def start(self):
+        if self._thread is not None and self._pid == os.getpid(): return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid    = os.getpid()
+                self.holder  = f"{socket.gethostname()}:{self._pid}"
+                self._thread = threading.Thread(target=self._run, name="roast-pool", daemon=True)
+                self._thread.start()
+
+    def _execute(self, sql, args=(), fetch=True):
+        """One statement in its own transaction → rows ([] if fetch is False), or None on failure."""
+        with self.get_conn() as conn:
+            if not conn: return None
+            try:
+                cur = conn.cursor()
+                cur.execute(sql, args)
+                rows = cur.fetchall() if fetch else []
+                conn.commit()
+                return rows
+            except Exception as e:
+                conn.rollback()
+                logger.warning(f"Roast pool query failed: {e}")
+                return None
+
+    def _claim(self):
+        """This process is the refiller until the lease runs out (renewed every pass)."""
+        rows = self._execute(LEASE_SQL, {"me": self.holder, "secs": self.interval * 2})
+        return bool(rows)
+
+    def refill(self):
+        t0 = time.time()
+        if not self._claim():
+            self.m["passes_skipped"] += 1
+            return
+        demand = self.demand(self.max_buckets, self.window)
+        if demand is None:                               # DB trouble — keep what's pooled
+            self.m["passes_skipped"] += 1
+            return
+        wanted = {}
+        for topic, language, quality, requests in demand:
+            k = self.key(topic, language, quality)
+            if k not in wanted: wanted[k] = (topic, min(self.size, int(requests)))
+        expired = self._execute('''DELETE FROM roast_pool WHERE created_at <= NOW() - make_interval(secs => %s)
+                                   RETURNING id''', (self.ttl,))
+        self.m["expired"] += len(expired or ())
+        have = self._execute('''SELECT topic_key, language, quality, COUNT(*) AS n FROM roast_pool
+                                GROUP BY topic_key, language, quality''')
+        if have is None:
+            self.m["passes_skipped"] += 1
+            return
+        have = {(r['topic_key'], r['language'], r['quality']): r['n'] for r in have}
+
+        budget = ROAST_POOL_PER_PASS
+        for k, (topic, target) in wanted.items():
+            n = have.get(k, 0)
+            while budget > 0 and n < target:
+                budget -= 1
+                try:
+                    label, roast = self.generate(topic, k[1], k[2])
+                except Exception as e:
+                    self.m["gen_errors"] += 1
+                    logger.warning(f"Roast pool generate failed for {k}: {e}")
+                    break
+                if self._execute('''INSERT INTO roast_pool (topic_key, language, quality, label, roast, digest)
+                                    VALUES (%s,%s,%s,%s,%s,%s)''', (*k, label, roast, _digest(roast)),
+                                 fetch=False) is None: break
+                n += 1
+                self.m["generated"] += 1
+        self.m["passes"]      += 1
+        self.m["last_buckets"] = len(wanted)
+        self.m["last_pass_ms"] = int((time.time() - t0) * 1000)
+
+    def _run(self):
+        while True:
+            try:    self.refill()
+            except Exception as e: logger.error(f"Roast pool refill error: {e}")
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.m, enabled=self.enabled, holder=self.holder, sessions=len(self._seen),
+                        empty_buckets=self._empty.stats()["size"])
@@ -0,0 +1,173 @@
+"""
+core/rollups.py
+===============
+Pre-aggregated analytics for the dashboards.
+  - analytics_rollup: (period, dim, value) → events / ok / summed response_ms,
+    period = 'all' or a 'YYYY-MM-DD' day, dim = 'all' or one of DIMS
+  - analytics_hll:    HyperLogLog sketch of session ids per period
+AnalyticsWriter applies each batch's deltas in the same transaction as its
+INSERTs, so rollups are exact and as fresh as the last flush. Dashboards read
+a handful of rows instead of scanning analytics.
+Days are UTC dates (AnalyticsWriter stamps created_at in UTC), so callers pass
+the UTC day to today() rather than relying on the DB's clock or time zone.
+Backfill / repair from the raw table, offline (it holds a SHARE lock on
+analytics, so inserts wait until it finishes):  python -m core.rollups rebuild
+"""
+
+import os, sys, math, hashlib, logging
+from datetime import datetime, timezone
+from collections import defaultdict
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+# rollup dimension → analytics column
+DIMS = {"language": "language", "quality": "quality_name", "country": "country",
+        "device": "device_type", "topic": "topic"}
+
+HLL_P = 12                # 4096 registers → ~1.6% standard error, 4 KB per sketch
+
+
+class HLL:
+    """HyperLogLog over 64-bit blake2b hashes; registers are one byte each."""
+    M = 1 << HLL_P
+
+    def __init__(self, registers=None):
+        self.reg = bytearray(registers) if registers else bytearray(self.M)
+
+    def add(self, item):
+        h    = int.from_bytes(hashlib.blake2b(str(item).encode("utf-8"), digest_size=8).digest(), "big")
+        idx  = h >> (64 - HLL_P)
+        rest = h & ((1 << (64 - HLL_P)) - 1)
+        rank = (64 - HLL_P) - rest.bit_length() + 1
+        if rank > self.reg[idx]: self.reg[idx] = rank
+
+    def merge(self, other):
+        self.reg = bytearray(map(max, self.reg, other.reg))
+        return self
+
+    def count(self):
+        m     = self.M
+        est   = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.reg)
+        zeros = self.reg.count(0)
+        if est <= 2.5 * m and zeros: est = m * math.log(m / zeros)   # small-range correction
+        return int(round(est))
+
+
+def _periods(ts):
+    return ("all", ts.strftime("%Y-%m-%d"))
+
+
+def apply_rollups(cur, events):
+    """
+    Add a batch of analytics rows (dicts with the analytics column names) to the
+    rollups. Call inside the transaction that inserts them.
+    """
+    deltas   = defaultdict(lambda: [0, 0, 0])       # (period, dim, value) → [events, ok, ms_sum]
+    sketches = defaultdict(HLL)
+    for e in events:
+        ok = bool(e.get("success", True))
+        ms = (e.get("response_ms") or 0) if ok else 0
+        for period in _periods(e["created_at"]):
+            keys = [(period, "all", "")] + [(period, dim, (e.get(col) or "")[:255]) for dim, col in DIMS.items()]
+            for k in keys:
+                d = deltas[k]
+                d[0] += 1
+                d[1] += ok
+                d[2] += ms
+            if e.get("session_id") is not None: sketches[period].add(e["session_id"])
+    if not deltas: return
+    execute_values(cur, '''INSERT INTO analytics_rollup (period, dim, value, events, ok, ms_sum) VALUES %s
+        ON CONFLICT (period, dim, value) DO UPDATE
+        SET events     = analytics_rollup.events + EXCLUDED.events,
+            ok         = analytics_rollup.ok     + EXCLUDED.ok,
+            ms_sum     = analytics_rollup.ms_sum + EXCLUDED.ms_sum,
+            updated_at = NOW()''',
+        [k + tuple(v) for k, v in sorted(deltas.items())], page_size=500)   # sorted → stable lock order
+    if not sketches: return
+    scopes = sorted(sketches)
+    execute_values(cur, 'INSERT INTO analytics_hll (period) VALUES %s ON CONFLICT (period) DO NOTHING',
+                   [(s,) for s in scopes])
+    cur.execute('SELECT period, registers FROM analytics_hll WHERE period = ANY(%s) ORDER BY period FOR UPDATE',
+                (scopes,))
+    for r in cur.fetchall():
+        if r['registers']: sketches[r['period']].merge(HLL(bytes(r['registers'])))
+    execute_values(cur, '''UPDATE analytics_hll AS h SET registers = v.registers, updated_at = NOW()
+        FROM (VALUES %s) AS v(period, registers) WHERE h.period = v.period''',
+        [(s, bytes(sketches[s].reg)) for s in scopes])
+
+
+def rebuild(conn):
+    """
+    Recompute every rollup from the analytics table. Holds a SHARE lock on
+    analytics for the duration, so no batch is counted twice or missed.
+    """
+    cur = conn.cursor()
+    cur.execute('LOCK TABLE analytics IN SHARE MODE')
+    cur.execute('DELETE FROM analytics_rollup')
+    cur.execute('DELETE FROM analytics_hll')
+    dims = ", ".join(f"('{dim}', LEFT(COALESCE(a.{col}, ''), 255))" for dim, col in DIMS.items())
+    cur.execute(f'''INSERT INTO analytics_rollup (period, dim, value, events, ok, ms_sum)
+        SELECT p.period, d.dim, d.value, COUNT(*),
+               COUNT(*) FILTER (WHERE a.success),
+               COALESCE(SUM(a.response_ms) FILTER (WHERE a.success), 0)
+        FROM analytics a
+        CROSS JOIN LATERAL (VALUES ('all'), (to_char(a.created_at, 'YYYY-MM-DD'))) AS p(period)
+        CROSS JOIN LATERAL (VALUES ('all', ''), {dims}) AS d(dim, value)
+        WHERE a.created_at IS NOT NULL
+        GROUP BY 1, 2, 3''')
+    sketches = defaultdict(HLL)
+    rows = conn.cursor(name="rollup_sessions")              # server-side: streams, doesn't load the table
+    rows.itersize = 10000
+    rows.execute('''SELECT to_char(created_at, 'YYYY-MM-DD') AS day, session_id FROM analytics
+                    WHERE session_id IS NOT NULL AND created_at IS NOT NULL''')
+    for r in rows:
+        sketches["all"].add(r['session_id'])
+        sketches[r['day']].add(r['session_id'])
+    rows.close()
+    for period, sk in sorted(sketches.items()):
+        cur.execute('INSERT INTO analytics_hll (period, registers) VALUES (%s, %s)', (period, bytes(sk.reg)))
+    logger.info(f"Rollups rebuilt ({len(sketches)} session sketches)")
+
+
+# ── dashboard reads ──────────────────────────────────────────
+def totals(cur, period="all"):
+    """{'events', 'ok', 'avg_ms', 'as_of'} for 'all' or a day; as_of is the last flush folded in."""
+    cur.execute('''SELECT events, ok, ms_sum, updated_at FROM analytics_rollup
+                   WHERE period=%s AND dim='all' AND value=\'\'''', (period,))
+    r = cur.fetchone()
+    if not r: return {"events": 0, "ok": 0, "avg_ms": 0, "as_of": None}
+    return {"events": r['events'], "ok": r['ok'], "avg_ms": int(r['ms_sum'] / r['ok']) if r['ok'] else 0,
+            "as_of": r['updated_at']}
+
+
+def today(cur, day=None):
+    """totals() for `day` — a UTC date, which is what apply_rollups buckets by (default: today, UTC)."""
+    return totals(cur, (day or datetime.now(timezone.utc).date()).strftime("%Y-%m-%d"))
+
+
+def top(cur, dim, limit=None, metric="ok", period="all", skip_empty=False):
+    """[{<analytics column>: value, 'cnt': n}] by `metric` ('ok' = successful roasts, 'events' = all)."""
+    assert dim in DIMS and metric in ("ok", "events")
+    cur.execute(f'''SELECT value AS {DIMS[dim]}, {metric} AS cnt FROM analytics_rollup
+                    WHERE period=%s AND dim=%s AND {metric} > 0 {"AND value <> ''" if skip_empty else ""}
+                    ORDER BY {metric} DESC LIMIT %s''', (period, dim, limit))
+    return [dict(r) for r in cur.fetchall()]
+
+
+def unique_sessions(cur, period="all"):
+    cur.execute('SELECT registers FROM analytics_hll WHERE period=%s', (period,))
+    r = cur.fetchone()
+    return HLL(bytes(r['registers'])).count() if r and r['registers'] else 0
+
+
+if __name__ == "__main__":
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    if sys.argv[1:2] != ["rebuild"]:
+        print(__doc__)
+        sys.exit(0)
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+    rebuild(conn)
+    conn.commit()
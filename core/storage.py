@@ -1,60 +1,137 @@
 """
 core/storage.py
 ===============
-Cloudinary uploads for roast cards + battle cards.
-Both stored permanently, delivered via CDN.
+Permanent storage for roast cards + battle cards, picked by STORAGE_BACKEND:
+  cloudinary — Cloudinary uploads, delivered via its CDN (default)
+  local      — content-addressed files under STORAGE_DIR, written atomically and
+               served by the app at /media/<path> (sendfile, range requests,
+               ETag, immutable caching). Set STORAGE_BASE_URL to put a CDN or
+               nginx in front; the URL layout stays the same.
 """
 
-import os, time
-import cloudinary
-import cloudinary.uploader
+import os, hashlib, tempfile
+from io import BytesIO
+from core.formats import sniff, EXT
 
-cloudinary.config(
-    cloud_name = os.getenv("CLOUDINARY_CLOUD_NAME", "ddjoodecx"),
-    api_key    = os.getenv("CLOUDINARY_API_KEY",    "738511258157834"),
-    api_secret = os.getenv("CLOUDINARY_API_SECRET", "xJKGug_zL3qlXKfXuT3litta2oM"),
-    secure     = True
-)
+STORAGE_BACKEND  = os.getenv("STORAGE_BACKEND", "cloudinary")
+STORAGE_DIR      = os.getenv("STORAGE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "media"))
+STORAGE_BASE_URL = os.getenv("STORAGE_BASE_URL", "/media").rstrip("/")
+
+
+def _read(src):
+    """bytes from bytes / BytesIO / file path."""
+    if isinstance(src, (bytes, bytearray)): return bytes(src)
+    if hasattr(src, "getvalue"):            return src.getvalue()
+    with open(src, "rb") as f:              return f.read()
+
+
+def content_key(data):
+    """Stable id for a payload — a retried upload of the same bytes lands on the same asset."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class CloudinaryStorage:
+    name = "cloudinary"
+
+    def __init__(self):
+        import cloudinary, cloudinary.uploader
+        cloudinary.config(
+            cloud_name = os.getenv("CLOUDINARY_CLOUD_NAME", "ddjoodecx"),
+            api_key    = os.getenv("CLOUDINARY_API_KEY",    "738511258157834"),
+            api_secret = os.getenv("CLOUDINARY_API_SECRET", "xJKGug_zL3qlXKfXuT3litta2oM"),
+            secure     = True
+        )
+        self.uploader = cloudinary.uploader
+
+    def upload_roast_card(self, image_bytes, session_id="anon"):
+        data = _read(image_bytes)
+        result = self.uploader.upload(
+            BytesIO(data),
+            folder        = "roaster-ai/roasts",
+            public_id     = f"roast_{session_id}_{content_key(data)}",
+            overwrite     = True,
+            resource_type = "image",
+            transformation = [
+                {"quality": "auto:good"},
+                {"fetch_format": "auto"}
+            ]
+        )
+        return result["secure_url"]
+
+    def upload_battle_card(self, file_path, battle_id):
+        result = self.uploader.upload(
+            BytesIO(file_path) if isinstance(file_path, bytes) else file_path,
+            folder        = "roaster-ai/battles",
+            public_id     = f"battle_{battle_id}",
+            overwrite     = True,
+            resource_type = "image",
+            transformation = [
+                {"quality": "auto:best"},
+                {"fetch_format": "auto"}
+            ]
+        )
+        return result["secure_url"]
+
+
+class LocalStorage:
+    """<root>/<folder>/<h[:2]>/<h>.<ext>, h = blake2b of the bytes — same bytes, same URL."""
+    name = "local"
+
+    def __init__(self, root=STORAGE_DIR, base_url=STORAGE_BASE_URL):
+        self.root     = os.path.abspath(root)
+        self.base_url = base_url
+        os.makedirs(self.root, exist_ok=True)
+
+    def put(self, folder, data):
+        digest = content_key(data)
+        rel    = f"{folder}/{digest[:2]}/{digest}.{EXT.get(sniff(data), 'bin')}"
+        path   = os.path.join(self.root, rel)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{digest}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f: f.write(data)
+                os.replace(tmp, path)          # readers see the whole file or none of it
+            except Exception:
+                try:    os.remove(tmp)
+                except OSError: pass
+                raise
+        return f"{self.base_url}/{rel}"
+
+    def upload_roast_card(self, image_bytes, session_id="anon"):
+        return self.put("roasts", _read(image_bytes))
+
+    def upload_battle_card(self, file_path, battle_id):
+        return self.put("battles", _read(file_path))
+
+
+def make_storage(backend=STORAGE_BACKEND):
+    if backend == "local": return LocalStorage()
+    if backend == "cloudinary": return CloudinaryStorage()
+    raise ValueError(f"unknown STORAGE_BACKEND {backend!r}")
+
+
+storage = make_storage()
 
 
 def upload_roast_card(image_bytes, session_id="anon") -> str:
     """
-    Upload roast card (BytesIO or bytes) to Cloudinary.
-    Returns secure CDN URL.
+    Store a roast card (BytesIO or bytes).
+    Returns its permanent URL.
     """
-    result = cloudinary.uploader.upload(
-        image_bytes,
-        folder        = "roaster-ai/roasts",
-        public_id     = f"roast_{session_id}_{int(time.time())}",
-        overwrite     = True,
-        resource_type = "image",
-        transformation = [
-            {"quality": "auto:good"},
-            {"fetch_format": "auto"}
-        ]
-    )
-    return result["secure_url"]
-
-
-def upload_battle_card(file_path: str, battle_id: str) -> str:
+    return storage.upload_roast_card(image_bytes, session_id)
+
+
+def upload_battle_card(file_path, battle_id: str) -> str:
     """
-    Upload battle result card (file path) to Cloudinary.
+    Store a battle result card (file path or JPEG bytes).
     Deletes temp file after upload.
-    Returns secure CDN URL.
+    Returns its permanent URL.
     """
-    result = cloudinary.uploader.upload(
-        file_path,
-        folder        = "roaster-ai/battles",
-        public_id     = f"battle_{battle_id}",
-        overwrite     = True,
-        resource_type = "image",
-        transformation = [
-            {"quality": "auto:best"},
-            {"fetch_format": "auto"}
-        ]
-    )
-    try:
-        os.remove(file_path)
-    except:
-        pass
-    return result["secure_url"]
+    url = storage.upload_battle_card(file_path, battle_id)
+    if isinstance(file_path, str):
+        try:
+            os.remove(file_path)
+        except:
+            pass
+    return url
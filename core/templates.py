@@ -0,0 +1,134 @@
+"""
+core/templates.py
+=================
+Meme template registry — decoded bitmaps + font objects kept in memory.
+Templates are copied per request (a memcpy, no decode). The folder is
+re-scanned when its mtime changes; decoded images live in a byte-budgeted LRU.
+A folder mtime change also drops the decoded images, which is how a reload
+reaches every process: mark_changed() bumps the mtime, and each registry (app
+workers, render workers) re-decodes within MEME_RESCAN_SECS.
+"""
+
+import os, time, logging, threading
+from collections import OrderedDict
+from functools import lru_cache
+from PIL import Image, ImageFont
+
+logger = logging.getLogger(__name__)
+
+MEME_EXTS        = ('.jpg', '.jpeg', '.png')
+MEME_CACHE_MB    = int(os.getenv("MEME_CACHE_MB", 256))
+MEME_RESCAN_SECS = float(os.getenv("MEME_RESCAN_SECS", 10))    # min gap between folder stat() calls
+FONT_BOLD        = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+
+@lru_cache(maxsize=64)
+def get_font(size, path=FONT_BOLD):
+    """TrueType font at `size`, loaded once per process."""
+    try:    return ImageFont.truetype(path, size)
+    except Exception: return ImageFont.load_default()
+
+
+class TemplateRegistry:
+    def __init__(self, folder, budget_mb=MEME_CACHE_MB):
+        self.folder     = folder
+        self.budget     = budget_mb * 1024 * 1024
+        self._images    = OrderedDict()      # name -> (mtime, Image)
+        self._bytes     = 0
+        self._names     = []
+        self._dir_mtime = None
+        self._checked   = 0.0
+        self._lock      = threading.RLock()
+        self.m = {"hits": 0, "misses": 0, "evictions": 0, "reloads": 0}
+
+    # ── folder scan ──────────────────────────────────────────
+    def _rescan_if_changed(self, force=False):
+        now = time.time()
+        if not force and now - self._checked < MEME_RESCAN_SECS: return
+        self._checked = now
+        try:    mtime = os.stat(self.folder).st_mtime
+        except OSError:
+            self._names, self._dir_mtime = [], None
+            return
+        if force or mtime != self._dir_mtime:
+            changed, self._dir_mtime = self._dir_mtime not in (None, mtime), mtime
+            self._names = sorted(f for f in os.listdir(self.folder) if f.endswith(MEME_EXTS))
+            with self._lock:
+                if changed:                          # another process may have asked for a reload
+                    self._images.clear()
+                    self._bytes = 0
+                    self.m["reloads"] += 1
+                for gone in set(self._images) - set(self._names):
+                    self._drop(gone)
+
+    def check(self):
+        """Re-scan the folder if it's due (one stat() per MEME_RESCAN_SECS)."""
+        self._rescan_if_changed()
+
+    def names(self):
+        self._rescan_if_changed()
+        return self._names
+
+    def mark_changed(self):
+        """Bump the folder mtime: every registry watching it drops its decoded templates on its next check."""
+        os.utime(self.folder)
+
+    # ── decoded LRU ──────────────────────────────────────────
+    def _drop(self, name):
+        _, img = self._images.pop(name)
+        self._bytes -= img.width * img.height * len(img.getbands())
+
+    def _load(self, name):
+        path  = os.path.join(self.folder, name)
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            item = self._images.get(name)
+            if item and item[0] == mtime:
+                self._images.move_to_end(name)
+                self.m["hits"] += 1
+                return item[1]
+        self.m["misses"] += 1
+        img = Image.open(path).convert('RGB')
+        img.load()
+        size = img.width * img.height * 3
+        with self._lock:
+            if name in self._images: self._drop(name)
+            self._images[name] = (mtime, img)
+            self._bytes += size
+            while self._bytes > self.budget and len(self._images) > 1:
+                self._drop(next(iter(self._images)))
+                self.m["evictions"] += 1
+        return img
+
+    def get(self, name):
+        """Private RGB copy of a template, safe to draw on."""
+        return self._load(name).copy()
+
+    def view(self, name):
+        """Shared decoded template — read-only (crop/resize it, never draw on it)."""
+        return self._load(name)
+
+    def fingerprint(self, name):
+        """Identity of the template file's current contents, for render cache keys."""
+        st = os.stat(os.path.join(self.folder, name))
+        return f"{name}:{st.st_mtime_ns}:{st.st_size}"
+
+    def preload(self):
+        """Decode templates until the memory budget is reached."""
+        self._rescan_if_changed(force=True)
+        for name in self._names:
+            if self._bytes >= self.budget: break
+            try: self._load(name)
+            except Exception as e: logger.error(f"Template {name} failed to load: {e}")
+        logger.info(f"Templates: {len(self._images)}/{len(self._names)} decoded, {self._bytes // 1024 // 1024} MB")
+
+    def reload(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+        self.m["reloads"] += 1
+        self.preload()
+
+    def stats(self):
+        return dict(self.m, templates=len(self._names), decoded=len(self._images),
+                    mb=round(self._bytes / 1024 / 1024, 1), budget_mb=self.budget // 1024 // 1024)
@@ -0,0 +1,269 @@
+"""
+core/uploads.py
+===============
+Spooled upload queue for CDN uploads.
+submit() writes the payload + a small JSON job file into UPLOAD_SPOOL_DIR and
+returns; UPLOAD_WORKERS threads upload with exponential backoff. Jobs survive
+restarts: each process holds an flock on the job files it owns, so on start
+(and every UPLOAD_RESCAN_SECS) a process adopts only jobs whose owner died —
+call start() at boot so a crash's leftovers don't wait for the next upload.
+Keyed jobs are created with O_EXCL, so two processes submitting the same key
+share one job; temp files carry the pid + a random suffix.
+Jobs that run out of attempts are moved to <spool>/failed/.
+"""
+
+import os, json, time, fcntl, heapq, random, hashlib, secrets, logging, threading
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SPOOL_DIR    = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "spool"))
+UPLOAD_WORKERS      = int(os.getenv("UPLOAD_WORKERS", 4))          # concurrent uploads per process
+UPLOAD_QUEUE_MAX    = int(os.getenv("UPLOAD_QUEUE_MAX", 1000))     # pending jobs before submit() refuses
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", 8))
+UPLOAD_RETRY_BASE   = float(os.getenv("UPLOAD_RETRY_BASE", 2))     # secs; doubles per attempt
+UPLOAD_RETRY_MAX    = float(os.getenv("UPLOAD_RETRY_MAX", 600))
+UPLOAD_RESCAN_SECS  = float(os.getenv("UPLOAD_RESCAN_SECS", 60))   # how often orphaned jobs are adopted
+UPLOAD_TMP_MAX_AGE  = 3600                                          # secs before a crashed writer's .tmp is removed
+
+
+class _Job:
+    __slots__ = ("id", "fd", "meta")
+
+    def __init__(self, id, fd, meta):
+        self.id, self.fd, self.meta = id, fd, meta
+
+
+class UploadQueue:
+    """
+    handlers — {kind: fn(data: bytes, meta: dict) → url}, raising on failure.
+    A handler must be safe to repeat (uploads overwrite by public id).
+    """
+
+    def __init__(self, handlers, spool_dir=UPLOAD_SPOOL_DIR, workers=UPLOAD_WORKERS, maxsize=UPLOAD_QUEUE_MAX):
+        self.handlers = handlers
+        self.spool    = spool_dir
+        self.failed   = os.path.join(spool_dir, "failed")
+        self.workers  = workers
+        self.maxsize  = maxsize
+        self._jobs    = {}             # id -> _Job (owned + locked by this process)
+        self._heap    = []             # (next_at, id)
+        self._running = 0
+        self._cond    = threading.Condition()
+        self._threads = []
+        self._pid     = None
+        self._scanned = 0.0
+        self.m = {"submitted": 0, "deduped": 0, "rejected": 0, "uploaded": 0, "retries": 0,
+                  "dead": 0, "adopted": 0, "last_ms": 0, "avg_ms": 0.0}
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        """A forked child (render worker, gunicorn worker) must not keep the parent's job locks alive."""
+        for job in self._jobs.values():
+            if job is not None:
+                try:    os.close(job.fd)
+                except OSError: pass
+        self._jobs, self._heap, self._running, self._threads = {}, [], 0, []
+        self._cond = threading.Condition()
+
+    # ── spool files ──────────────────────────────────────────
+    def _paths(self, id):
+        return os.path.join(self.spool, id + ".bin"), os.path.join(self.spool, id + ".json")
+
+    @staticmethod
+    def _write_meta(fd, meta):
+        raw = json.dumps(meta).encode("utf-8")
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, raw)
+
+    def _tmp(self, path):
+        return f"{path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+
+    def _adopt(self):
+        """Lock + schedule spooled jobs that no live process owns."""
+        try:    names = os.listdir(self.spool)
+        except OSError: return
+        for name in names:
+            if name.endswith(".tmp"):
+                path = os.path.join(self.spool, name)
+                try:
+                    if time.time() - os.path.getmtime(path) > UPLOAD_TMP_MAX_AGE: os.remove(path)
+                except OSError: pass
+                continue
+            if not name.endswith(".json"): continue
+            id = name[:-5]
+            with self._cond:
+                if id in self._jobs or len(self._jobs) >= self.maxsize: continue
+            path = os.path.join(self.spool, name)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if not os.path.exists(path): raise OSError("finished by its owner")
+                meta = json.loads(os.pread(fd, 1 << 20, 0) or b"{}")
+                if "kind" not in meta: raise ValueError("not written yet")
+            except (OSError, ValueError):
+                os.close(fd)                       # owned by a live process, or mid-write
+                continue
+            with self._cond:
+                self._jobs[id] = _Job(id, fd, meta)
+                heapq.heappush(self._heap, (meta.get("next_at", 0), id))
+                self._cond.notify()
+            self.m["adopted"] += 1
+        if self.m["adopted"]: logger.info(f"Uploads: {self.m['adopted']} spooled jobs adopted so far")
+
+    # ── producer side ────────────────────────────────────────
+    def start(self):
+        if self._threads and self._pid == os.getpid(): return
+        with self._cond:
+            if self._threads and self._pid == os.getpid(): return
+            self._pid = os.getpid()
+            os.makedirs(self.failed, exist_ok=True)
+            self._threads = [threading.Thread(target=self._run, name=f"upload-{i}", daemon=True)
+                             for i in range(self.workers)]
+            for t in self._threads: t.start()
+        self._adopt()
+
+    def submit(self, kind, data, key=None, **meta):
+        """
+        Spool one upload; returns its job id, or None if the queue is full.
+        Jobs with the same `key` are deduplicated while one is pending.
+        """
+        self.start()
+        id = hashlib.blake2b(f"{kind}:{key}".encode(), digest_size=12).hexdigest() if key else \
+             f"{int(time.time() * 1000):x}-{secrets.token_hex(6)}"
+        with self._cond:
+            if id in self._jobs:
+                self.m["deduped"] += 1
+                return id
+            if len(self._jobs) >= self.maxsize:
+                self.m["rejected"] += 1
+                logger.warning(f"Upload queue full ({self.maxsize}) — dropping {kind} upload")
+                return None
+            self._jobs[id] = None                       # reserve the id while files are written
+        bin_path, json_path = self._paths(id)
+        meta = dict(meta, kind=kind, attempts=0, next_at=0, created_at=time.time())
+        fd = None
+        try:
+            # claim the job file first: another process holding the same key wins the O_EXCL
+            fd = os.open(json_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)               # adopters skip it until meta is written
+            tmp = self._tmp(bin_path)
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, bin_path)
+            self._write_meta(fd, meta)                   # the job exists (locked) from here on
+        except FileExistsError:
+            with self._cond: self._jobs.pop(id, None)
+            self.m["deduped"] += 1
+            return id
+        except OSError as e:
+            with self._cond: self._jobs.pop(id, None)
+            if fd is not None:
+                for path in (bin_path, json_path):
+                    try:    os.remove(path)
+                    except OSError: pass
+                os.close(fd)
+            self.m["rejected"] += 1
+            logger.error(f"Upload spool write failed: {e}")
+            return None
+        with self._cond:
+            self._jobs[id] = _Job(id, fd, meta)
+            heapq.heappush(self._heap, (0, id))
+            self._cond.notify()
+        self.m["submitted"] += 1
+        return id
+
+    # ── worker side ──────────────────────────────────────────
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    _, id = heapq.heappop(self._heap)
+                    self._running += 1
+                    return self._jobs[id]
+                if now - self._scanned > UPLOAD_RESCAN_SECS:
+                    self._scanned = now                # one worker rescans, the rest keep waiting
+                    return None
+                wait = self._heap[0][0] - now if self._heap else UPLOAD_RESCAN_SECS
+                self._cond.wait(min(wait, UPLOAD_RESCAN_SECS))
+
+    def _finish(self, job, dead=False):
+        bin_path, json_path = self._paths(job.id)
+        try:
+            if dead:
+                os.replace(bin_path,  os.path.join(self.failed, job.id + ".bin"))
+                os.replace(json_path, os.path.join(self.failed, job.id + ".json"))
+            else:
+                os.remove(bin_path)
+                os.remove(json_path)
+        except OSError as e:
+            logger.warning(f"Upload spool cleanup {job.id}: {e}")
+        os.close(job.fd)
+        with self._cond:
+            self._jobs.pop(job.id, None)
+            self._running -= 1
+
+    def _attempt(self, job):
+        """One upload try → url. Raises; a missing payload or handler can't be retried."""
+        handler = self.handlers.get(job.meta.get("kind"))
+        try:
+            if handler is None: raise LookupError(f"no upload handler for {job.meta.get('kind')!r}")
+            with open(self._paths(job.id)[0], "rb") as f: data = f.read()
+        except (OSError, LookupError):
+            job.meta["attempts"] = UPLOAD_MAX_ATTEMPTS - 1
+            raise
+        return handler(data, job.meta)
+
+    def _retry_or_give_up(self, job, e):
+        meta = job.meta
+        meta["attempts"] += 1
+        if meta["attempts"] >= UPLOAD_MAX_ATTEMPTS:
+            self.m["dead"] += 1
+            logger.error(f"Upload {meta.get('kind')} {job.id} gave up after {meta['attempts']} attempts: {e}")
+            self._finish(job, dead=True)
+            return
+        delay = min(UPLOAD_RETRY_MAX, UPLOAD_RETRY_BASE * 2 ** (meta["attempts"] - 1))
+        meta["next_at"] = time.time() + delay * random.uniform(0.8, 1.2)
+        meta["error"]   = str(e)[:200]
+        self.m["retries"] += 1
+        logger.warning(f"Upload {meta['kind']} {job.id} failed (attempt {meta['attempts']}), retry in {delay:.0f}s: {e}")
+        try:    self._write_meta(job.fd, meta)            # attempts survive a restart
+        except OSError: pass
+        with self._cond:
+            self._running -= 1
+            heapq.heappush(self._heap, (meta["next_at"], job.id))
+
+    def _run(self):
+        while True:
+            job = self._next()
+            if job is None:
+                self._adopt()
+                continue
+            t0 = time.time()
+            try:
+                url = self._attempt(job)
+            except Exception as e:
+                self._retry_or_give_up(job, e)
+                continue
+            ms = int((time.time() - t0) * 1000)
+            self.m["uploaded"] += 1
+            self.m["last_ms"]   = ms
+            self.m["avg_ms"]    = round(0.8 * self.m["avg_ms"] + 0.2 * ms, 1)
+            logger.info(f"Uploaded {job.meta['kind']} {job.id} → {url}")
+            self._finish(job)
+
+    def pending(self, kind, key):
+        """True while a job submitted with (kind, key) is queued or uploading."""
+        id = hashlib.blake2b(f"{kind}:{key}".encode(), digest_size=12).hexdigest()
+        with self._cond: return id in self._jobs
+
+    def stats(self):
+        with self._cond:
+            pending, running = len(self._jobs), self._running
+        try:    dead = sum(1 for n in os.listdir(self.failed) if n.endswith(".json"))
+        except OSError: dead = None
+        return dict(self.m, pending=pending, in_flight=running, workers=self.workers,
+                    queue_max=self.maxsize, failed_on_disk=dead)
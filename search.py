@@ -2,7 +2,56 @@
 
 from duckduckgo_search import DDGS
 from pytrends.request import TrendReq
+from core.cache import TTLCache
+import os
+import math
+import time
 import random
+import string
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Topic context cache — fresh for CONTEXT_TTL, then served stale for up to
+# CONTEXT_STALE_TTL while a background refresh runs. Empty results expire fast.
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", 2000))
+CONTEXT_TTL        = int(os.getenv("CONTEXT_TTL", 1800))
+CONTEXT_STALE_TTL  = int(os.getenv("CONTEXT_STALE_TTL", 21600))
+CONTEXT_NEG_TTL    = int(os.getenv("CONTEXT_NEG_TTL", 120))
+
+_context_cache = TTLCache(maxsize=CONTEXT_CACHE_SIZE, ttl=CONTEXT_TTL + CONTEXT_STALE_TTL,
+                          neg_ttl=CONTEXT_NEG_TTL)
+_refreshing    = set()
+_refresh_lock  = threading.Lock()
+
+# Roast-material queries run in parallel; whatever arrives within
+# SEARCH_DEADLINE_MS is used and stragglers are discarded.
+SEARCH_PARALLEL    = os.getenv("SEARCH_PARALLEL", "1") == "1"
+SEARCH_DEADLINE_MS = int(os.getenv("SEARCH_DEADLINE_MS", 1500))
+SEARCH_WORKERS     = int(os.getenv("SEARCH_WORKERS", 8))
+
+_search_pool  = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="ddgs")
+_search_stats = {"fanouts": 0, "queries": 0, "timeouts": 0, "errors": 0}
+
+# Trending lists are refreshed in the background; requests read the snapshot.
+TRENDING_REFRESH_SECS = int(os.getenv("TRENDING_REFRESH_SECS", 900))
+TRENDING_JITTER       = float(os.getenv("TRENDING_JITTER", 0.1))      # ± fraction of the interval
+TRENDING_MAX_BACKOFF  = int(os.getenv("TRENDING_MAX_BACKOFF", 3600))
+
+FALLBACK_TRENDING = {
+    'india': [
+        "IPL 2025", "Bollywood", "JEE Results",
+        "Stock Market", "Instagram Reels",
+        "Startup Funding", "AI Jobs", "Crypto"
+    ],
+    'global': [
+        "ChatGPT", "Taylor Swift", "Elon Musk",
+        "Netflix", "iPhone", "Tesla", "AI", "Crypto"
+    ],
+}
+
 
 def search_topic_context(topic):
     """Get real-time context about any topic"""
@@ -24,44 +73,166 @@ def search_topic_context(topic):
         return ""
 
 
+def _fetch_trending(region):
+    """Live Google Trends call — raises on failure"""
+    if region == 'india':
+        pytrends = TrendReq(hl='en-IN', tz=330)
+        trending = pytrends.trending_searches(pn='india')
+    else:
+        pytrends = TrendReq()
+        trending = pytrends.trending_searches(pn='united_states')
+    topics = trending[0].tolist()[:10]
+    if not topics:
+        raise ValueError("empty trending list")
+    return topics
+
+
 def get_india_trending():
     """Get trending topics in India"""
     try:
-        pytrends = TrendReq(hl='en-IN', tz=330)
-        trending = pytrends.trending_searches(pn='india')
-        return trending[0].tolist()[:10]
+        return _fetch_trending('india')
     except:
-        return [
-            "IPL 2025", "Bollywood", "JEE Results",
-            "Stock Market", "Instagram Reels",
-            "Startup Funding", "AI Jobs", "Crypto"
-        ]
+        return FALLBACK_TRENDING['india']
 
 
 def get_global_trending():
     """Get global trending topics"""
     try:
-        pytrends = TrendReq()
-        trending = pytrends.trending_searches(pn='united_states')
-        return trending[0].tolist()[:10]
+        return _fetch_trending('global')
     except:
-        return [
-            "ChatGPT", "Taylor Swift", "Elon Musk",
-            "Netflix", "iPhone", "Tesla", "AI", "Crypto"
-        ]
+        return FALLBACK_TRENDING['global']
+
+
+class TrendingRefresher:
+    """
+    Keeps an in-memory snapshot of both trending lists fresh.
+    Fallback lists are served until the first successful refresh; failures
+    back off exponentially (capped), and every sleep is jittered so workers
+    don't hit Google Trends in lockstep.
+    """
+
+    def __init__(self, interval=TRENDING_REFRESH_SECS, jitter=TRENDING_JITTER,
+                 max_backoff=TRENDING_MAX_BACKOFF):
+        self.interval    = interval
+        self.jitter      = jitter
+        self.max_backoff = max_backoff
+        self.snapshot    = dict(FALLBACK_TRENDING)
+        self.updated_at  = {region: None for region in FALLBACK_TRENDING}
+        self.failures    = 0
+        self.next_run    = None
+        self._thread     = None
+        self._pid        = None
+        self._lock       = threading.Lock()
+
+    def start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid    = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="trending-refresher", daemon=True)
+                self._thread.start()
+
+    def refresh_once(self):
+        ok = True
+        for region in FALLBACK_TRENDING:
+            try:
+                self.snapshot = dict(self.snapshot, **{region: _fetch_trending(region)})
+                self.updated_at[region] = time.time()
+            except Exception as e:
+                ok = False
+                logger.warning(f"Trending refresh ({region}) failed: {e}")
+        self.failures = 0 if ok else self.failures + 1
+        return ok
+
+    def _delay(self):
+        base = self.interval if not self.failures else min(self.max_backoff, 30 * 2 ** self.failures)
+        return base * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _run(self):
+        time.sleep(random.uniform(0, 5))     # spread the first hit across workers
+        while True:
+            self.refresh_once()
+            delay = self._delay()
+            self.next_run = time.time() + delay
+            time.sleep(delay)
+
+    def get(self, region):
+        self.start()
+        return self.snapshot[region]
+
+    def stats(self):
+        now = time.time()
+        return {"age_s": {r: (int(now - t) if t else None) for r, t in self.updated_at.items()},
+                "failures": self.failures,
+                "next_refresh_s": int(self.next_run - now) if self.next_run else None}
+
+
+trending = TrendingRefresher()
+
+
+def _roast_queries(topic):
+    return [
+        f"{topic} funny memes",
+        f"{topic} fail controversy",
+        f"{topic} problems issues",
+        f"{topic} jokes roast"
+    ]
+
+
+def _timed_query(q, timeout):
+    """One DDGS text query on its own session (DDGS isn't thread-safe) → (snippets, ms)"""
+    t0 = time.time()
+    with DDGS(timeout=timeout) as ddgs:
+        results = list(ddgs.text(q, max_results=2))
+    return [r['body'][:100] for r in results], int((time.time() - t0) * 1000)
+
+
+def get_topic_roast_material_parallel(topic, deadline_ms=SEARCH_DEADLINE_MS):
+    """Fan the roast queries out concurrently; keep what lands before the deadline"""
+    queries = _roast_queries(topic)
+    ddgs_timeout = max(1, math.ceil(deadline_ms / 1000))    # stragglers give up soon after
+    t0   = time.time()
+    futs = [_search_pool.submit(_timed_query, q, ddgs_timeout) for q in queries]
+    done, pending = wait(futs, timeout=deadline_ms / 1000)
+    for f in pending:
+        f.cancel()
+
+    all_context, timings = [], []
+    for q, f in zip(queries, futs):
+        if f not in done:
+            timings.append(f"{q!r}: timeout")
+            continue
+        try:
+            snippets, ms = f.result()
+            all_context.extend(snippets)
+            timings.append(f"{q!r}: {ms}ms")
+        except Exception as e:
+            _search_stats["errors"] += 1
+            timings.append(f"{q!r}: error {e}")
+    _search_stats["fanouts"]  += 1
+    _search_stats["queries"]  += len(queries)
+    _search_stats["timeouts"] += len(pending)
+    logger.info(f"Search fan-out {len(done)}/{len(queries)} in {int((time.time() - t0) * 1000)}ms"
+                f" ({len(pending)} timed out) — " + ", ".join(timings))
+    return " | ".join(all_context)[:600]
+
+
+def search_stats():
+    return dict(_search_stats)
 
 
 def get_topic_roast_material(topic):
     """Get roast material - failures, controversies, funny facts"""
+    if SEARCH_PARALLEL:
+        try:
+            return get_topic_roast_material_parallel(topic)
+        except Exception:
+            return ""
     try:
         with DDGS() as ddgs:
             # Search for roastable content
-            queries = [
-                f"{topic} funny memes",
-                f"{topic} fail controversy",
-                f"{topic} problems issues",
-                f"{topic} jokes roast"
-            ]
+            queries = _roast_queries(topic)
             
             all_context = []
             for q in queries:
@@ -74,19 +245,59 @@ def get_topic_roast_material(topic):
         return ""
 
 
+def normalize_topic(topic):
+    """Cache key for a topic — case, spacing and surrounding punctuation don't matter"""
+    return " ".join((topic or "").lower().split()).strip(string.punctuation + " ")
+
+
+def _fetch_topic_info(topic):
+    return get_topic_roast_material(topic) or search_topic_context(topic)
+
+
+def _refresh_async(key, topic):
+    with _refresh_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            info = _fetch_topic_info(topic)
+            if info:    # on failure keep serving the stale copy
+                _context_cache.set(key, (time.time(), info))
+        except Exception as e:
+            logger.warning(f"Context refresh error for {topic!r}: {e}")
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_topic_info(topic):
+    """Cached roast material for a topic (stale-while-revalidate)"""
+    key = normalize_topic(topic)
+    fetched_at, info = _context_cache.get_or_load(
+        key, lambda: (time.time(), _fetch_topic_info(topic)), negative=lambda v: not v[1])
+    if info and time.time() - fetched_at > CONTEXT_TTL:
+        _refresh_async(key, topic)
+    return info
+
+
+def context_cache_stats():
+    return dict(_context_cache.stats(), refreshing=len(_refreshing), search=search_stats())
+
+
 def get_smart_context(topic, language='hindi'):
     """Get context formatted for roasting"""
-    raw_context = get_topic_roast_material(topic)
-    
-    if not raw_context:
-        raw_context = search_topic_context(topic)
+    raw_context = get_topic_info(topic)
     
-    # Add trending angle
-    trending = get_india_trending() if language == 'hindi' else get_global_trending()
+    # Add trending angle (background snapshot — no Google Trends call here)
+    trending_now = trending.get('india' if language == 'hindi' else 'global')
     
     context_data = {
         "topic_info": raw_context,
-        "trending_now": trending[:5],
+        "trending_now": trending_now[:5],
         "roast_angles": [
             "hypocrisy", "failure", "overconfidence",
             "delusion", "fakeness", "laziness"
@@ -0,0 +1,142 @@
+"""
+tests/test_battle_rounds.py
+===========================
+Round numbering under concurrency (core/battles.add_round / BattleCache.add_round)
+against a real database. Skipped unless DATABASE_URL is set; the schema is
+brought up with core.migrations and every test battle is deleted afterwards.
+  DATABASE_URL=postgresql://... python -m pytest tests/test_battle_rounds.py
+"""
+
+import os, sys, secrets, threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+DSN = os.environ.get("DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DSN, reason="needs DATABASE_URL (a throwaway Postgres)")
+
+THREADS, MOVES = 8, 25
+
+
+@pytest.fixture(scope="module")
+def db():
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    from core.migrations import migrate
+
+    def connect():
+        return psycopg2.connect(DSN, cursor_factory=RealDictCursor)
+
+    conn = connect()
+    migrate(conn)
+    conn.close()
+    return connect
+
+
+@pytest.fixture
+def battle(db):
+    """A fresh active battle between players 'a' and 'b' → battle_id; removed afterwards."""
+    battle_id = "T-" + secrets.token_hex(4).upper()
+    conn = db()
+    cur  = conn.cursor()
+    cur.execute('''INSERT INTO battles (battle_id, topic, status, challenger_id, challenger_name,
+                   opponent_id, opponent_name) VALUES (%s,'test','active','a','A','b','B')''', (battle_id,))
+    conn.commit()
+    yield battle_id
+    cur.execute('DELETE FROM battle_rounds WHERE battle_id=%s', (battle_id,))
+    cur.execute('DELETE FROM battles WHERE battle_id=%s', (battle_id,))
+    conn.commit()
+    conn.close()
+
+
+def _rounds(db, battle_id):
+    conn = db()
+    cur  = conn.cursor()
+    cur.execute('SELECT round_num FROM battle_rounds WHERE battle_id=%s ORDER BY round_num', (battle_id,))
+    nums = [r['round_num'] for r in cur.fetchall()]
+    cur.execute('SELECT total_rounds FROM battles WHERE battle_id=%s', (battle_id,))
+    total = cur.fetchone()['total_rounds']
+    conn.close()
+    return nums, total
+
+
+def _hammer(db, fn, battle_id):
+    """THREADS connections x MOVES calls of fn(conn, battle_id, player, text) → (returned, errors)."""
+    returned, errors, start = [], [], threading.Barrier(THREADS)
+
+    def player(i):
+        conn = db()
+        start.wait()
+        for m in range(MOVES):
+            try:
+                returned.append(fn(conn, battle_id, "ab"[i % 2], f"roast {i}.{m}"))
+            except Exception as e:
+                conn.rollback()
+                errors.append(e)
+        conn.close()
+
+    ts = [threading.Thread(target=player, args=(i,)) for i in range(THREADS)]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    return returned, errors
+
+
+def test_concurrent_add_round_is_gap_free(db, battle):
+    from core.battles import add_round
+    n = THREADS * MOVES
+    returned, errors = _hammer(db, add_round, battle)
+    assert not errors
+    nums, total = _rounds(db, battle)
+    assert nums == list(range(1, n + 1))                       # unique, gap-free, 1..N
+    assert total == n
+    assert sorted(r[0] for r in returned) == nums              # each caller got the number it stored
+    assert {r[1] for r in returned} == {"A", "B"}              # player_name from the battle row
+
+
+def test_battle_cache_add_round_writes_through(db, battle):
+    from contextlib import contextmanager
+    from core.battles import BattleCache
+
+    @contextmanager
+    def get_conn():
+        conn = db()
+        try:     yield conn
+        finally: conn.close()
+
+    cache = BattleCache(get_conn)
+    assert cache.get(battle)['total_rounds'] == 0
+    returned, errors = _hammer(db, cache.add_round, battle)
+    assert not errors
+    n = THREADS * MOVES
+    assert sorted(r[0] for r in returned) == list(range(1, n + 1))
+    assert cache.get(battle)['total_rounds'] == n               # newest version won, no stale put
+    assert [r['round_num'] for r in cache.rounds(battle)] == list(range(1, n + 1))
+
+
+def test_add_round_on_ended_battle(db, battle):
+    from core.battles import add_round
+    conn = db()
+    assert add_round(conn, battle, "a", "first")[0] == 1
+    conn.cursor().execute("UPDATE battles SET status='ended' WHERE battle_id=%s", (battle,))
+    conn.commit()
+    assert add_round(conn, battle, "b", "too late") is None
+    assert add_round(conn, battle, "x", "not a player") is None
+    conn.close()
+    assert _rounds(db, battle) == ([1], 1)
+
+
+def test_battle_roast_409_when_battle_ends_mid_roast(db, battle, monkeypatch):
+    """The route saw an active battle, but it ended while the roast was being generated."""
+    os.environ.setdefault("GROQ_API_KEY", "test")
+    os.environ.setdefault("STORAGE_BACKEND", "local")
+    app = pytest.importorskip("app")
+    stale = dict(app.get_battle(battle))                       # active snapshot, taken before the end
+    conn = db()
+    conn.cursor().execute("UPDATE battles SET status='ended' WHERE battle_id=%s", (battle,))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(app, "get_battle", lambda battle_id: stale)
+    monkeypatch.setattr(app, "pooled_or_live_roast", lambda *a: ("Label", "a roast"))
+    r = app.app.test_client().post(f"/battle/{battle}/roast", json={"session_id": "a"})
+    assert r.status_code == 409
+    assert _rounds(db, battle) == ([], 0)
@@ -0,0 +1,74 @@
+"""
+tests/test_query_plans.py
+=========================
+Index regression check: EXPLAIN the queries the app runs on its hot paths and
+assert each plan uses the index that was added for it. Seq scans are disabled,
+since a small test table would always be seq-scanned. Skipped unless
+DATABASE_URL is set; the schema is brought up with core.migrations.
+  DATABASE_URL=postgresql://... python -m pytest tests/test_query_plans.py
+"""
+
+import os, sys, json
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from core.roast_pool import POP_SQL
+
+DSN = os.environ.get("DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DSN, reason="needs DATABASE_URL (a throwaway Postgres)")
+
+# (name, query as the app runs it, params, index the plan must use)
+PLAN_CHECKS = [
+    ("battle snapshot (core/battles)", 'SELECT * FROM battles WHERE battle_id=%s',
+     ("RB-00000",), "battles_battle_id_key"),
+    ("battle rounds (core/battles)", '''SELECT * FROM battle_rounds WHERE battle_id=%s AND round_num <= %s
+                                        ORDER BY round_num''', ("RB-00000", 10), "uq_battle_rounds_battle_round"),
+    ("gali status (core/counters)", 'SELECT roast_count,gali_unlocked FROM user_roast_count WHERE session_id=%s',
+     ("s",), "user_roast_count_pkey"),
+    ("pooled roast pop (core/roast_pool)", POP_SQL, ("t", "hindi", 3, 3600, []), "idx_roast_pool_bucket"),
+    ("roast pool demand (app)", '''SELECT topic, language, quality, COUNT(*) AS cnt FROM analytics
+        WHERE success=TRUE AND topic!='' AND quality IS NOT NULL
+          AND created_at > (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %s)
+        GROUP BY topic, language, quality ORDER BY cnt DESC LIMIT %s''',
+     (600, 20), "idx_analytics_success_created"),
+    ("top topics (core/rollups)", '''SELECT value AS topic, ok AS cnt FROM analytics_rollup
+        WHERE period=%s AND dim=%s AND ok > 0 AND value <> '' ORDER BY ok DESC LIMIT %s''',
+     ("all", "topic", 10), "idx_rollup_top"),
+    ("admin: recent battles", "SELECT battle_id,topic,status,total_rounds FROM battles ORDER BY created_at DESC LIMIT 10",
+     (), "idx_battles_created"),
+    ("admin: battles completed", "SELECT COUNT(*) as c FROM battles WHERE status='ended'",
+     (), "idx_battles_status"),
+    ("admin: recent roasts", '''SELECT topic,language,quality_name,country,device_type,created_at FROM analytics
+        WHERE success=TRUE ORDER BY created_at DESC LIMIT 15''', (), "idx_analytics_success_created"),
+]
+
+
+@pytest.fixture(scope="module")
+def conn():
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    from core.migrations import migrate
+    conn = psycopg2.connect(DSN, cursor_factory=RealDictCursor)
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def _plan_indexes(node):
+    found = {node["Index Name"]} if "Index Name" in node else set()
+    for child in node.get("Plans", ()):
+        found |= _plan_indexes(child)
+    return found
+
+
+@pytest.mark.parametrize("name,sql,params,index", PLAN_CHECKS, ids=[c[0] for c in PLAN_CHECKS])
+def test_query_uses_index(conn, name, sql, params, index):
+    cur = conn.cursor()
+    try:
+        cur.execute('SET LOCAL enable_seqscan = off')
+        cur.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cur.fetchone()['QUERY PLAN']
+    finally:
+        conn.rollback()
+    if isinstance(plan, str): plan = json.loads(plan)
+    assert index in _plan_indexes(plan[0]["Plan"])